@@ -0,0 +1,275 @@
+"""Batch classification of an image archive, incremental across runs.
+
+Usage:
+    python batch_classify.py ARCHIVE_DIR [--batch-size 32] [--full] [--retry-errors] [--prune] [--export results.csv]
+
+A manifest of (path, mtime, size, content hash, model fingerprint) is kept in
+the prediction store database. Each run only reads files that are new or whose
+mtime/size changed, and only runs the model on images whose content hash has
+no stored prediction for the current model fingerprint. Replacing
+``cnn_thyroid_model.h5`` changes the fingerprint, so the next run re-classifies
+everything. Manifest rows are committed after every batch, so an interrupted
+run resumes where it stopped. Files that could not be read or decoded are
+tried again on the next run. Images failing the quality gate are recorded
+with the gate's reasons as their error and are never sent to the model (nor
+re-checked, unless ``--retry-errors`` is given).
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pipeline
+import quality_gate
+from result_store import ResultStore, RESULT_STORE_PATH, connect
+
+BATCH_SIZE = int(os.environ.get('THYROID_BATCH_SIZE', '32'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_manifest (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT,
+    model_fingerprint TEXT,
+    label TEXT,
+    probabilities TEXT,
+    error TEXT,
+    classified_at REAL
+) WITHOUT ROWID;
+"""
+MANIFEST_COLUMNS = ('path', 'mtime_ns', 'size', 'content_hash', 'model_fingerprint', 'label',
+                    'probabilities', 'error', 'classified_at')
+QUALITY_GATE_ERROR = 'quality gate: '
+
+
+# --------------------------
+# Archive scan
+# --------------------------
+def scan_archive(archive_dir):
+    """Yield (absolute path, mtime_ns, size) for every image under archive_dir"""
+    stack = [os.path.abspath(archive_dir)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(pipeline.IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime_ns, stat.st_size
+
+
+def _prefix_range(archive_dir):
+    """(low, high) bounds selecting every manifest path under archive_dir with an index range scan"""
+    prefix = os.path.join(os.path.abspath(archive_dir), '')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ArchiveManifest:
+    """Per-file state of previous runs, stored next to the cached predictions"""
+
+    def __init__(self, db_path=RESULT_STORE_PATH):
+        self.conn = connect(db_path)
+        self.conn.executescript(_SCHEMA)
+
+    def load(self, archive_dir):
+        """Return {path: row dict} for every manifest entry under archive_dir"""
+        rows = self.conn.execute(
+            f"SELECT {', '.join(MANIFEST_COLUMNS)} FROM archive_manifest WHERE path >= ? AND path < ?",
+            _prefix_range(archive_dir)
+        ).fetchall()
+        return {row[0]: dict(zip(MANIFEST_COLUMNS, row)) for row in rows}
+
+    def upsert(self, entries):
+        """Insert or replace manifest rows in one transaction (one checkpoint)"""
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO archive_manifest ({', '.join(MANIFEST_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(MANIFEST_COLUMNS))})",
+                [tuple(entry.get(column) for column in MANIFEST_COLUMNS) for entry in entries]
+            )
+
+    def prune(self, paths):
+        """Drop entries for files that no longer exist"""
+        with self.conn:
+            self.conn.executemany("DELETE FROM archive_manifest WHERE path = ?", [(p,) for p in paths])
+
+    def close(self):
+        self.conn.close()
+
+
+# --------------------------
+# Incremental run
+# --------------------------
+def _needs_retry(entry, retry_errors):
+    """Read and decode errors are often transient (partial copies, network mounts) and are always retried;
+    quality-gate rejections depend only on the file's bytes, so they are re-checked only with retry_errors"""
+    if not entry['error']:
+        return False
+    return retry_errors or not entry['error'].startswith(QUALITY_GATE_ERROR)
+
+
+def _chunks(items, size):
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+
+def classify_archive(archive_dir, model_path=pipeline.MODEL_PATH, encoder_path=pipeline.LABEL_ENCODER_PATH,
+                     db_path=RESULT_STORE_PATH, batch_size=BATCH_SIZE, full=False, prune=False, retry_errors=False,
+                     log=print):
+    """Bring the manifest for archive_dir up to date with the current model; returns run statistics"""
+    start = time.perf_counter()
+    # Whole frames: ROI results are the app's, stored apart
+    fingerprint = pipeline.serving_fingerprint(model_path, roi_mode='off')
+    manifest = ArchiveManifest(db_path)
+    store = ResultStore(db_path)
+    previous = manifest.load(archive_dir)
+    stats = {'scanned': 0, 'unchanged': 0, 'retried': 0, 'reused': 0, 'classified': 0, 'failed': 0,
+             'rejected': 0, 'flagged': 0, 'pruned': 0}
+
+    # 1. stat-only pass: unchanged files with a result for this model are never opened
+    candidates, seen = [], set()
+    for path, mtime_ns, size in scan_archive(archive_dir):
+        stats['scanned'] += 1
+        seen.add(path)
+        entry = previous.get(path)
+        if (not full and entry is not None and entry['mtime_ns'] == mtime_ns and entry['size'] == size
+                and entry['model_fingerprint'] == fingerprint):
+            if not _needs_retry(entry, retry_errors):
+                stats['unchanged'] += 1
+                continue
+            stats['retried'] += 1
+        candidates.append({'path': path, 'mtime_ns': mtime_ns, 'size': size})
+
+    if prune:
+        gone = [path for path in previous if path not in seen]
+        manifest.prune(gone)
+        stats['pruned'] = len(gone)
+
+    model = class_map = None
+    for chunk in _chunks(candidates, batch_size):
+        # 2. hash the changed files; content already classified by this model (here or in the app) is reused
+        for entry in chunk:
+            try:
+                with open(entry['path'], 'rb') as f:
+                    entry['data'] = f.read()
+                entry['content_hash'] = pipeline.image_hash(entry['data'])
+            except OSError as e:
+                entry['error'] = str(e)
+        cached = store.get_many([e['content_hash'] for e in chunk if 'content_hash' in e], fingerprint)
+
+        to_predict, pixels = [], []
+        for entry in chunk:
+            entry['model_fingerprint'] = fingerprint
+            entry['classified_at'] = time.time()
+            record = cached.get(entry.get('content_hash'))
+            if record is not None:
+                entry['label'] = record['label']
+                entry['probabilities'] = json.dumps(record['probabilities'])
+                stats['reused'] += 1
+            elif 'data' in entry:
+                try:
+                    image = pipeline.decode_image(io.BytesIO(entry.pop('data')))
+                    image_pixels, quality = quality_gate.assess_image(image)
+                except Exception as e:
+                    entry['error'] = str(e)
+                else:
+                    # Rejected images are recorded like failures but never cost an inference
+                    if quality['verdict'] == 'reject':
+                        entry['error'] = QUALITY_GATE_ERROR + '; '.join(quality['reasons'])
+                        stats['rejected'] += 1
+                        continue
+                    stats['flagged'] += quality['verdict'] == 'flag'
+                    pixels.append(image_pixels)
+                    to_predict.append(entry)
+            if entry.get('error'):
+                stats['failed'] += 1
+
+        # 3. one batched predict for everything left
+        if to_predict:
+            if model is None:
+                model = pipeline.load_serving_model(model_path)
+                class_map = pipeline.load_class_map(encoder_path)
+                class_map.check_model(model)
+            preprocess_start = time.perf_counter()
+            batch = pipeline.normalize_pixels(np.stack(pixels))
+            predict_start = time.perf_counter()
+            predictions = model.predict(batch, batch_size=len(batch), verbose=0)
+            predict_end = time.perf_counter()
+            labels = class_map.labels(predictions)
+            timings = {
+                'preprocess_ms': (predict_start - preprocess_start) * 1000 / len(to_predict),
+                'predict_ms': (predict_end - predict_start) * 1000 / len(to_predict),
+                'batch_size': len(to_predict)
+            }
+            store.put_many([
+                {'image_hash': entry['content_hash'], 'label': label, 'probabilities': row, 'timings': timings}
+                for entry, label, row in zip(to_predict, labels, predictions)
+            ], fingerprint)
+            for entry, label, row in zip(to_predict, labels, predictions):
+                entry['label'] = str(label)
+                entry['probabilities'] = json.dumps([float(p) for p in row])
+            stats['classified'] += len(to_predict)
+
+        # Checkpoint: everything up to here survives an interruption
+        manifest.upsert(chunk)
+        done = stats['reused'] + stats['classified'] + stats['failed'] + stats['rejected']
+        log(f"{done}/{len(candidates)} changed images done")
+
+    manifest.close()
+    stats['seconds'] = time.perf_counter() - start
+    stats['model_fingerprint'] = fingerprint
+    return stats
+
+
+def export_results(archive_dir, output_path, db_path=RESULT_STORE_PATH):
+    """Write the current manifest for archive_dir as CSV"""
+    manifest = ArchiveManifest(db_path)
+    try:
+        entries = manifest.load(archive_dir)
+    finally:
+        manifest.close()
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'label', 'probabilities', 'content_hash', 'model_fingerprint', 'error'])
+        for path in sorted(entries):
+            entry = entries[path]
+            writer.writerow([os.path.relpath(path, archive_dir), entry['label'], entry['probabilities'],
+                             entry['content_hash'], entry['model_fingerprint'], entry['error']])
+    return len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally classify every image in an archive folder")
+    parser.add_argument("archive_dir", help="Folder to scan recursively")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--db", default=RESULT_STORE_PATH, help="Prediction store holding the manifest")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Images per predict call and checkpoint")
+    parser.add_argument("--full", action="store_true", help="Ignore the manifest and re-check every file")
+    parser.add_argument("--retry-errors", action="store_true",
+                        help="Also re-check unchanged files the quality gate rejected (read errors are always retried)")
+    parser.add_argument("--prune", action="store_true", help="Forget manifest entries for deleted files")
+    parser.add_argument("--export", default=None, help="Write the archive's results to this CSV file")
+    args = parser.parse_args(argv)
+
+    try:
+        stats = classify_archive(args.archive_dir, args.model, args.encoder, args.db, args.batch_size,
+                                 args.full, args.prune, args.retry_errors, log=lambda message: print(message, file=sys.stderr))
+    except KeyboardInterrupt:
+        print("Interrupted; completed batches are checkpointed and the next run resumes from there",
+              file=sys.stderr)
+        raise SystemExit(130)
+    print(json.dumps(stats, indent=2))
+    if args.export:
+        count = export_results(args.archive_dir, args.export, args.db)
+        print(f"Exported {count} results -> {args.export}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
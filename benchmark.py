@@ -0,0 +1,276 @@
+"""Offline accuracy and speed benchmark over a labelled image folder.
+
+Usage:
+    python benchmark.py DATA_DIR [--batch-sizes 1,8,32] [--output results.json]
+
+DATA_DIR must contain one subfolder per class (``benign/`` and ``malignant/``).
+Every image goes through the same pipeline as ``streamlit_app.py``:
+decode -> preprocess_image -> model.predict -> class map label lookup.
+
+DATA_DIR may also be a folder written by ``dataset_cache.py``; images are then
+streamed from the memory-mapped shards and only normalised, so the decode stage
+measures the mmap read instead of JPEG/PNG decoding.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+
+import pipeline
+from dataset_cache import PackedDataset, is_pack_dir
+from inference_pool import InferencePool
+
+STAGES = ('decode', 'preprocess', 'predict', 'label_lookup', 'total')
+# Latency histogram bucket edges in milliseconds (Prometheus-style upper bounds)
+LATENCY_BUCKETS_MS = [0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+CALIBRATION_BINS = 10
+
+
+# --------------------------
+# Metrics
+# --------------------------
+def latency_summary(samples_ms):
+    """Percentiles and a cumulative histogram for one stage"""
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    if samples.size == 0:
+        return {'count': 0}
+    counts = [int(np.count_nonzero(samples <= edge)) for edge in LATENCY_BUCKETS_MS]
+    return {
+        'count': int(samples.size),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+        'histogram': {'le_ms': LATENCY_BUCKETS_MS + ['+Inf'], 'cumulative_count': counts + [int(samples.size)]},
+    }
+
+
+def confusion_matrix(y_true, y_pred, n_classes):
+    """Rows are true classes, columns are predicted classes"""
+    matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+    np.add.at(matrix, (y_true, y_pred), 1)
+    return matrix
+
+
+def calibration_report(probabilities, y_true, n_bins=CALIBRATION_BINS):
+    """Expected calibration error, Brier score and a reliability table"""
+    confidence = probabilities.max(axis=1)
+    correct = (probabilities.argmax(axis=1) == y_true).astype(np.float64)
+    edges = np.linspace(0.0, 1.0, n_bins + 1)
+    bin_index = np.clip(np.digitize(confidence, edges[1:-1], right=True), 0, n_bins - 1)
+
+    bins, ece = [], 0.0
+    for b in range(n_bins):
+        mask = bin_index == b
+        count = int(mask.sum())
+        if count == 0:
+            continue
+        accuracy = float(correct[mask].mean())
+        mean_conf = float(confidence[mask].mean())
+        ece += count / len(confidence) * abs(accuracy - mean_conf)
+        bins.append({'lower': float(edges[b]), 'upper': float(edges[b + 1]), 'count': count,
+                     'accuracy': accuracy, 'mean_confidence': mean_conf})
+
+    one_hot = np.eye(probabilities.shape[1])[y_true]
+    brier = float(np.mean(np.sum((probabilities - one_hot) ** 2, axis=1)))
+    return {'ece': float(ece), 'brier_score': brier, 'bins': bins}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# --------------------------
+# Benchmark runs
+# --------------------------
+def load_labelled_source(data_dir, classes, limit=None):
+    """(source, class indices) for a labelled folder (list of paths) or a packed dataset"""
+    if is_pack_dir(data_dir):
+        # --limit takes the same kind of seeded class-mixed subset as for a folder
+        source = PackedDataset(data_dir, limit)
+        if source.classes != classes:
+            raise SystemExit(f"Pack classes {source.classes} do not match the label encoder {classes}")
+        y_true = source.labels
+    else:
+        source, y_true = pipeline.collect_labelled_images(data_dir, classes, limit)
+    if not len(source):
+        raise SystemExit(f"No labelled images found under {data_dir}")
+    return source, y_true
+
+
+def iter_batches(source, batch_size):
+    """Yield preprocessed batches from a list of image paths or a PackedDataset"""
+    if isinstance(source, PackedDataset):
+        for _, batch in source.batches(batch_size):
+            yield batch
+        return
+    for offset in range(0, len(source), batch_size):
+        chunk = source[offset:offset + batch_size]
+        yield np.concatenate([pipeline.preprocess_image(pipeline.decode_image(p)) for p in chunk], axis=0)
+
+
+def run_single_image_pass(model, class_map, source):
+    """Run the app pipeline one image at a time, timing every stage"""
+    if isinstance(source, PackedDataset):
+        items = range(len(source))
+        decode = lambda i: source.pixels(i, i + 1)  # noqa: E731
+        preprocess = pipeline.normalize_pixels
+    else:
+        items, decode, preprocess = source, pipeline.decode_image, pipeline.preprocess_image
+
+    timings = {stage: [] for stage in STAGES}
+    probabilities, labels = [], []
+    for item in items:
+        t0 = time.perf_counter()
+        img = decode(item)
+        t1 = time.perf_counter()
+        processed = preprocess(img)
+        t2 = time.perf_counter()
+        predictions = model.predict(processed, verbose=0)
+        t3 = time.perf_counter()
+        class_label = class_map.label(predictions[0])
+        t4 = time.perf_counter()
+
+        for stage, start, end in zip(STAGES, (t0, t1, t2, t3, t0), (t1, t2, t3, t4, t4)):
+            timings[stage].append((end - start) * 1000)
+        probabilities.append(predictions[0])
+        labels.append(class_label)
+    return np.array(probabilities), labels, timings
+
+
+def run_throughput_pass(model, class_map, source, batch_size):
+    """Images/sec for the full pipeline when images are processed in batches"""
+    start = time.perf_counter()
+    for batch in iter_batches(source, batch_size):
+        predictions = model.predict(batch, batch_size=batch_size, verbose=0)
+        class_map.labels(predictions)
+    elapsed = time.perf_counter() - start
+    return {'batch_size': batch_size, 'images': len(source), 'seconds': elapsed,
+            'images_per_sec': len(source) / elapsed if elapsed > 0 else 0.0}
+
+
+def run_pool_throughput_pass(pool, class_map, source, batch_size):
+    """Images/sec when batches are submitted concurrently to the inference worker pool"""
+    def run_batch(batch):
+        class_map.labels(pool.predict(batch))
+
+    start = time.perf_counter()
+    # One submitting thread per worker keeps every worker busy; at most two batches
+    # per worker are in flight so large datasets are not materialised up front
+    with ThreadPoolExecutor(max_workers=pool.workers) as executor:
+        pending = deque()
+        for batch in iter_batches(source, batch_size):
+            if len(pending) >= 2 * pool.workers:
+                pending.popleft().result()
+            pending.append(executor.submit(run_batch, batch))
+        for future in pending:
+            future.result()
+    elapsed = time.perf_counter() - start
+    return {'batch_size': batch_size, 'images': len(source), 'seconds': elapsed, 'inference_workers': pool.workers,
+            'images_per_sec': len(source) / elapsed if elapsed > 0 else 0.0}
+
+
+def run_benchmark(data_dir, model_path=pipeline.MODEL_PATH, encoder_path=pipeline.LABEL_ENCODER_PATH,
+                  batch_sizes=(1, 8, 32), limit=None, backend='tensorflow', warmup=2, inference_workers=0):
+    """Run accuracy, latency and throughput measurements and return a JSON-able dict"""
+    load_start = time.perf_counter()
+    model = pipeline.load_model(model_path)
+    class_map = pipeline.load_class_map(encoder_path)
+    class_map.check_model(model)
+    load_seconds = time.perf_counter() - load_start
+
+    classes = list(class_map.classes)
+    source, y_true = load_labelled_source(data_dir, classes, limit)
+
+    # Warm up graph tracing so the first image does not dominate p99
+    for batch in islice(iter_batches(source, 1), warmup):
+        model.predict(batch, verbose=0)
+
+    probabilities, predicted_labels, timings = run_single_image_pass(model, class_map, source)
+    y_pred = probabilities.argmax(axis=1)
+    matrix = confusion_matrix(y_true, y_pred, len(classes))
+
+    throughput = [run_throughput_pass(model, class_map, source, size) for size in batch_sizes]
+    if inference_workers:
+        pool = InferencePool(inference_workers, model_path)
+        try:
+            throughput += [run_pool_throughput_pass(pool, class_map, source, size) for size in batch_sizes]
+        finally:
+            pool.close()
+
+    return {
+        'run': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'data_dir': os.path.abspath(data_dir),
+            'packed': isinstance(source, PackedDataset),
+            'model_path': model_path,
+            'model_fingerprint': pipeline.model_fingerprint(model_path),
+            'backend': backend,
+            'tensorflow_version': tf.__version__,
+            'python_version': platform.python_version(),
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'model_load_seconds': load_seconds,
+        },
+        'dataset': {
+            'images': len(source),
+            'per_class': {name: int(np.count_nonzero(y_true == i)) for i, name in enumerate(classes)},
+        },
+        'accuracy': {
+            'accuracy': float(np.mean(y_pred == y_true)),
+            'classes': classes,
+            'confusion_matrix': matrix.tolist(),
+            'per_class_recall': {name: float(matrix[i, i] / max(matrix[i].sum(), 1)) for i, name in enumerate(classes)},
+            # The class map lookup must agree with argmax over the class list
+            'label_mismatches': int(sum(str(label) != classes[i] for label, i in zip(predicted_labels, y_pred))),
+        },
+        'calibration': calibration_report(probabilities, y_true),
+        'latency': {stage: latency_summary(samples) for stage, samples in timings.items()},
+        'throughput': throughput,
+        'memory': {'peak_rss_mb': peak_rss_mb()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the thyroid classifier on a labelled folder")
+    parser.add_argument("data_dir", help="Folder with benign/ and malignant/ subfolders, or a dataset_cache.py pack")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--batch-sizes", default="1,8,32", help="Comma-separated batch sizes for the throughput pass")
+    parser.add_argument("--limit", type=int, default=None, help="Only use this many images")
+    parser.add_argument("--backend", default="tensorflow", help="Free-form backend tag stored with the results")
+    parser.add_argument("--inference-workers", type=int, default=0,
+                        help="Also measure throughput through an inference worker pool of this size")
+    parser.add_argument("--output", default=None, help="Write results JSON here (default: print to stdout)")
+    args = parser.parse_args(argv)
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",") if size.strip()]
+    results = run_benchmark(args.data_dir, args.model, args.encoder, batch_sizes, args.limit, args.backend,
+                            inference_workers=args.inference_workers)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+        print(f"Accuracy {results['accuracy']['accuracy']:.3f}, "
+              f"p50 total {results['latency']['total']['p50_ms']:.1f} ms -> {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
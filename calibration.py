@@ -0,0 +1,309 @@
+"""Post-hoc probability calibration of the classifier's softmax outputs.
+
+Usage:
+    python calibration.py fit DATA_DIR [--method temperature|platt] [--holdout 0.3] [--output calibration.json]
+    python calibration.py evaluate DATA_DIR [--calibration calibration.json]
+
+CNN softmax scores are usually over-confident: a "97%" result is right less
+than 97% of the time. ``fit`` runs the model over a labelled folder (or pack),
+fits either one temperature ``T`` (``softmax(log p / T)``, the same for every
+class, so the predicted label never changes) or a Platt scaling of the
+malignant-vs-benign log-odds (slope and intercept; binary models only), and
+reports expected calibration error and Brier score before and after on a
+held-out share of the images. The parameters are written to
+``calibration.json`` next to the model together with the model fingerprint,
+so a calibration fitted for one model version is never applied to another.
+
+The app, the ingest daemon and the PDF report apply it to whole probability
+batches with ``Calibration.apply``: a log, a scale and a softmax over an
+(N, classes) array, a few microseconds per batch. Stored predictions stay raw;
+calibration happens on read, so refitting it needs no re-inference.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pipeline
+import roi
+from benchmark import calibration_report, iter_batches, load_labelled_source
+
+CALIBRATION_PATH = os.environ.get('THYROID_CALIBRATION', 'calibration.json')
+CALIBRATION_METHODS = ('temperature', 'platt')
+_EPSILON = 1e-7
+
+
+def temperature_scale(probabilities, temperature):
+    """Re-scale probabilities as softmax(log(p) / T); T > 1 softens, T < 1 sharpens"""
+    logits = np.log(np.clip(probabilities, _EPSILON, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def _log_odds(probabilities, positive_index):
+    """log(p_positive / p_other) for a (N, 2) probability batch"""
+    clipped = np.log(np.clip(probabilities, _EPSILON, 1.0))
+    return clipped[..., positive_index] - clipped[..., 1 - positive_index]
+
+
+class Calibration:
+    """Fitted calibration map, applied to (N, classes) or (classes,) probability arrays"""
+
+    def __init__(self, method='temperature', temperature=1.0, slope=1.0, intercept=0.0, positive_index=1,
+                 model_fingerprint=None, classes=None, metadata=None):
+        if method not in CALIBRATION_METHODS:
+            raise ValueError(f"Unknown calibration method: {method}")
+        self.method = method
+        self.temperature = float(temperature)
+        self.slope = float(slope)
+        self.intercept = float(intercept)
+        self.positive_index = int(positive_index)
+        self.model_fingerprint = model_fingerprint
+        self.classes = list(classes) if classes is not None else None
+        self.metadata = metadata or {}
+
+    def apply(self, probabilities):
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        if self.method == 'temperature':
+            return temperature_scale(probabilities, self.temperature).astype(np.float32)
+        positive = 1.0 / (1.0 + np.exp(-(self.slope * _log_odds(probabilities, self.positive_index) + self.intercept)))
+        calibrated = np.empty_like(probabilities)
+        calibrated[..., self.positive_index] = positive
+        calibrated[..., 1 - self.positive_index] = 1.0 - positive
+        return calibrated
+
+    def describe(self):
+        """One-line summary for the UI and the PDF report"""
+        if self.method == 'temperature':
+            return f"Temperature scaling (T = {self.temperature:.2f})"
+        return f"Platt scaling (slope {self.slope:.2f}, intercept {self.intercept:+.2f})"
+
+    def to_dict(self):
+        return {'method': self.method, 'temperature': self.temperature, 'slope': self.slope,
+                'intercept': self.intercept, 'positive_index': self.positive_index,
+                'model_fingerprint': self.model_fingerprint, 'classes': self.classes, **self.metadata}
+
+    @classmethod
+    def from_dict(cls, data):
+        params = ('method', 'temperature', 'slope', 'intercept', 'positive_index', 'model_fingerprint', 'classes')
+        return cls(**{key: data[key] for key in params if key in data},
+                   metadata={key: value for key, value in data.items() if key not in params})
+
+    def save(self, path=CALIBRATION_PATH):
+        # Written atomically: the app may be reading it while a refit finishes
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def load_calibration(model_fingerprint, classes=None, path=CALIBRATION_PATH):
+    """The calibration fitted for this model, or None (no file, or it belongs to another model)"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        calibration = Calibration.from_dict(json.load(f))
+    if calibration.model_fingerprint != model_fingerprint:
+        print(f"Ignoring {path}: it was fitted for model {str(calibration.model_fingerprint)[:12]}, "
+              f"not {model_fingerprint[:12]}", file=sys.stderr)
+        return None
+    if classes is not None and calibration.classes is not None and calibration.classes != [str(c) for c in classes]:
+        print(f"Ignoring {path}: classes {calibration.classes} do not match {list(classes)}", file=sys.stderr)
+        return None
+    return calibration
+
+
+# --------------------------
+# Fitting
+# --------------------------
+def _nll(probabilities, y_true):
+    return float(-np.mean(np.log(np.clip(probabilities[np.arange(len(y_true)), y_true], _EPSILON, 1.0))))
+
+
+def fit_temperature(probabilities, y_true, low=0.05, high=20.0, iterations=60):
+    """Temperature minimising the negative log-likelihood (golden-section search over log T)"""
+    # The NLL is unimodal in T, so a bracketing search needs no gradients or SciPy
+    ratio = (np.sqrt(5.0) - 1.0) / 2.0
+    a, b = np.log(low), np.log(high)
+    loss = lambda log_t: _nll(temperature_scale(probabilities, np.exp(log_t)), y_true)  # noqa: E731
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    loss_c, loss_d = loss(c), loss(d)
+    for _ in range(iterations):
+        if loss_c < loss_d:
+            b, d, loss_d = d, c, loss_c
+            c = b - ratio * (b - a)
+            loss_c = loss(c)
+        else:
+            a, c, loss_c = c, d, loss_d
+            d = a + ratio * (b - a)
+            loss_d = loss(d)
+    temperature = float(np.exp((a + b) / 2.0))
+    # A search that ends on (or on a plateau reaching) a bound found no optimum inside [low, high]:
+    # the clamp is not a fitted value
+    best = loss(np.log(temperature))
+    if any(abs(np.log(temperature / bound)) < 0.01 or loss(np.log(bound)) <= best for bound in (low, high)):
+        raise ValueError(f"Temperature fit ran into its bound (T={temperature:.3g}, search range {low:g}-{high:g}); "
+                         f"the fit set is too small, too separable or mislabelled")
+    return temperature
+
+
+def fit_platt(probabilities, y_true, positive_index, iterations=100):
+    """(slope, intercept) of a logistic regression on the positive-class log-odds (damped Newton)"""
+    if probabilities.shape[1] != 2:
+        raise ValueError("Platt scaling needs a binary model; use temperature scaling instead")
+    features = np.stack([_log_odds(probabilities, positive_index), np.ones(len(y_true))], axis=1).astype(np.float64)
+    positive = y_true == positive_index
+    # Platt's smoothed targets keep a near-separable set from driving the slope to infinity
+    target = np.where(positive, (positive.sum() + 1.0) / (positive.sum() + 2.0), 1.0 / ((~positive).sum() + 2.0))
+
+    def loss(weights):
+        z = features @ weights
+        return float(np.mean(np.logaddexp(0.0, z) - target * z))
+
+    weights = np.array([1.0, 0.0])
+    current = loss(weights)
+    for _ in range(iterations):
+        predicted = 1.0 / (1.0 + np.exp(-np.clip(features @ weights, -500.0, 500.0)))
+        gradient = features.T @ (predicted - target)
+        hessian = (features * (predicted * (1.0 - predicted))[:, None]).T @ features + 1e-9 * np.eye(2)
+        step = np.linalg.solve(hessian, gradient)
+        # Halve the step until the loss goes down; saturated outputs make the plain Newton step overshoot
+        scale = 1.0
+        while scale > 1e-6 and loss(weights - scale * step) > current:
+            scale /= 2.0
+        weights -= scale * step
+        previous, current = current, loss(weights)
+        if previous - current < 1e-12:
+            break
+    # A non-positive slope flattens or inverts the positive-class probability
+    if weights[0] <= 0:
+        raise ValueError(f"Platt fit gave a non-positive slope ({weights[0]:.3g}); the model's scores do not "
+                         f"separate the classes on this fit set")
+    return float(weights[0]), float(weights[1])
+
+
+def fit_calibration(probabilities, y_true, method, class_map, model_fingerprint=None):
+    """Fit a Calibration of the given method to raw model probabilities and their true class indices"""
+    if method == 'temperature':
+        return Calibration('temperature', temperature=fit_temperature(probabilities, y_true),
+                           model_fingerprint=model_fingerprint, classes=list(class_map.classes))
+    slope, intercept = fit_platt(probabilities, y_true, class_map.malignant_index)
+    return Calibration('platt', slope=slope, intercept=intercept, positive_index=class_map.malignant_index,
+                       model_fingerprint=model_fingerprint, classes=list(class_map.classes))
+
+
+def split_holdout(count, fraction, seed=0):
+    """(fit indices, held-out indices); the held-out share is used only for the before/after report"""
+    order = np.random.default_rng(seed).permutation(count)
+    held_out = int(round(count * fraction))
+    if not held_out:
+        return order, order
+    return np.sort(order[held_out:]), np.sort(order[:held_out])
+
+
+def compare(raw, calibrated, y_true):
+    """ECE, Brier score and mean confidence before and after calibration"""
+    report = {}
+    for name, probabilities in (('before', raw), ('after', calibrated)):
+        stats = calibration_report(probabilities, y_true)
+        report[name] = {'ece': stats['ece'], 'brier_score': stats['brier_score'],
+                        'mean_confidence': float(probabilities.max(axis=1).mean()),
+                        'accuracy': float(np.mean(probabilities.argmax(axis=1) == y_true)), 'bins': stats['bins']}
+    return report
+
+
+# --------------------------
+# CLI
+# --------------------------
+def _model_and_fingerprint(model_path):
+    """The model the app would serve and the fingerprint it stores results under"""
+    return pipeline.load_serving_model(model_path), pipeline.serving_fingerprint(model_path)
+
+
+def _raw_probabilities(model, source, batch_size, malignant_index):
+    """Uncalibrated model outputs for every image of a source, as the app would compute them"""
+    if roi.ROI_MODE == 'off':
+        return np.concatenate([model.predict(batch, batch_size=len(batch), verbose=0)
+                               for batch in iter_batches(source, batch_size)])
+    if not isinstance(source, list):
+        raise SystemExit("THYROID_ROI_MODE needs an image folder; packs only hold 128×128 model inputs")
+    return np.stack([
+        result['probabilities']
+        for offset in range(0, len(source), batch_size)
+        for result in roi.classify_images(model, [pipeline.decode_image(p) for p in source[offset:offset + batch_size]],
+                                          malignant_index=malignant_index)
+    ])
+
+
+def _print_comparison(report):
+    print(f"{'':<8}{'ECE':>9}{'Brier':>9}{'mean conf':>11}{'accuracy':>10}", file=sys.stderr)
+    for name in ('before', 'after'):
+        r = report[name]
+        print(f"{name:<8}{r['ece']:>9.4f}{r['brier_score']:>9.4f}{r['mean_confidence']:>11.1%}{r['accuracy']:>10.1%}",
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit and check post-hoc calibration of the classifier")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per predict call")
+    parser.add_argument("--limit", type=int, default=None, help="Only use this many images")
+    commands = parser.add_subparsers(dest="command", required=True)
+    fit_parser = commands.add_parser("fit", help="Fit a calibration on a labelled folder")
+    fit_parser.add_argument("data_dir", help="Folder with benign/ and malignant/ subfolders, or a pack")
+    fit_parser.add_argument("--method", choices=CALIBRATION_METHODS, default='temperature', help="Calibration map")
+    fit_parser.add_argument("--holdout", type=float, default=0.3,
+                            help="Share of images kept out of the fit for the before/after report (0 reports on the fit set)")
+    fit_parser.add_argument("--output", default=CALIBRATION_PATH, help="Where to write the calibration")
+    evaluate_parser = commands.add_parser("evaluate", help="ECE before/after an existing calibration")
+    evaluate_parser.add_argument("data_dir", help="Folder with benign/ and malignant/ subfolders, or a pack")
+    evaluate_parser.add_argument("--calibration", default=CALIBRATION_PATH, help="Calibration file to check")
+    args = parser.parse_args(argv)
+
+    model, fingerprint = _model_and_fingerprint(args.model)
+    class_map = pipeline.load_class_map(args.encoder)
+    class_map.check_model(model)
+    source, y_true = load_labelled_source(args.data_dir, list(class_map.classes), args.limit)
+    raw = _raw_probabilities(model, source, args.batch_size, class_map.malignant_index)
+
+    if args.command == "fit":
+        fit_index, report_index = split_holdout(len(raw), args.holdout)
+        try:
+            calibration = fit_calibration(raw[fit_index], y_true[fit_index], args.method, class_map, fingerprint)
+        except ValueError as e:
+            raise SystemExit(f"Not writing {args.output}: {e}")
+    else:
+        calibration = load_calibration(fingerprint, class_map.classes, args.calibration)
+        if calibration is None:
+            raise SystemExit(f"No calibration for this model in {args.calibration}")
+        report_index = np.arange(len(raw))
+
+    start = time.perf_counter()
+    calibrated = calibration.apply(raw[report_index])
+    apply_us = (time.perf_counter() - start) * 1e6
+    report = compare(raw[report_index], calibrated, y_true[report_index])
+    print(f"{calibration.describe()}; applied to {len(report_index)} images in {apply_us:.0f} µs", file=sys.stderr)
+    _print_comparison(report)
+
+    if args.command == "fit":
+        calibration.metadata = {
+            'fitted_on': os.path.abspath(args.data_dir),
+            'fit_images': len(fit_index),
+            'report_images': len(report_index),
+            'ece_before': report['before']['ece'],
+            'ece_after': report['after']['ece'],
+            'brier_before': report['before']['brier_score'],
+            'brier_after': report['after']['brier_score'],
+            'created_at': time.time(),
+        }
+        calibration.save(args.output)
+        print(f"-> {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
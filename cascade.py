@@ -0,0 +1,259 @@
+"""Two-stage cascade: a small distilled student first, the full CNN only when it is unsure.
+
+Usage:
+    python cascade.py distill DATA_DIR [--output cnn_thyroid_student.h5] [--epochs 15]
+    python cascade.py evaluate DATA_DIR [--student cnn_thyroid_student.h5] [--thresholds 0.8,0.9,0.95,0.99]
+
+``distill`` trains a student of a few thousand parameters on the current
+model's temperature-softened outputs; the class folders of DATA_DIR only locate
+the images, their labels are not used. ``evaluate`` runs the full model, the
+student and the cascade at several confidence thresholds over a labelled
+folder and reports throughput, escalation rate, agreement with the full model
+and accuracy.
+
+``CascadeModel`` mirrors ``model.predict``: the student scores the whole batch
+and only rows whose top probability is below ``THYROID_CASCADE_THRESHOLD`` are
+sent to the full model. The app switches to it when ``THYROID_CASCADE_STUDENT``
+points at a student model.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+
+import pipeline
+from benchmark import iter_batches, load_labelled_source
+from calibration import temperature_scale
+from metrics import increment
+
+CASCADE_STUDENT_PATH = os.environ.get('THYROID_CASCADE_STUDENT', '')
+CASCADE_THRESHOLD = float(os.environ.get('THYROID_CASCADE_THRESHOLD', '0.99'))
+STUDENT_OUTPUT_PATH = 'cnn_thyroid_student.h5'
+DISTILL_TEMPERATURE = 2.0
+
+
+# --------------------------
+# Cascade inference
+# --------------------------
+class CascadeModel:
+    """Drop-in for the full model: the student answers confident images, the full model the rest"""
+
+    def __init__(self, student, teacher, threshold=CASCADE_THRESHOLD):
+        self.student = student
+        self.teacher = teacher
+        self.threshold = threshold
+        # Lets ClassMap.check_model validate the class count (None for an InferencePool teacher)
+        self.output_shape = getattr(teacher, 'output_shape', (None, None))
+        # Escalated rows are a subset of one caller batch, so a Keras teacher can take them in one call too;
+        # an InferencePool only has predict()
+        self._teacher_predict = getattr(teacher, 'predict_on_batch', None) or (lambda rows: teacher.predict(rows))
+        self._lock = threading.Lock()
+        self.images = 0
+        self.escalated = 0
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        # predict() costs tens of milliseconds per call in Keras, far more than the student itself
+        probabilities = np.array(self.student.predict_on_batch(batch))
+        uncertain = np.flatnonzero(probabilities.max(axis=1) < self.threshold)
+        if uncertain.size:
+            probabilities[uncertain] = self._teacher_predict(batch[uncertain])
+        with self._lock:
+            self.images += len(batch)
+            self.escalated += int(uncertain.size)
+        increment('cascade_images', len(batch))
+        increment('cascade_escalated', int(uncertain.size))
+        return probabilities
+
+
+def cascade_fingerprint(model_fingerprint, student_path, threshold):
+    """Result-store key for cascade predictions; changes with either model or the threshold"""
+    key = f"{model_fingerprint}:{pipeline.model_fingerprint(student_path)}:{threshold}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def load_cascade(teacher, student_path=CASCADE_STUDENT_PATH, threshold=CASCADE_THRESHOLD):
+    """Wrap an already loaded full model (or InferencePool) in a cascade"""
+    return CascadeModel(tf.keras.models.load_model(student_path), teacher, threshold)
+
+
+# --------------------------
+# Distillation
+# --------------------------
+def build_student(n_classes, input_shape=(*pipeline.IMAGE_SIZE, 3)):
+    """(student, logits model): strided convolutions on a 2× downsampled input, then global max pooling"""
+    layers = tf.keras.layers
+    inputs = tf.keras.Input(shape=input_shape)
+    x = layers.AveragePooling2D(2)(inputs)
+    for filters in (8, 16, 32):
+        x = layers.Conv2D(filters, 3, strides=2, padding='same', use_bias=False)(x)
+        # A short distillation run is only a few hundred steps; the default 0.99 momentum
+        # leaves the inference-time statistics far from the trained ones
+        x = layers.BatchNormalization(momentum=0.9)(x)
+        x = layers.ReLU()(x)
+    # Max pooling keeps small focal findings that an average over the frame washes out
+    x = layers.GlobalMaxPooling2D()(x)
+    logits = layers.Dense(n_classes, name='logits')(x)
+    student = tf.keras.Model(inputs, layers.Softmax()(logits), name='thyroid_student')
+    return student, tf.keras.Model(inputs, logits)
+
+
+def source_pixels(source):
+    """uint8 model-input pixels of a whole source (a memmap view for single-shard packs)"""
+    if isinstance(source, list):
+        return np.stack([pipeline.preprocess_pixels(pipeline.decode_image(path)) for path in source])
+    return source.pixels(0, len(source))
+
+
+class _DistillBatches(tf.keras.utils.PyDataset):
+    """Shuffled (normalised pixels, soft targets) batches; pixels stay uint8 until a batch is drawn"""
+
+    def __init__(self, pixels, targets, batch_size, seed=0):
+        super().__init__()
+        self.pixels, self.targets, self.batch_size = pixels, targets, batch_size
+        self.rng = np.random.default_rng(seed)
+        self.order = self.rng.permutation(len(pixels))
+
+    def __len__(self):
+        return -(-len(self.pixels) // self.batch_size)
+
+    def __getitem__(self, index):
+        rows = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        return pipeline.normalize_pixels(self.pixels[rows]).astype(np.float32), self.targets[rows]
+
+    def on_epoch_end(self):
+        self.order = self.rng.permutation(len(self.pixels))
+
+
+def distill(teacher, pixels, n_classes, epochs=15, temperature=DISTILL_TEMPERATURE, batch_size=32, log=print):
+    """Train a student on the teacher's softened outputs for the given uint8 pixels; returns the student"""
+    targets = np.concatenate([
+        teacher.predict(pipeline.normalize_pixels(pixels[start:start + 256]), verbose=0)
+        for start in range(0, len(pixels), 256)
+    ])
+    student, logits_model = build_student(n_classes, pixels.shape[1:])
+    # Training sees softmax(logits / T); the saved student keeps the plain softmax
+    trainer = tf.keras.Model(logits_model.input,
+                             tf.keras.layers.Softmax()(tf.keras.layers.Rescaling(1.0 / temperature)(logits_model.output)))
+    trainer.compile(optimizer=tf.keras.optimizers.Adam(1e-3), loss='categorical_crossentropy')
+    history = trainer.fit(_DistillBatches(pixels, temperature_scale(targets, temperature), batch_size),
+                          epochs=epochs, verbose=0)
+    log(f"Distillation loss {history.history['loss'][0]:.4f} -> {history.history['loss'][-1]:.4f}")
+
+    student_labels = np.concatenate([
+        student.predict(pipeline.normalize_pixels(pixels[start:start + 256]), verbose=0).argmax(axis=1)
+        for start in range(0, len(pixels), 256)
+    ])
+    log(f"Student agrees with the full model on {np.mean(student_labels == targets.argmax(axis=1)):.1%} "
+        f"of the {len(pixels)} training images")
+    return student
+
+
+# --------------------------
+# Evaluation
+# --------------------------
+def _timed_predict(predict, batches):
+    start = time.perf_counter()
+    probabilities = np.concatenate([predict(batch) for batch in batches])
+    return probabilities, time.perf_counter() - start
+
+
+def evaluate_cascade(teacher, student, class_map, data_dir, thresholds, batch_size=32, limit=None):
+    """Throughput, escalation and agreement of the cascade at each threshold; returns a JSON-able dict"""
+    source, y_true = load_labelled_source(data_dir, list(class_map.classes), limit)
+    # Decoding is identical for every variant, so batches are preprocessed once and only inference is timed
+    batches = list(iter_batches(source, batch_size))
+    for model in (teacher, student):
+        model.predict(batches[0][:1], verbose=0)  # trace before timing
+        model.predict_on_batch(batches[0])
+
+    # The app calls model.predict, so that is the baseline; predict_on_batch shows how much of the
+    # cascade's gain is Keras per-call overhead rather than the smaller model
+    teacher_probs, teacher_seconds = _timed_predict(
+        lambda batch: teacher.predict(batch, batch_size=len(batch), verbose=0), batches)
+    _, teacher_on_batch_seconds = _timed_predict(teacher.predict_on_batch, batches)
+    student_probs, student_seconds = _timed_predict(student.predict_on_batch, batches)
+    teacher_pred = teacher_probs.argmax(axis=1)
+    count = len(teacher_probs)
+
+    def row(name, probabilities, seconds, escalated):
+        predicted = probabilities.argmax(axis=1)
+        return {
+            'variant': name,
+            'images_per_sec': count / seconds,
+            'speedup': teacher_seconds / seconds,
+            'escalated': escalated / count,
+            'agreement': float(np.mean(predicted == teacher_pred)),
+            'accuracy': float(np.mean(predicted == y_true)),
+            'malignant_recall': float(np.mean(predicted[y_true == class_map.malignant_index] == class_map.malignant_index))
+            if np.any(y_true == class_map.malignant_index) else None,
+        }
+
+    rows = [row('full model', teacher_probs, teacher_seconds, count),
+            row('full, on_batch', teacher_probs, teacher_on_batch_seconds, count),
+            row('student only', student_probs, student_seconds, 0)]
+    for threshold in thresholds:
+        cascade = CascadeModel(student, teacher, threshold)
+        probabilities, seconds = _timed_predict(
+            lambda batch: cascade.predict(batch, batch_size=len(batch), verbose=0), batches)
+        rows.append({**row(f"cascade @ {threshold:g}", probabilities, seconds, cascade.escalated),
+                     'threshold': threshold})
+    return {'data_dir': os.path.abspath(data_dir), 'images': count, 'batch_size': batch_size, 'results': rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distill and evaluate the student model of the inference cascade")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the full Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    commands = parser.add_subparsers(dest="command", required=True)
+    distill_parser = commands.add_parser("distill", help="Train a student on the full model's outputs")
+    distill_parser.add_argument("data_dir", help="Image folder (any layout of benign/malignant subfolders) or pack")
+    distill_parser.add_argument("--output", default=STUDENT_OUTPUT_PATH, help="Where to save the student")
+    distill_parser.add_argument("--epochs", type=int, default=15, help="Training epochs")
+    distill_parser.add_argument("--temperature", type=float, default=DISTILL_TEMPERATURE, help="Softening temperature")
+    distill_parser.add_argument("--limit", type=int, default=None, help="Only use this many images")
+    evaluate_parser = commands.add_parser("evaluate", help="Throughput vs agreement on a labelled folder")
+    evaluate_parser.add_argument("data_dir", help="Folder with benign/ and malignant/ subfolders, or a pack")
+    evaluate_parser.add_argument("--student", default=CASCADE_STUDENT_PATH or STUDENT_OUTPUT_PATH,
+                                 help="Path to the student model")
+    evaluate_parser.add_argument("--thresholds", default="0.8,0.9,0.95,0.99", help="Comma-separated thresholds")
+    evaluate_parser.add_argument("--batch-size", type=int, default=32, help="Images per predict call")
+    evaluate_parser.add_argument("--limit", type=int, default=None, help="Only use this many images")
+    evaluate_parser.add_argument("--output", default=None, help="Write results JSON here")
+    args = parser.parse_args(argv)
+
+    teacher = pipeline.load_model(args.model)
+    class_map = pipeline.load_class_map(args.encoder)
+    class_map.check_model(teacher)
+
+    if args.command == "distill":
+        source, _ = load_labelled_source(args.data_dir, list(class_map.classes), args.limit)
+        start = time.perf_counter()
+        student = distill(teacher, source_pixels(source), len(class_map), args.epochs, args.temperature,
+                          log=lambda message: print(message, file=sys.stderr))
+        student.save(args.output)
+        print(f"Student with {student.count_params():,} parameters (full model: {teacher.count_params():,}) "
+              f"trained in {time.perf_counter() - start:.0f}s -> {args.output}")
+        return
+
+    student = tf.keras.models.load_model(args.student)
+    thresholds = [float(t) for t in args.thresholds.split(",") if t.strip()]
+    report = evaluate_cascade(teacher, student, class_map, args.data_dir, thresholds, args.batch_size, args.limit)
+    print(f"{'variant':<18}{'img/s':>9}{'speedup':>9}{'escalated':>11}{'agreement':>11}{'accuracy':>10}"
+          f"{'malignant recall':>18}", file=sys.stderr)
+    for r in report['results']:
+        recall = f"{r['malignant_recall']:17.1%}" if r['malignant_recall'] is not None else f"{'-':>17}"
+        print(f"{r['variant']:<18}{r['images_per_sec']:9.1f}{r['speedup']:8.2f}x{r['escalated']:10.1%}"
+              f"{r['agreement']:10.1%}{r['accuracy']:10.1%} {recall}", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
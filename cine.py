@@ -0,0 +1,224 @@
+"""Cine loops and multi-frame ultrasound: streaming frame decode with batched inference.
+
+Usage:
+    python cine.py CLIP [CLIP ...] [--stride 5] [--window 32] [--output frames.json]
+
+Frames are decoded one at a time, every ``THYROID_CINE_STRIDE``-th frame is
+kept, and kept frames are reduced to the model's 128×128 uint8 input straight
+away. Up to ``THYROID_CINE_WINDOW`` of those wait for the next batched predict,
+so memory is one decoded frame plus one window of model inputs whatever the
+clip length. Frames rejected by the quality gate (probe lifted, blank frames
+at the start of a sweep) are dropped before inference, and at most
+``THYROID_CINE_MAX_FRAMES`` frames are scored per clip.
+
+Multi-frame GIF and TIFF are read with Pillow. Video clips (MP4, AVI, MOV, ...)
+need the optional ``opencv-python`` package; skipped frames are only grabbed,
+not colour-converted.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+import pipeline
+import quality_gate
+
+try:
+    import cv2  # type: ignore
+except ImportError:  # GIF and TIFF clips work without it
+    cv2 = None
+
+MULTI_FRAME_EXTENSIONS = ('.gif', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+FRAME_STRIDE = int(os.environ.get('THYROID_CINE_STRIDE', '5'))
+FRAME_WINDOW = int(os.environ.get('THYROID_CINE_WINDOW', '32'))
+MAX_SAMPLED_FRAMES = int(os.environ.get('THYROID_CINE_MAX_FRAMES', '600'))
+# How per-frame probabilities are combined into the clip result (see pipeline.AGGREGATE_METHODS)
+CLIP_AGGREGATE = os.environ.get('THYROID_CINE_AGGREGATE', 'mean')
+
+
+class ClipError(ValueError):
+    """Raised when a clip cannot be read or has no frame worth classifying"""
+
+
+def clip_extensions():
+    """Extensions accepted as clips in this environment"""
+    return MULTI_FRAME_EXTENSIONS + (VIDEO_EXTENSIONS if cv2 is not None else ())
+
+
+def is_video(name):
+    return name.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def is_clip(name, img=None):
+    """True for video files and for decoded images with more than one frame"""
+    return is_video(name) or (img is not None and getattr(img, 'n_frames', 1) > 1)
+
+
+# --------------------------
+# Streaming decode
+# --------------------------
+def _check_size(width, height, max_pixels):
+    if width * height > max_pixels:
+        raise pipeline.ImageTooLargeError(f"Clip frames are {width}×{height} pixels; the limit is {max_pixels:,} pixels")
+
+
+def _pil_frames(source, stride, max_pixels):
+    img = Image.open(source)
+    _check_size(*img.size, max_pixels)
+    for index in range(0, getattr(img, 'n_frames', 1), stride):
+        # GIF frames are deltas, so seeking decodes the skipped ones; TIFF pages are read directly
+        img.seek(index)
+        yield index, img
+
+
+def _video_frames(path, stride, max_pixels):
+    if cv2 is None:
+        raise ClipError("Video clips need the optional opencv-python package")
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ClipError("Video could not be opened")
+    try:
+        _check_size(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)), max_pixels)
+        index = 0
+        while capture.grab():
+            if index % stride == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield index, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            index += 1
+    finally:
+        capture.release()
+
+
+def iter_frames(source, name=None, stride=FRAME_STRIDE, max_pixels=pipeline.MAX_IMAGE_PIXELS):
+    """Yield (frame index, PIL frame) for every stride-th frame; a frame is only valid until the next one"""
+    name = name or (source if isinstance(source, str) else getattr(source, 'name', ''))
+    if hasattr(source, 'seek'):
+        source.seek(0)  # uploads may already have been read once
+    if not is_video(name):
+        yield from _pil_frames(source, stride, max_pixels)
+        return
+    if isinstance(source, str):
+        yield from _video_frames(source, stride, max_pixels)
+        return
+    # OpenCV only reads from files, so an upload is spooled to disk (not into memory)
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as f:
+        shutil.copyfileobj(source, f)
+        f.flush()
+        yield from _video_frames(f.name, stride, max_pixels)
+
+
+def read_frame(source, index, name=None):
+    """Decode one frame (e.g. the most suspicious one, for display)"""
+    for frame_index, frame in iter_frames(source, name, stride=max(1, index)):
+        if frame_index == index:
+            return frame.convert('RGB') if frame.mode not in ('RGB', 'RGBA') else frame.copy()
+    raise ClipError(f"Clip has no frame {index}")
+
+
+# --------------------------
+# Inference
+# --------------------------
+def classify_clip(model, source, name=None, stride=FRAME_STRIDE, window=FRAME_WINDOW,
+                  max_frames=MAX_SAMPLED_FRAMES, gate_mode=quality_gate.QUALITY_GATE_MODE):
+    """Stream a clip through the model one window of sampled frames at a time.
+
+    Returns {'frame_indices', 'probabilities' (raw, one row per scored frame),
+    'frames_seen' (up to the last sampled frame), 'rejected_frames', 'truncated', 'stride'}.
+    """
+    indices, probabilities = [], []
+    window_pixels, window_indices = [], []
+    rejected, frames_seen, truncated = 0, 0, False
+
+    def flush():
+        batch = pipeline.normalize_pixels(np.stack(window_pixels))
+        probabilities.append(np.asarray(model.predict(batch, batch_size=len(batch), verbose=0)))
+        indices.extend(window_indices)
+        window_pixels.clear()
+        window_indices.clear()
+
+    for index, frame in iter_frames(source, name, stride):
+        frames_seen = index + 1
+        if len(indices) + len(window_pixels) >= max_frames:
+            truncated = True
+            break
+        pixels = pipeline.preprocess_pixels(frame)
+        if quality_gate.assess(pixels, frame.size, gate_mode)['verdict'] == 'reject':
+            rejected += 1
+            continue
+        window_pixels.append(pixels)
+        window_indices.append(index)
+        if len(window_pixels) >= window:
+            flush()
+    if window_pixels:
+        flush()
+    if not indices:
+        raise ClipError(f"None of the {rejected} sampled frames passed the quality gate" if rejected
+                        else "Clip has no frames")
+    return {
+        'frame_indices': np.array(indices),
+        'probabilities': np.concatenate(probabilities),
+        'frames_seen': frames_seen,
+        'rejected_frames': rejected,
+        'truncated': truncated,
+        'stride': stride,
+    }
+
+
+def clip_prediction(clip, method=CLIP_AGGREGATE, malignant_index=1):
+    """Clip-level probability row from the per-frame rows"""
+    return pipeline.aggregate_predictions(clip['probabilities'], method, malignant_index)
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify cine loops and multi-frame images frame by frame")
+    parser.add_argument("clips", nargs="+", help="GIF/TIFF stacks or video files")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--stride", type=int, default=FRAME_STRIDE, help="Score every N-th frame")
+    parser.add_argument("--window", type=int, default=FRAME_WINDOW, help="Frames per predict call")
+    parser.add_argument("--aggregate", choices=pipeline.AGGREGATE_METHODS, default=CLIP_AGGREGATE,
+                        help="How frame results are combined")
+    parser.add_argument("--output", default=None, help="Write per-frame results JSON here")
+    args = parser.parse_args(argv)
+
+    model = pipeline.load_model(args.model)
+    class_map = pipeline.load_class_map(args.encoder)
+    class_map.check_model(model)
+    results = []
+    for path in args.clips:
+        try:
+            clip = classify_clip(model, path, stride=args.stride, window=args.window)
+        except (ClipError, OSError, pipeline.ImageTooLargeError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        row = clip_prediction(clip, args.aggregate, class_map.malignant_index)
+        print(f"{path}: {class_map.label(row).upper()} ({float(row.max()):.1%}) from {len(clip['frame_indices'])} "
+              f"of {clip['frames_seen']} frames, {clip['rejected_frames']} rejected", file=sys.stderr)
+        results.append({
+            'clip': path,
+            'prediction': str(class_map.label(row)),
+            'probabilities': row.tolist(),
+            'frames': [{'frame': int(i), 'probabilities': p.tolist()}
+                       for i, p in zip(clip['frame_indices'], clip['probabilities'])],
+            'frames_seen': clip['frames_seen'],
+            'rejected_frames': clip['rejected_frames'],
+            'truncated': clip['truncated'],
+        })
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
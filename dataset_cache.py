@@ -0,0 +1,187 @@
+"""Memory-mapped cache of preprocessed images for repeated evaluation runs.
+
+Usage:
+    python dataset_cache.py DATA_DIR PACK_DIR [--shard-size 4096] [--limit N]
+
+Packing decodes every image under DATA_DIR/<class>/ once and stores the
+resized 128×128×3 uint8 pixels in ``.npy`` shards, next to the labels, the
+SHA-256 of each source file and an ``index.json``. ``PackedDataset`` opens the
+shards with ``mmap_mode='r'``: batches are zero-copy slices of the page cache
+and are normalised on the fly, so re-evaluating a retrained model is bound by
+inference rather than by JPEG/PNG decoding.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pipeline
+
+PACK_FORMAT_VERSION = 1
+INDEX_FILE = 'index.json'
+LABELS_FILE = 'labels.npy'
+SHARD_SIZE = int(os.environ.get('THYROID_PACK_SHARD_SIZE', '4096'))
+
+
+# --------------------------
+# Packing
+# --------------------------
+def pack_dataset(data_dir, pack_dir, classes, shard_size=SHARD_SIZE, limit=None):
+    """Decode and preprocess a labelled folder into memory-mapped shards; returns the index dict"""
+    paths, labels = pipeline.collect_labelled_images(data_dir, classes, limit)
+    if not paths:
+        raise SystemExit(f"No labelled images found under {data_dir}")
+    os.makedirs(pack_dir, exist_ok=True)
+    # Re-packing in place: drop the old index first, so an interrupted run never leaves it
+    # describing the new, partly written shards
+    if os.path.exists(os.path.join(pack_dir, INDEX_FILE)):
+        os.remove(os.path.join(pack_dir, INDEX_FILE))
+
+    shards, kept_paths, kept_labels, hashes = [], [], [], []
+    shard, fill = None, 0
+
+    def close_shard():
+        if shard is not None and fill:
+            shard.flush()
+            shards.append({'file': shard_name, 'count': fill})
+
+    for path, label in zip(paths, labels):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            pixels = pipeline.preprocess_pixels(pipeline.decode_image(io.BytesIO(data)))
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+
+        if shard is None or fill == shard_size:
+            close_shard()
+            remaining = len(paths) - len(kept_paths)
+            shard_name = f"images-{len(shards):05d}.npy"
+            shard = np.lib.format.open_memmap(
+                os.path.join(pack_dir, shard_name), mode='w+', dtype=np.uint8,
+                shape=(min(shard_size, remaining), *pipeline.IMAGE_SIZE, 3)
+            )
+            fill = 0
+        shard[fill] = pixels
+        fill += 1
+        kept_paths.append(os.path.relpath(path, data_dir))
+        kept_labels.append(int(label))
+        hashes.append(pipeline.image_hash(data))
+    close_shard()
+    # Shards of an earlier, larger pack in the same folder
+    kept_shards = {s['file'] for s in shards}
+    for name in os.listdir(pack_dir):
+        if name.startswith('images-') and name.endswith('.npy') and name not in kept_shards:
+            os.remove(os.path.join(pack_dir, name))
+
+    # Skipped files leave unused rows at the end of the last shard; the index only counts filled rows
+    np.save(os.path.join(pack_dir, LABELS_FILE), np.array(kept_labels, dtype=np.int64))
+    index = {
+        'format_version': PACK_FORMAT_VERSION,
+        'image_size': list(pipeline.IMAGE_SIZE),
+        'classes': [str(c) for c in classes],
+        'source_dir': os.path.abspath(data_dir),
+        'created_at': time.time(),
+        'count': len(kept_paths),
+        'shards': shards,
+        'paths': kept_paths,
+        'hashes': hashes,
+    }
+    # Written last, so an interrupted pack is never mistaken for a complete one
+    with open(os.path.join(pack_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+# --------------------------
+# Reading
+# --------------------------
+def is_pack_dir(path):
+    """True if path holds a packed dataset"""
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class PackedDataset:
+    """Read-only view over a packed dataset; pixels stay memory-mapped"""
+
+    def __init__(self, pack_dir, limit=None):
+        with open(os.path.join(pack_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index.get('format_version') != PACK_FORMAT_VERSION:
+            raise ValueError(f"Unsupported pack format: {index.get('format_version')}")
+        if tuple(index['image_size']) != tuple(pipeline.IMAGE_SIZE):
+            raise ValueError(f"Pack was built for {index['image_size']} inputs, the model expects {pipeline.IMAGE_SIZE}")
+
+        self.pack_dir = pack_dir
+        self.classes = index['classes']
+        self.paths, self.hashes = index['paths'], index['hashes']
+        self.labels = np.load(os.path.join(pack_dir, LABELS_FILE))
+        # Packs are stored class by class: a limit takes a seeded random subset (in pack order), like
+        # pipeline.collect_labelled_images, so the class mix is kept
+        self._rows = None
+        if limit is not None and limit < index['count']:
+            self._rows = np.sort(np.random.default_rng(0).permutation(index['count'])[:limit])
+            self.paths = [self.paths[i] for i in self._rows]
+            self.hashes = [self.hashes[i] for i in self._rows]
+            self.labels = self.labels[self._rows]
+        self.count = len(self.paths)
+        self._shards = [np.load(os.path.join(pack_dir, s['file']), mmap_mode='r')[:s['count']]
+                        for s in index['shards']]
+        self._offsets = np.cumsum([0] + [s['count'] for s in index['shards']])
+
+    def __len__(self):
+        return self.count
+
+    def pixels(self, start, stop):
+        """uint8 pixels for rows [start, stop); a zero-copy view unless the range spans two shards"""
+        stop = min(stop, self.count)
+        if self._rows is not None:
+            return self._take(self._rows[start:stop])
+        first = int(np.searchsorted(self._offsets, start, side='right')) - 1
+        local = start - self._offsets[first]
+        if stop - self._offsets[first] <= len(self._shards[first]):
+            return self._shards[first][local:local + (stop - start)]
+        parts = []
+        while start < stop:
+            shard = self._shards[first]
+            take = min(stop - start, len(shard) - local)
+            parts.append(shard[local:local + take])
+            start += take
+            first, local = first + 1, 0
+        return np.concatenate(parts, axis=0)
+
+    def _take(self, rows):
+        """uint8 pixels for sorted pack rows of a limited view (a copy)"""
+        shard_of = np.searchsorted(self._offsets, rows, side='right') - 1
+        return np.concatenate([self._shards[s][rows[shard_of == s] - self._offsets[s]] for s in np.unique(shard_of)],
+                              axis=0)
+
+    def batches(self, batch_size):
+        """Yield (start, normalised float batch) over the whole dataset"""
+        for start in range(0, self.count, batch_size):
+            yield start, pipeline.normalize_pixels(self.pixels(start, start + batch_size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack a labelled image folder into memory-mapped shards")
+    parser.add_argument("data_dir", help="Folder with benign/ and malignant/ subfolders")
+    parser.add_argument("pack_dir", help="Output folder for the shards and index")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Images per shard file")
+    parser.add_argument("--limit", type=int, default=None, help="Only pack this many images")
+    args = parser.parse_args(argv)
+
+    classes = list(pipeline.load_class_map(args.encoder).classes)
+    start = time.perf_counter()
+    index = pack_dataset(args.data_dir, args.pack_dir, classes, args.shard_size, args.limit)
+    print(f"Packed {index['count']} images into {len(index['shards'])} shard(s) in "
+          f"{time.perf_counter() - start:.1f}s -> {args.pack_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+"""Similar-case retrieval over the classifier's penultimate-layer embeddings.
+
+Usage:
+    python embedding_index.py add SOURCE [--batch-size 64]
+    python embedding_index.py build-ivf [--lists N]
+    python embedding_index.py search IMAGE [-k 5]
+
+Every analysed image can be added with the embedding that ``pipeline.embedding_model``
+returns from the same forward pass as its probabilities. Vectors are
+L2-normalised and appended to a raw float16 file (``vectors.f16``), so the
+index is one memory-mapped array: a 128-wide embedding costs 256 bytes per
+study. Row metadata (image hash, predicted label, malignant probability,
+source) lives in a small SQLite file next to it. Each model version gets its
+own subdirectory, because embeddings of different models are not comparable.
+
+Search is cosine similarity. Small indexes are scanned exactly in vectorised
+chunks; once ``build-ivf`` has clustered the vectors (spherical k-means in
+NumPy), queries only scan the ``THYROID_IVF_PROBES`` closest lists plus the
+rows added since the last build, which keeps them in the millisecond range at
+hundreds of thousands of studies.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+import pipeline
+from result_store import connect
+
+EMBEDDING_INDEX_DIR = os.environ.get('THYROID_EMBEDDING_INDEX', 'embedding_index')
+# Below this many rows an exact scan is as fast as probing the IVF lists
+IVF_MIN_ROWS = int(os.environ.get('THYROID_IVF_MIN_ROWS', '20000'))
+IVF_PROBES = int(os.environ.get('THYROID_IVF_PROBES', '8'))
+SIMILAR_CASES_K = int(os.environ.get('THYROID_SIMILAR_CASES', '5'))
+VECTORS_FILE = 'vectors.f16'
+DB_FILE = 'index.db'
+IVF_FILE = 'ivf.json'
+SCAN_CHUNK_ROWS = 65536
+VECTOR_DTYPE = np.float16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+    row INTEGER PRIMARY KEY,
+    image_hash TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    malignant REAL NOT NULL,
+    source TEXT,
+    created_at REAL NOT NULL
+);
+"""
+ENTRY_COLUMNS = ('row', 'image_hash', 'label', 'malignant', 'source', 'created_at')
+
+
+def normalize_rows(vectors):
+    """L2-normalise each row (all-zero rows stay zero)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, rows, k):
+    """(scores, rows) of the k best candidates, best first"""
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, rows = scores[keep], rows[keep]
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], rows[order]
+
+
+class EmbeddingIndex:
+    """Append-only float16 embedding store with exact and IVF nearest-neighbour search"""
+
+    def __init__(self, index_dir=EMBEDDING_INDEX_DIR, model_fingerprint=None):
+        self.path = os.path.join(index_dir, model_fingerprint[:16]) if model_fingerprint else index_dir
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, VECTORS_FILE)
+        # sqlite3 connections must stay on the thread that created them
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._mapped = (0, None)
+        self._ivf = (None, None)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(os.path.join(self.path, DB_FILE))
+        return conn
+
+    @property
+    def dim(self):
+        row = self._conn().execute("SELECT value FROM settings WHERE key = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def __len__(self):
+        return self._conn().execute("SELECT COALESCE(MAX(row) + 1, 0) FROM entries").fetchone()[0]
+
+    # --------------------------
+    # Writing
+    # --------------------------
+    def missing(self, image_hashes):
+        """The subset of image_hashes that has no stored embedding"""
+        image_hashes = list(image_hashes)
+        present = set()
+        # Chunked to stay under SQLite's bound-parameter limit
+        for start in range(0, len(image_hashes), 500):
+            chunk = image_hashes[start:start + 500]
+            present.update(row[0] for row in self._conn().execute(
+                f"SELECT image_hash FROM entries WHERE image_hash IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return set(image_hashes) - present
+
+    def add(self, image_hashes, embeddings, labels, malignant, sources=None):
+        """Append embeddings for images not indexed yet; returns how many rows were added"""
+        embeddings = normalize_rows(embeddings)
+        sources = sources if sources is not None else [None] * len(image_hashes)
+        conn = self._conn()
+        # BEGIN IMMEDIATE serialises writers across processes; the vector file follows the table
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            dim = self.dim
+            if dim is None:
+                dim = embeddings.shape[1]
+                conn.execute("INSERT INTO settings (key, value) VALUES ('dim', ?)", (str(dim),))
+            elif dim != embeddings.shape[1]:
+                raise ValueError(f"Index holds {dim}-wide embeddings, got {embeddings.shape[1]}")
+
+            present = set(image_hashes) - self.missing(image_hashes)
+            new, seen = [], set()
+            for i, image_hash in enumerate(image_hashes):
+                if image_hash not in present and image_hash not in seen:
+                    seen.add(image_hash)
+                    new.append(i)
+            if not new:
+                conn.execute("COMMIT")
+                return 0
+
+            count = len(self)
+            row_bytes = dim * np.dtype(VECTOR_DTYPE).itemsize
+            with open(self.vectors_path, 'ab+') as f:
+                # Drops vectors left behind by a writer that died before committing its rows
+                f.truncate(count * row_bytes)
+                f.write(embeddings[new].astype(VECTOR_DTYPE).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO entries (row, image_hash, label, malignant, source, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(count + j, image_hashes[i], str(labels[i]), float(malignant[i]), sources[i], now)
+                 for j, i in enumerate(new)]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(new)
+
+    # --------------------------
+    # Reading
+    # --------------------------
+    def vectors(self):
+        """All committed vectors as a read-only (rows, dim) float16 memmap"""
+        count = len(self)
+        with self._lock:
+            if self._mapped[0] != count:
+                mapped = None
+                if count:
+                    mapped = np.memmap(self.vectors_path, dtype=VECTOR_DTYPE, mode='r', shape=(count, self.dim))
+                self._mapped = (count, mapped)
+            return self._mapped[1]
+
+    def vector_for(self, image_hash):
+        """Stored (normalised) embedding of one image, or None"""
+        row = self._conn().execute("SELECT row FROM entries WHERE image_hash = ?", (image_hash,)).fetchone()
+        if row is None:
+            return None
+        return np.asarray(self.vectors()[row[0]], dtype=np.float32)
+
+    def entries(self, rows):
+        """{row: metadata dict} for the given row numbers"""
+        rows = [int(r) for r in rows]
+        if not rows:
+            return {}
+        result = self._conn().execute(
+            f"SELECT {', '.join(ENTRY_COLUMNS)} FROM entries WHERE row IN ({','.join('?' * len(rows))})", rows
+        ).fetchall()
+        return {r[0]: dict(zip(ENTRY_COLUMNS, r)) for r in result}
+
+    def _load_ivf(self):
+        """The current IVF lists (memory-mapped), or None before the first build"""
+        try:
+            with open(os.path.join(self.path, IVF_FILE)) as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if self._ivf[0] != info['dir']:
+                base = os.path.join(self.path, info['dir'])
+                ivf = {name: np.load(os.path.join(base, f"{name}.npy"), mmap_mode='r')
+                       for name in ('centroids', 'vectors', 'rows', 'offsets')}
+                ivf['offsets'] = np.asarray(ivf['offsets'])
+                ivf['covered'] = info['rows']
+                self._ivf = (info['dir'], ivf)
+            return self._ivf[1]
+
+    def _scan(self, vectors, query, first_row, k):
+        """Exact top-k over a contiguous block of rows, in chunks"""
+        best_scores, best_rows = np.empty(0, np.float32), np.empty(0, np.int64)
+        for start in range(0, len(vectors), SCAN_CHUNK_ROWS):
+            # float16 has no BLAS kernels; widening a chunk and using sgemv is far faster
+            scores = np.asarray(vectors[start:start + SCAN_CHUNK_ROWS], dtype=np.float32) @ query
+            rows = np.arange(first_row + start, first_row + start + len(scores))
+            best_scores, best_rows = _top_k(np.concatenate([best_scores, scores]),
+                                            np.concatenate([best_rows, rows]), k)
+        return best_scores, best_rows
+
+    def search(self, query, k=SIMILAR_CASES_K, exclude=(), probes=IVF_PROBES):
+        """Top-k most similar indexed images as metadata dicts with a 'similarity' in [-1, 1]"""
+        vectors = self.vectors()
+        if vectors is None:
+            return []
+        query = normalize_rows(query)
+        exclude = set(exclude)
+        wanted = k + len(exclude)
+
+        ivf = self._load_ivf() if len(vectors) >= IVF_MIN_ROWS else None
+        if ivf is None:
+            scores, rows = self._scan(vectors, query, 0, wanted)
+        else:
+            centroid_scores = ivf['centroids'] @ query
+            probe = np.argsort(-centroid_scores)[:probes]
+            parts_scores, parts_rows = [], []
+            for cluster in probe:
+                start, stop = ivf['offsets'][cluster], ivf['offsets'][cluster + 1]
+                parts_scores.append(np.asarray(ivf['vectors'][start:stop], dtype=np.float32) @ query)
+                parts_rows.append(np.asarray(ivf['rows'][start:stop]))
+            # Rows appended after the last build are not in any list yet
+            tail_scores, tail_rows = self._scan(vectors[ivf['covered']:], query, ivf['covered'], wanted)
+            scores, rows = _top_k(np.concatenate(parts_scores + [tail_scores]),
+                                  np.concatenate(parts_rows + [tail_rows]), wanted)
+
+        metadata = self.entries(rows)
+        results = []
+        for score, row in zip(scores, rows):
+            entry = metadata.get(int(row))
+            if entry is None or entry['image_hash'] in exclude:
+                continue
+            results.append({**entry, 'similarity': float(score)})
+        return results[:k]
+
+    # --------------------------
+    # IVF build
+    # --------------------------
+    def build_ivf(self, lists=None, iterations=10, sample_size=65536, log=print):
+        """Cluster the vectors into inverted lists (spherical k-means); returns the list count"""
+        vectors = self.vectors()
+        if vectors is None:
+            raise ValueError("The index is empty")
+        count = len(vectors)
+        lists = min(count, lists or max(1, int(np.sqrt(count))))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, min(count, sample_size), replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for iteration in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            filled = np.bincount(assignment, minlength=lists) > 0
+            # Empty lists keep their previous centroid
+            centroids[filled] = normalize_rows(sums[filled])
+            log(f"k-means iteration {iteration + 1}/{iterations}")
+
+        assignment = np.concatenate([
+            np.argmax(np.asarray(vectors[start:start + SCAN_CHUNK_ROWS], dtype=np.float32) @ centroids.T, axis=1)
+            for start in range(0, count, SCAN_CHUNK_ROWS)
+        ])
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.searchsorted(assignment[order], np.arange(lists + 1))
+
+        # Each build gets a fresh directory; ivf.json is switched last, so readers never see a half-built index
+        build_dir = f"ivf-{time.time_ns()}"
+        base = os.path.join(self.path, build_dir)
+        os.makedirs(base)
+        grouped = np.lib.format.open_memmap(os.path.join(base, 'vectors.npy'), mode='w+',
+                                            dtype=VECTOR_DTYPE, shape=(count, vectors.shape[1]))
+        for start in range(0, count, SCAN_CHUNK_ROWS):
+            grouped[start:start + SCAN_CHUNK_ROWS] = vectors[order[start:start + SCAN_CHUNK_ROWS]]
+        grouped.flush()
+        del grouped
+        np.save(os.path.join(base, 'centroids.npy'), centroids.astype(np.float32))
+        np.save(os.path.join(base, 'rows.npy'), order.astype(np.int64))
+        np.save(os.path.join(base, 'offsets.npy'), offsets.astype(np.int64))
+        tmp_path = os.path.join(self.path, IVF_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'dir': build_dir, 'rows': count, 'lists': lists, 'built_at': time.time()}, f)
+        os.replace(tmp_path, os.path.join(self.path, IVF_FILE))
+
+        # Open memmaps keep the old files alive until their readers drop them
+        for name in os.listdir(self.path):
+            if name.startswith('ivf-') and name != build_dir:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        return lists
+
+
+# --------------------------
+# Command line
+# --------------------------
+def _iter_source(source, batch_size):
+    """Yield (hashes, names, normalised batch) from a packed dataset or an image folder"""
+    from dataset_cache import PackedDataset, is_pack_dir
+    if is_pack_dir(source):
+        dataset = PackedDataset(source)
+        for start, batch in dataset.batches(batch_size):
+            yield dataset.hashes[start:start + len(batch)], dataset.paths[start:start + len(batch)], batch
+        return
+
+    from batch_classify import scan_archive
+    paths = sorted(path for path, _, _ in scan_archive(source))
+    for start in range(0, len(paths), batch_size):
+        hashes, names, images = [], [], []
+        for path in paths[start:start + batch_size]:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                images.append(pipeline.decode_image(path))
+            except Exception as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+                continue
+            hashes.append(pipeline.image_hash(data))
+            names.append(os.path.relpath(path, source))
+        if images:
+            yield hashes, names, pipeline.preprocess_batch(images)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain and query the similar-case embedding index")
+    parser.add_argument("--index-dir", default=EMBEDDING_INDEX_DIR, help="Root folder of the embedding index")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_parser = commands.add_parser("add", help="Index every image of a folder or packed dataset")
+    add_parser.add_argument("source", help="Image folder (scanned recursively) or dataset_cache.py pack")
+    add_parser.add_argument("--batch-size", type=int, default=64, help="Images per predict call")
+    ivf_parser = commands.add_parser("build-ivf", help="(Re)build the IVF lists used by large indexes")
+    ivf_parser.add_argument("--lists", type=int, default=None, help="Number of lists (default: sqrt(rows))")
+    ivf_parser.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+    search_parser = commands.add_parser("search", help="Print the nearest indexed images for one image")
+    search_parser.add_argument("image", help="Query image")
+    search_parser.add_argument("-k", type=int, default=SIMILAR_CASES_K, help="Number of results")
+    args = parser.parse_args(argv)
+
+    # Embeddings come from the full model on whole frames, as in the app without ROI inference
+    index = EmbeddingIndex(args.index_dir, pipeline.serving_fingerprint(args.model, cascade=False, roi_mode='off'))
+    if args.command == "build-ivf":
+        start = time.perf_counter()
+        lists = index.build_ivf(args.lists, args.iterations, log=lambda message: print(message, file=sys.stderr))
+        print(f"Built {lists} lists over {len(index)} vectors in {time.perf_counter() - start:.1f}s")
+        return
+
+    model = pipeline.embedding_model(pipeline.load_model(args.model))
+    class_map = pipeline.load_class_map(args.encoder)
+    if args.command == "add":
+        added = 0
+        for hashes, names, batch in _iter_source(args.source, args.batch_size):
+            predictions, embeddings = model.predict(batch, batch_size=len(batch), verbose=0)
+            added += index.add(hashes, embeddings, class_map.labels(predictions),
+                               class_map.malignant(predictions), names)
+            print(f"{added} added, {len(index)} indexed", file=sys.stderr)
+        return
+
+    with open(args.image, 'rb') as f:
+        query_hash = pipeline.image_hash(f.read())
+    predictions, embeddings = model.predict(pipeline.preprocess_image(pipeline.decode_image(args.image)), verbose=0)
+    start = time.perf_counter()
+    results = index.search(embeddings[0], args.k, exclude={query_hash})
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f"{class_map.label(predictions[0])} ({float(class_map.malignant(predictions[0])) * 100:.1f}% malignant); "
+          f"{len(results)} similar cases in {elapsed_ms:.1f} ms:")
+    for result in results:
+        print(f"  {result['similarity']:.3f}  {result['label']:<10} {result['malignant'] * 100:5.1f}%  "
+              f"{result['source'] or result['image_hash'][:12]}")
+
+
+if __name__ == "__main__":
+    main()
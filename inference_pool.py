@@ -0,0 +1,203 @@
+"""Process-per-core inference workers with shared-memory input tensors.
+
+Streamlit runs every session in one interpreter, so concurrent model.predict
+calls and PDF builds contend for the same GIL and thread pools. This pool runs
+N worker processes that each own one model instance. Every worker has a
+preallocated ``multiprocessing.shared_memory`` slot: the caller copies a
+preprocessed batch straight into it and sends only a tiny (rows, shape) message
+over a pipe; probabilities come back over the same pipe.
+
+``predict()`` mirrors ``model.predict``, is thread-safe and blocks only until a worker is free, so calls
+from several Streamlit sessions (or CLI threads) run on separate cores. A worker that dies is replaced in
+the background and its chunk is retried once on another worker.
+"""
+import atexit
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import increment
+from pipeline import IMAGE_SIZE, MODEL_PATH
+from report_jobs import script_main_hidden
+
+INFERENCE_WORKERS = int(os.environ.get('THYROID_INFERENCE_WORKERS', '0'))
+# Largest batch one worker slot can hold; bigger batches are split across calls
+SLOT_BATCH_SIZE = int(os.environ.get('THYROID_INFERENCE_SLOT_BATCH', '64'))
+INPUT_SHAPE = (*IMAGE_SIZE, 3)
+INPUT_DTYPE = np.float32
+
+
+def _worker_main(model_path, shm_name, slot_batch, intra_op_threads, conn):
+    """Worker process: load the model once, then serve batches from the shared slot"""
+    try:
+        import tensorflow as tf  # type: ignore
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        from pipeline import load_model
+        model = load_model(model_path)
+        shm = shared_memory.SharedMemory(name=shm_name)
+        slot = np.ndarray((slot_batch, *INPUT_SHAPE), dtype=INPUT_DTYPE, buffer=shm.buf)
+        # Trace the predict graph before reporting ready
+        model.predict(slot[:1], verbose=0)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ready', None))
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        rows = message
+        try:
+            predictions = model.predict(slot[:rows], batch_size=rows, verbose=0)
+            conn.send(('ok', predictions))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    del slot
+    shm.close()
+
+
+class _Worker:
+    def __init__(self, context, model_path, slot_batch, intra_op_threads):
+        nbytes = slot_batch * int(np.prod(INPUT_SHAPE)) * np.dtype(INPUT_DTYPE).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.slot = np.ndarray((slot_batch, *INPUT_SHAPE), dtype=INPUT_DTYPE, buffer=self.shm.buf)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(model_path, self.shm.name, slot_batch, intra_op_threads, child_conn),
+            daemon=True
+        )
+        self.process.start()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.slot
+        self.shm.close()
+        self.shm.unlink()
+
+
+class InferencePool:
+    """N model-owning worker processes fed through shared memory"""
+
+    def __init__(self, workers=INFERENCE_WORKERS, model_path=MODEL_PATH, slot_batch=SLOT_BATCH_SIZE):
+        self.workers = max(1, workers)
+        self.slot_batch = slot_batch
+        self.model_path = model_path
+        # Split the cores between workers instead of letting every TF runtime grab all of them
+        self._intra_op_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self._context = multiprocessing.get_context('spawn')
+        with script_main_hidden():
+            self._workers = [self._spawn() for _ in range(self.workers)]
+        self._idle = queue.Queue()
+        self._closed = False
+        self._respawning = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+        # Fail fast (e.g. missing model file) instead of on the first request
+        for worker in self._workers:
+            status, detail = worker.conn.recv()
+            if status != 'ready':
+                self.close()
+                raise RuntimeError(f"Inference worker failed to start:\n{detail}")
+            self._idle.put(worker)
+
+    def _spawn(self):
+        return _Worker(self._context, self.model_path, self.slot_batch, self._intra_op_threads)
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        """Run a preprocessed (N, 128, 128, 3) batch and return (N, classes) probabilities.
+
+        Mirrors ``model.predict`` so the pool can stand in for a Keras model;
+        ``batch_size`` and ``verbose`` are accepted for compatibility and ignored.
+        """
+        batch = np.asarray(batch)
+        if len(batch) <= self.slot_batch:
+            return self._predict_chunk(batch)
+        return np.concatenate([self._predict_chunk(batch[i:i + self.slot_batch])
+                               for i in range(0, len(batch), self.slot_batch)], axis=0)
+
+    def _predict_chunk(self, batch, retry=True):
+        worker = self._idle.get()
+        if worker is None:
+            # Pass the wake-up on to the next waiting caller
+            self._idle.put(None)
+            raise RuntimeError("Inference pool has no running workers")
+        try:
+            rows = len(batch)
+            # The only copy of the input: straight into the worker's shared slot (cast to float32)
+            worker.slot[:rows] = batch
+            worker.conn.send(rows)
+            status, payload = worker.conn.recv()
+        except (EOFError, BrokenPipeError, OSError) as e:
+            # Restart it off this caller's thread; the chunk goes to the next idle worker (or the replacement)
+            threading.Thread(target=self._replace, args=(worker,), name='inference-respawn', daemon=True).start()
+            if retry:
+                return self._predict_chunk(batch, retry=False)
+            raise RuntimeError(f"Inference worker {worker.process.pid} died") from e
+        self._idle.put(worker)
+        if status != 'ok':
+            raise RuntimeError(f"Inference worker failed:\n{payload}")
+        return payload
+
+    def _replace(self, dead):
+        """Swap a worker that died (OOM, kill) for a fresh one; the pool shrinks if it cannot start"""
+        with self._lock:
+            if self._closed:
+                return  # close() has already stopped it
+            # Taken out of the pool first so close() does not stop it a second time
+            self._workers.remove(dead)
+            self._respawning += 1
+        print(f"Inference worker {dead.process.pid} died; starting a replacement", file=sys.stderr)
+        increment('inference_worker_restarts')
+        dead.close()
+        worker = None
+        try:
+            with script_main_hidden():
+                worker = self._spawn()
+            status, detail = worker.conn.recv()
+            if status != 'ready':
+                raise RuntimeError(detail.strip().splitlines()[-1])
+        except Exception as e:
+            print(f"Replacement inference worker failed to start: {e!r}", file=sys.stderr)
+            if worker is not None:
+                worker.close()
+            worker = None
+        with self._lock:
+            self._respawning -= 1
+            if worker is not None and not self._closed:
+                self._workers.append(worker)
+                self._idle.put(worker)
+                return
+            empty = not self._workers and not self._respawning
+        if worker is not None:
+            worker.close()  # The pool was closed while it started
+        if empty:
+            # Wake callers blocked on the idle queue instead of leaving them waiting forever
+            self._idle.put(None)
+
+    def close(self):
+        """Stop all workers and release their shared memory"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers)
+        for worker in workers:
+            worker.close()
+        # Later predict() calls fail instead of waiting for a worker
+        self._idle.put(None)
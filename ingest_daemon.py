@@ -0,0 +1,464 @@
+"""Unattended ingestion of images exported to a drop folder.
+
+Usage:
+    python ingest_daemon.py DROP_DIR [--reports] [--poll]
+
+Ultrasound machines write into DROP_DIR; this daemon picks up every new file,
+decodes it off the event loop, classifies it in micro-batches and writes the
+result without anyone in the Streamlit UI:
+
+* the prediction goes to the shared prediction store (so the app and the
+  history page see it),
+* a ``<name>.json`` result and the source file are moved to ``processed/``
+  (as ``<stem>-1<ext>`` etc. when an earlier drop already used the name),
+* with ``--reports`` a PDF is queued on the background report workers.
+
+New files are detected with inotify (via the optional ``watchdog`` package) or by
+polling. A file is only read once its size and mtime have been stable for
+``THYROID_INGEST_SETTLE_SECONDS``, so half-written exports are not picked up.
+Failures are retried with exponential back-off; files that still cannot be
+decoded, and images rejected by the quality gate, are moved to ``dead_letter/``
+with an ``.error.txt`` next to them.
+DICOM (``.dcm``) files are accepted when ``pydicom`` is installed.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import time
+import traceback
+from datetime import date
+
+import numpy as np
+from PIL import Image
+
+import pipeline
+import quality_gate
+from calibration import CALIBRATION_PATH, load_calibration
+from metrics import increment, observe, start_metrics_server
+from report_pdf import get_confidence_level, REPORT_DIR
+from result_store import ResultStore, RESULT_STORE_PATH
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # polling fallback
+    Observer = None
+
+try:
+    import pydicom  # type: ignore
+except ImportError:
+    pydicom = None
+
+# --------------------------
+# Configuration (environment overrides)
+# --------------------------
+DROP_DIR = os.environ.get('THYROID_DROP_DIR', 'drop')
+POLL_SECONDS = float(os.environ.get('THYROID_INGEST_POLL_SECONDS', '2'))
+SETTLE_SECONDS = float(os.environ.get('THYROID_INGEST_SETTLE_SECONDS', '1'))
+DECODE_CONCURRENCY = int(os.environ.get('THYROID_INGEST_CONCURRENCY', '4'))
+MICRO_BATCH_SIZE = int(os.environ.get('THYROID_INGEST_BATCH', '16'))
+MICRO_BATCH_WAIT_MS = float(os.environ.get('THYROID_INGEST_BATCH_WAIT_MS', '200'))
+MAX_ATTEMPTS = int(os.environ.get('THYROID_INGEST_MAX_ATTEMPTS', '4'))
+BACKOFF_SECONDS = float(os.environ.get('THYROID_INGEST_BACKOFF_SECONDS', '0.5'))
+
+PROCESSED_SUBDIR = 'processed'
+DEAD_LETTER_SUBDIR = 'dead_letter'
+DICOM_EXTENSIONS = ('.dcm',)
+
+log = logging.getLogger('ingest')
+
+
+# --------------------------
+# Decoding
+# --------------------------
+def ingest_extensions():
+    return pipeline.IMAGE_EXTENSIONS + (DICOM_EXTENSIONS if pydicom is not None else ())
+
+
+def _decode_dicom(data):
+    """First frame of a DICOM file as an 8-bit PIL image, plus the patient/study tags"""
+    dataset = pydicom.dcmread(io.BytesIO(data))
+    pixels = dataset.pixel_array
+    if pixels.ndim == 4 or (pixels.ndim == 3 and pixels.shape[-1] not in (3, 4)):
+        pixels = pixels[0]  # Cine loop: first frame
+    pixels = pixels.astype(np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    pixels = ((pixels - low) / (high - low or 1.0) * 255).astype(np.uint8)
+    tags = {
+        'patient_id': str(dataset.get('PatientID', '')) or None,
+        'name': str(dataset.get('PatientName', '')) or None,
+        'scan_date': str(dataset.get('StudyDate', '')) or None,
+    }
+    return Image.fromarray(pixels), tags
+
+
+def read_and_decode(path):
+    """Blocking part of ingestion: read bytes, hash and decode one file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        img, tags = _decode_dicom(data)
+    else:
+        img, tags = pipeline.decode_image(io.BytesIO(data)), {}
+    pixels, quality = quality_gate.assess_image(img)
+    return {'path': path, 'image_hash': pipeline.image_hash(data), 'pixels': pixels, 'quality': quality, 'tags': tags}
+
+
+def reserve_target(directory, name, sidecar_suffix):
+    """Free path for name in directory (<stem>-<n><ext> if taken), claimed by creating its sidecar file"""
+    stem, ext = os.path.splitext(name)
+    for n in itertools.count():
+        target = os.path.join(directory, name if n == 0 else f"{stem}-{n}{ext}")
+        if os.path.exists(target):
+            continue
+        try:
+            # O_EXCL: concurrent dead-lettering of two drops with the same name cannot pick the same target
+            os.close(os.open(target + sidecar_suffix, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        return target
+
+
+# --------------------------
+# Daemon
+# --------------------------
+class IngestDaemon:
+    """Watch → decode (bounded concurrency) → micro-batch predict → store/report"""
+
+    def __init__(self, drop_dir=DROP_DIR, model_path=pipeline.MODEL_PATH, encoder_path=pipeline.LABEL_ENCODER_PATH,
+                 db_path=RESULT_STORE_PATH, reports=False, use_inotify=True, calibration_path=CALIBRATION_PATH):
+        self.drop_dir = os.path.abspath(drop_dir)
+        self.processed_dir = os.path.join(self.drop_dir, PROCESSED_SUBDIR)
+        self.dead_letter_dir = os.path.join(self.drop_dir, DEAD_LETTER_SUBDIR)
+        os.makedirs(self.processed_dir, exist_ok=True)
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+
+        self.model = pipeline.load_serving_model(model_path)
+        self.class_map = pipeline.load_class_map(encoder_path)
+        self.class_map.check_model(self.model)
+        # Whole frames: ROI results are the app's, stored apart
+        self.model_fingerprint = pipeline.serving_fingerprint(model_path, roi_mode='off')
+        self.calibration = load_calibration(self.model_fingerprint, self.class_map.classes, calibration_path)
+        self.store = ResultStore(db_path) if db_path else None
+        self.report_jobs = None
+        if reports:
+            # Imported lazily: only report-producing daemons need the worker pool
+            from report_jobs import ReportJobQueue, REPORT_WORKERS, report_key
+            self._report_key = report_key
+            self.report_jobs = ReportJobQueue(db_path or RESULT_STORE_PATH, REPORT_WORKERS)
+        self.use_inotify = use_inotify and Observer is not None
+
+        self._in_flight = set()  # paths queued or being processed
+        self._tasks = set()  # strong references so pending ingests are not garbage collected
+        self._decode_slots = asyncio.Semaphore(DECODE_CONCURRENCY)
+        self._decoded = asyncio.Queue(maxsize=MICRO_BATCH_SIZE * 4)
+        self._stop = asyncio.Event()
+
+    # Watching ---------------------------------------------------------
+    def _candidate_files(self):
+        with os.scandir(self.drop_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(ingest_extensions()):
+                    yield entry.path
+
+    async def _settled(self, path):
+        """Wait until a file stops growing; False if it disappeared"""
+        previous = None
+        while not self._stop.is_set():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return False
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current == previous and stat.st_size > 0:
+                return True
+            previous = current
+            await asyncio.sleep(SETTLE_SECONDS)
+        return False
+
+    def _schedule(self, path):
+        if path in self._in_flight or not path.lower().endswith(ingest_extensions()):
+            return
+        if os.path.dirname(path) != self.drop_dir:
+            return  # processed/ and dead_letter/ live inside the drop folder
+        self._in_flight.add(path)
+        task = asyncio.create_task(self._ingest(path))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        for path in self._candidate_files():  # backlog from while the daemon was down
+            self._schedule(path)
+
+        if self.use_inotify:
+            daemon = self
+
+            class Handler(FileSystemEventHandler):
+                def on_created(self, event):
+                    if not event.is_directory:
+                        loop.call_soon_threadsafe(daemon._schedule, event.src_path)
+
+                def on_moved(self, event):
+                    if not event.is_directory:
+                        loop.call_soon_threadsafe(daemon._schedule, event.dest_path)
+
+            observer = Observer()
+            observer.schedule(Handler(), self.drop_dir, recursive=False)
+            observer.start()
+            log.info("Watching %s with inotify", self.drop_dir)
+            try:
+                await self._stop.wait()
+            finally:
+                observer.stop()
+                observer.join()
+        else:
+            log.info("Polling %s every %.1fs", self.drop_dir, POLL_SECONDS)
+            while not self._stop.is_set():
+                for path in self._candidate_files():
+                    self._schedule(path)
+                try:
+                    await asyncio.wait_for(self._stop.wait(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    # Decoding ---------------------------------------------------------
+    async def _ingest(self, path):
+        if not await self._settled(path):
+            self._in_flight.discard(path)
+            return
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                async with self._decode_slots:
+                    item = await asyncio.to_thread(read_and_decode, path)
+                break
+            except FileNotFoundError:
+                self._in_flight.discard(path)
+                return
+            except Exception:
+                error = traceback.format_exc(limit=3)
+                if attempt == MAX_ATTEMPTS:
+                    await asyncio.to_thread(self._dead_letter, path, error)
+                    return
+                delay = BACKOFF_SECONDS * 2 ** (attempt - 1)
+                log.warning("Decode of %s failed (attempt %d/%d), retrying in %.1fs",
+                            os.path.basename(path), attempt, MAX_ATTEMPTS, delay)
+                await asyncio.sleep(delay)
+        if item['quality']['verdict'] == 'reject':
+            # Not a transient failure: retrying would give the same verdict
+            increment('ingest_quality_rejected')
+            reasons = '; '.join(item['quality']['reasons'])
+            await asyncio.to_thread(self._dead_letter, path, f"Rejected by the quality gate: {reasons}\n")
+            return
+        await self._decoded.put(item)
+
+    def _dead_letter(self, path, error):
+        try:
+            target = reserve_target(self.dead_letter_dir, os.path.basename(path), '.error.txt')
+            with open(f"{target}.error.txt", 'w') as f:
+                f.write(error)
+            shutil.move(path, target)
+        finally:
+            self._in_flight.discard(path)
+        increment('ingest_dead_letter')
+        log.error("Moved %s to %s", os.path.basename(path), DEAD_LETTER_SUBDIR)
+
+    # Micro-batching ---------------------------------------------------
+    async def _next_batch(self):
+        """Block for the first item, then collect more until the batch is full or the wait runs out"""
+        batch = [await self._decoded.get()]
+        deadline = time.monotonic() + MICRO_BATCH_WAIT_MS / 1000
+        while len(batch) < MICRO_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._decoded.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _classify(self, batch):
+        """Blocking part: cached lookup, one model.predict for the rest, then store and report"""
+        # A retried batch skips the items an earlier attempt already finished
+        batch = [item for item in batch if not item.get('finished')]
+        if not batch:
+            return
+        start = time.perf_counter()
+        hashes = [item['image_hash'] for item in batch]
+        cached = self.store.get_many(hashes, self.model_fingerprint) if self.store is not None else {}
+        missing = [i for i, h in enumerate(hashes) if h not in cached]
+
+        probabilities = [None] * len(batch)
+        for i, h in enumerate(hashes):
+            if h in cached:
+                probabilities[i] = np.asarray(cached[h]['probabilities'])
+        if missing:
+            predict_start = time.perf_counter()
+            processed = pipeline.normalize_pixels(np.stack([batch[i]['pixels'] for i in missing]))
+            predictions = self.model.predict(processed, batch_size=len(missing), verbose=0)
+            predict_ms = (time.perf_counter() - predict_start) * 1000 / len(missing)
+            for i, row in zip(missing, predictions):
+                probabilities[i] = row
+        raw = np.stack(probabilities)
+        labels = self.class_map.labels(raw)
+
+        if self.store is not None and missing:
+            self.store.put_many([
+                {'image_hash': hashes[i], 'label': labels[i], 'probabilities': probabilities[i],
+                 'timings': {'predict_ms': predict_ms, 'batch_size': len(missing), 'source': 'ingest'}}
+                for i in missing
+            ], self.model_fingerprint)
+
+        # Stored results stay raw; the JSON result and the report carry calibrated confidences
+        if self.calibration is not None:
+            calibrated = self.calibration.apply(raw)
+            labels, probabilities = self.class_map.labels(calibrated), calibrated
+        for item, label, row in zip(batch, labels, probabilities):
+            self._finish(item, str(label), row)
+        observe('ingest_batch', time.perf_counter() - start)
+        increment('ingest_images', len(batch))
+
+    def _finish(self, item, label, row):
+        path = item['path']
+        name = os.path.basename(path)
+        benign_conf = float(self.class_map.benign(row)) * 100
+        malignant_conf = float(self.class_map.malignant(row)) * 100
+        confidence = max(benign_conf, malignant_conf)
+        result = {
+            'file': name,
+            'image_hash': item['image_hash'],
+            'model_fingerprint': self.model_fingerprint,
+            'prediction': label,
+            'confidence': confidence,
+            'confidence_level': get_confidence_level(confidence),
+            'benign_conf': benign_conf,
+            'malignant_conf': malignant_conf,
+            'calibration': self.calibration.describe() if self.calibration is not None else None,
+            'ingested_at': time.time(),
+        }
+        if item['quality']['verdict'] == 'flag':
+            result['quality_flags'] = item['quality']['reasons']
+        # Steps already done by an earlier attempt of this item are not repeated
+        if self.report_jobs is not None:
+            if 'report_job_id' not in item:
+                item['report_job_id'] = self._queue_report(item, result)
+            result['report_job_id'] = item['report_job_id']
+        if 'target' not in item:
+            item['target'] = reserve_target(self.processed_dir, name, '.json')
+        result['processed_file'] = os.path.basename(item['target'])
+        with open(f"{item['target']}.json", 'w') as f:
+            json.dump(result, f, indent=2)
+        # Moving the source out of the drop folder marks it done across restarts
+        shutil.move(path, item['target'])
+        item['finished'] = True
+        self._in_flight.discard(path)
+        log.info("%s: %s (%.1f%%)", name, label.upper(), confidence)
+
+    def _queue_report(self, item, result):
+        tags = item['tags']
+        scan_date = tags.get('scan_date')
+        scan_date = (f"{scan_date[:4]}-{scan_date[4:6]}-{scan_date[6:8]}" if scan_date and len(scan_date) == 8
+                     else date.today().isoformat())
+        report_id = f"THY-AI-{int(time.time())}-{item['image_hash'][:4].upper()}"
+        patient_info = {
+            'name': tags.get('name') or 'Not Provided',
+            'patient_id': tags.get('patient_id') or 'Not Assigned',
+            'scan_date': scan_date,
+            'physician': 'Not Specified',
+            'clinical_notes': f"Automatically ingested from {result['file']}",
+            'report_id': report_id,
+        }
+        prediction_results = {
+            'prediction': result['prediction'],
+            'confidence': result['confidence'],
+            'benign_conf': result['benign_conf'],
+            'malignant_conf': result['malignant_conf'],
+            'image_count': 1,
+            'aggregate': None,
+            'calibration': result['calibration'],
+        }
+        history_record = {
+            'report_id': report_id,
+            'patient_id': tags.get('patient_id'),
+            'scan_date': scan_date,
+            'physician': None,
+            'prediction': result['prediction'],
+            'confidence': result['confidence'],
+            'confidence_level': result['confidence_level'],
+            'model_fingerprint': self.model_fingerprint,
+            'image_count': 1,
+        }
+        key = self._report_key(patient_info, prediction_results, [item['image_hash']], self.model_fingerprint)
+        return self.report_jobs.submit(patient_info, prediction_results, os.path.join(REPORT_DIR, f"{report_id}.pdf"),
+                                       history_record, [item['image_hash']], self.model_fingerprint, key=key)
+
+    async def _batcher(self):
+        while True:
+            batch = await self._next_batch()
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    # One batch at a time keeps a single model instance busy without oversubscribing it
+                    await asyncio.to_thread(self._classify, batch)
+                    break
+                except Exception:
+                    error = traceback.format_exc(limit=3)
+                    if attempt == MAX_ATTEMPTS:
+                        for item in batch:
+                            if not item.get('finished'):
+                                await asyncio.to_thread(self._dead_letter, item['path'], error)
+                        break
+                    delay = BACKOFF_SECONDS * 2 ** (attempt - 1)
+                    log.warning("Batch of %d failed (attempt %d/%d), retrying in %.1fs",
+                                len(batch), attempt, MAX_ATTEMPTS, delay)
+                    await asyncio.sleep(delay)
+
+    # Lifecycle --------------------------------------------------------
+    def stop(self):
+        self._stop.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows / non-main thread
+        batcher = asyncio.create_task(self._batcher())
+        try:
+            await self._watch()
+        finally:
+            batcher.cancel()
+            if self.report_jobs is not None:
+                self.report_jobs.shutdown(wait=True)
+            log.info("Stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify images dropped into a watch folder")
+    parser.add_argument("drop_dir", nargs="?", default=DROP_DIR, help="Folder the ultrasound machines export to")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--db", default=RESULT_STORE_PATH, help="Prediction store ('' to disable)")
+    parser.add_argument("--calibration", default=CALIBRATION_PATH, help="Calibration fitted for the model ('' to disable)")
+    parser.add_argument("--reports", action="store_true", help="Also generate a PDF report for every image")
+    parser.add_argument("--poll", action="store_true", help="Poll instead of using inotify")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve Prometheus metrics on this port")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    daemon = IngestDaemon(args.drop_dir, args.model, args.encoder, args.db, args.reports, not args.poll,
+                          args.calibration)
+    asyncio.run(daemon.run())
+
+
+if __name__ == "__main__":
+    main()
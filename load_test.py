@@ -0,0 +1,571 @@
+"""Load test: many simulated clinician sessions against a running app server.
+
+Usage:
+    python load_test.py IMAGE [IMAGE ...] [--levels 1,2,4,8] [--sessions 3] [--think 0.5]
+                        [--output load.json] [--baseline load_before.json]
+    python load_test.py IMAGE --url http://host:8501 [--server-pid PID]
+
+Each simulated clinician is a headless client that speaks the browser's
+protocol to the server (the ``/_stcore/stream`` websocket and the upload
+endpoint): open the page, upload the study, wait for the prediction, type the
+patient details field by field (each a fragment rerun, as in the browser),
+click "Generate Professional PDF Report", follow the report job's polling
+fragment and download the PDF from its media URL. Uploads are re-encoded with
+a per-session marker pixel so every session is a new study (``--same-images``
+replays identical bytes instead, to exercise the store and request
+coalescing).
+
+Without ``--url`` the tool starts ``streamlit run`` on a free port itself. It
+ramps through ``--levels`` concurrent users, each running ``--sessions``
+sessions back to back, and reports per level: completed sessions per minute,
+end-to-end and per-step latency percentiles, errors, and the CPU (in cores)
+and peak RSS of the server and its worker processes (or of ``--server-pid``
+and its children). Where throughput stops growing is reported as the
+saturation point. With ``--baseline`` a previous result is compared level by
+level and the exit status is 1 if p95 latency or throughput regressed by more
+than ``--tolerance``.
+
+The clients run on the same machine as a local server and take some CPU from
+it; point ``--url`` at a server elsewhere for exact capacity numbers.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+from websockets.sync.client import connect as ws_connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.NumberInput_pb2 import NumberInput
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+APP_SCRIPT = 'streamlit_app.py'
+STEP_TIMEOUT = 300
+SERVER_START_TIMEOUT = 120
+STEPS = ('open', 'analyse', 'patient_form', 'report', 'download')
+SAMPLE_SECONDS = 0.5
+# A level whose throughput is not this much above the previous level's is saturated
+SATURATION_GAIN = 1.1
+XSRF_COOKIE = '_streamlit_xsrf'
+# What a clinician types into the patient form, in order
+PATIENT_FIELDS = (('text_input', 'Patient Name'), ('text_input', 'Patient ID'), ('number_input', 'Age'),
+                  ('text_area', 'Clinical Notes'))
+
+
+class SessionError(RuntimeError):
+    """Raised when a simulated session does not reach the next step"""
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    return {'p50_ms': float(np.percentile(samples, 50)), 'p95_ms': float(np.percentile(samples, 95)),
+            'max_ms': float(np.max(samples))}
+
+
+# --------------------------
+# Server resources
+# --------------------------
+def _proc_stat(pid):
+    """(parent pid, CPU seconds, RSS bytes) of one process from /proc, or None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_tree(root_pid):
+    """{pid: (CPU seconds, RSS bytes)} for root_pid and all of its descendants"""
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            stat = _proc_stat(int(entry))
+            if stat is not None:
+                stats[int(entry)] = stat
+    tree, frontier = {}, [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        if pid in stats and pid not in tree:
+            tree[pid] = stats[pid][1:]
+            frontier.extend(child for child, stat in stats.items() if stat[0] == pid)
+    return tree
+
+
+class ResourceSampler(threading.Thread):
+    """Samples CPU time and RSS of a server process tree in the background"""
+
+    def __init__(self, pid, interval=SAMPLE_SECONDS):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._cpu = {}  # pid -> last CPU seconds seen (exited workers keep their last value)
+        self._rss_peak = 0
+
+    def _sample(self):
+        tree = process_tree(self.pid)
+        with self._lock:
+            for pid, (cpu, _) in tree.items():
+                self._cpu[pid] = cpu
+            self._rss_peak = max(self._rss_peak, sum(rss for _, rss in tree.values()))
+
+    def cpu_seconds(self):
+        self._sample()
+        with self._lock:
+            return sum(self._cpu.values())
+
+    def take_rss_peak(self):
+        """Peak RSS since the previous call, in MB"""
+        self._sample()
+        with self._lock:
+            peak, self._rss_peak = self._rss_peak, 0
+        return peak / (1024 * 1024)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+# --------------------------
+# Headless client
+# --------------------------
+class AppClient:
+    """One browser tab: a websocket session that reruns the script the way the frontend does"""
+
+    def __init__(self, url, timeout=STEP_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.http = requests.Session()
+        # The health check sets the XSRF cookie that uploads must echo back
+        self.http.get(f"{self.url}/_stcore/health", timeout=timeout).raise_for_status()
+        cookie = '; '.join(f"{name}={value}" for name, value in self.http.cookies.items())
+        self._stack = contextlib.ExitStack()
+        self._stack.callback(self.http.close)
+        self.ws = self._stack.enter_context(ws_connect(
+            f"ws{self.url[4:]}/_stcore/stream", subprotocols=['streamlit'],
+            additional_headers={'Cookie': cookie} if cookie else None, max_size=None, open_timeout=timeout))
+        self.session_id = None
+        self.page_script_hash = ''
+        self.widgets = {}  # label -> (element type, widget proto, fragment id)
+        self.widget_states = {}  # widget id -> WidgetState the frontend would send on every rerun
+        self.auto_rerun = None  # (interval, fragment id) while a polling fragment is active
+        self.errors = []
+        self._request_id = 0
+
+    def close(self):
+        self._stack.close()
+
+    def _send(self, msg):
+        self.ws.send(msg.SerializeToString())
+
+    def _receive(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise SessionError("timed out waiting for the server")
+        try:
+            data = self.ws.recv(timeout=remaining)
+        except TimeoutError:
+            raise SessionError("timed out waiting for the server") from None
+        msg = ForwardMsg()
+        msg.ParseFromString(data)
+        kind = msg.WhichOneof('type')
+        if kind == 'new_session':
+            self.page_script_hash = msg.new_session.page_script_hash
+            if msg.new_session.HasField('initialize'):
+                self.session_id = msg.new_session.initialize.session_id
+        elif kind == 'delta' and msg.delta.WhichOneof('type') == 'new_element':
+            element = msg.delta.new_element
+            element_type = element.WhichOneof('type')
+            if element_type == 'exception':
+                self.errors.append(f"{element.exception.type}: {element.exception.message}")
+            elif element_type is not None:
+                widget = getattr(element, element_type)
+                if hasattr(widget, 'label') and hasattr(widget, 'id'):
+                    self.widgets[widget.label] = (element_type, widget, msg.delta.fragment_id)
+        elif kind == 'auto_rerun':
+            self.auto_rerun = (msg.auto_rerun.interval, msg.auto_rerun.fragment_id)
+        elif kind == 'stop_auto_rerun':
+            self.auto_rerun = None
+        return msg
+
+    def rerun(self, fragment_id='', trigger=None, is_auto_rerun=False):
+        """Send a rerun with the current widget states (plus a one-off trigger) and wait for it to finish"""
+        msg = BackMsg()
+        client_state = msg.rerun_script
+        client_state.page_script_hash = self.page_script_hash
+        client_state.fragment_id = fragment_id
+        client_state.is_auto_rerun = is_auto_rerun
+        client_state.widget_states.widgets.extend(self.widget_states.values())
+        if trigger is not None:
+            client_state.widget_states.widgets.append(trigger)
+        self.errors = []
+        self._send(msg)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            received = self._receive(deadline)
+            # A fragment that calls st.rerun() finishes early and the full run follows
+            if received.WhichOneof('type') == 'script_finished' and \
+                    received.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                break
+        if self.errors:
+            raise SessionError('; '.join(self.errors))
+
+    def widget(self, element_type, label):
+        for widget_label, (kind, proto, fragment_id) in self.widgets.items():
+            if kind == element_type and label in widget_label:
+                return proto, fragment_id
+        raise SessionError(f"no {element_type} labelled {label!r} on the page")
+
+    def set_value(self, element_type, label, value):
+        """Change a widget as a user would; reruns its fragment, or the page"""
+        proto, fragment_id = self.widget(element_type, label)
+        state = WidgetState(id=proto.id)
+        if element_type == 'number_input':
+            if proto.data_type == NumberInput.INT:
+                state.int_value = value
+            else:
+                state.double_value = value
+        else:
+            state.string_value = value
+        self.widget_states[proto.id] = state
+        self.rerun(fragment_id)
+
+    def click(self, label):
+        proto, fragment_id = self.widget('button', label)
+        self.rerun(fragment_id, trigger=WidgetState(id=proto.id, trigger_value=True))
+
+    def upload(self, label, files):
+        """Upload (name, bytes, mime type) files through the upload endpoint and rerun with them"""
+        proto, fragment_id = self.widget('file_uploader', label)
+        self._request_id += 1
+        request = BackMsg()
+        request.file_urls_request.request_id = str(self._request_id)
+        request.file_urls_request.session_id = self.session_id
+        request.file_urls_request.file_names.extend(name for name, _, _ in files)
+        self._send(request)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            response = self._receive(deadline)
+            if response.WhichOneof('type') == 'file_urls_response' and \
+                    response.file_urls_response.response_id == str(self._request_id):
+                break
+        if response.file_urls_response.error_msg:
+            raise SessionError(f"upload refused: {response.file_urls_response.error_msg}")
+
+        state = WidgetState(id=proto.id)
+        headers = {'X-Xsrftoken': self.http.cookies.get(XSRF_COOKIE, '')}
+        for (name, data, mime_type), urls in zip(files, response.file_urls_response.file_urls):
+            reply = self.http.put(f"{self.url}{urls.upload_url}", files={'file': (name, data, mime_type)},
+                                  headers=headers, timeout=self.timeout)
+            if not reply.ok:
+                raise SessionError(f"upload of {name} failed: HTTP {reply.status_code}")
+            state.file_uploader_state_value.uploaded_file_info.append(
+                UploadedFileInfo(name=name, size=len(data), file_id=urls.file_id, file_urls=urls))
+        self.widget_states[proto.id] = state
+        self.rerun(fragment_id)
+
+    def follow_auto_rerun(self, until):
+        """Rerun the polling fragment on its schedule, as the frontend does, until until() holds"""
+        deadline = time.monotonic() + self.timeout
+        while not until():
+            if self.auto_rerun is None:
+                raise SessionError("nothing left to wait for")
+            if time.monotonic() > deadline:
+                raise SessionError("timed out waiting for the polling fragment")
+            interval, fragment_id = self.auto_rerun
+            time.sleep(interval)
+            self.rerun(fragment_id, is_auto_rerun=True)
+
+    def download(self, label):
+        proto, _ = self.widget('download_button', label)
+        reply = self.http.get(f"{self.url}{proto.url}", timeout=self.timeout)
+        if not reply.ok:
+            raise SessionError(f"download failed: HTTP {reply.status_code}")
+        return reply.content
+
+
+# --------------------------
+# Simulated sessions
+# --------------------------
+def study_files(images, marker=None):
+    """Upload payloads; with a marker each image is re-encoded with one changed pixel so its hash is new"""
+    files = []
+    for path in images:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(path)
+        if marker is not None:
+            img = Image.open(io.BytesIO(data)).convert('RGB')
+            img.putpixel((0, 0), (marker % 256, (marker // 256) % 256, 0))
+            buffer = io.BytesIO()
+            img.save(buffer, format='PNG')
+            data, name = buffer.getvalue(), f"{os.path.splitext(name)[0]}_{marker}.png"
+        files.append((name, data, 'image/png' if name.endswith('.png') else 'image/jpeg'))
+    return files
+
+
+def run_session(url, files, name, think=0.0):
+    """One clinician from opening the page to a downloaded PDF; returns {step: ms}"""
+    steps = {}
+    start = time.perf_counter()
+    client = AppClient(url)
+    try:
+        def step(label, action):
+            nonlocal start
+            action()
+            steps[label] = (time.perf_counter() - start) * 1000
+            time.sleep(think)
+            start = time.perf_counter()
+
+        def fill_form():
+            values = {'Patient Name': name, 'Patient ID': f"MRN-{name.split()[-1]}", 'Age': 54,
+                      'Clinical Notes': "Load test session"}
+            for element_type, label in PATIENT_FIELDS:
+                client.set_value(element_type, label, values[label])
+
+        def has_download():
+            return any(kind == 'download_button' for kind, _, _ in client.widgets.values())
+
+        def generate_report():
+            client.click('Generate Professional PDF Report')
+            # With report workers the PDF arrives through the polling fragment
+            client.follow_auto_rerun(has_download)
+
+        def download():
+            pdf = client.download('Download Professional Report')
+            if not pdf.startswith(b'%PDF'):
+                raise SessionError("download: not a PDF")
+
+        def analyse():
+            client.upload('Choose ultrasound image files', files)
+            client.widget('button', 'Generate Professional PDF Report')
+
+        for label, action in (('open', client.rerun), ('analyse', analyse), ('patient_form', fill_form),
+                              ('report', generate_report), ('download', download)):
+            try:
+                step(label, action)
+            except SessionError as e:
+                raise SessionError(f"{label}: {e}") from None
+    finally:
+        client.close()
+    return steps
+
+
+# --------------------------
+# Ramp
+# --------------------------
+def run_level(url, images, users, sessions, think, same_images, sampler, first_marker):
+    """Run users × sessions concurrent sessions; returns the level's summary dict"""
+    results, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(users)
+
+    def user(index):
+        barrier.wait()
+        for session in range(sessions):
+            marker = None if same_images else first_marker + index * sessions + session
+            name = f"Load Test {users}-{index}-{session}"
+            try:
+                steps = run_session(url, study_files(images, marker), name, think)
+            except Exception as e:  # a failed session is a data point, not the end of the test
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+                continue
+            with lock:
+                results.append(steps)
+
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(users)]
+    if sampler is not None:
+        sampler.take_rss_peak()
+        cpu_start = sampler.cpu_seconds()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_s = time.perf_counter() - wall_start
+
+    end_to_end = [sum(steps.values()) for steps in results]
+    return {
+        'users': users,
+        'sessions': len(results),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'wall_s': wall_s,
+        'sessions_per_minute': len(results) * 60 / wall_s,
+        'end_to_end': _percentiles(end_to_end),
+        'steps': {step: _percentiles([steps[step] for steps in results]) for step in STEPS},
+        'cpu_cores': (sampler.cpu_seconds() - cpu_start) / wall_s if sampler is not None else None,
+        'rss_peak_mb': sampler.take_rss_peak() if sampler is not None else None,
+    }
+
+
+def saturation_point(levels):
+    """Lowest concurrency after which more users no longer raise throughput by SATURATION_GAIN"""
+    for previous, level in zip(levels, levels[1:]):
+        if level['sessions_per_minute'] < previous['sessions_per_minute'] * SATURATION_GAIN:
+            return previous['users']
+    return None
+
+
+def compare(levels, baseline_levels, tolerance):
+    """Regressions against a baseline run, matched by concurrency level"""
+    regressions = []
+    baseline = {level['users']: level for level in baseline_levels}
+    for level in levels:
+        before = baseline.get(level['users'])
+        if before is None or not level['sessions'] or not before['sessions']:
+            continue
+        if level['end_to_end']['p95_ms'] > before['end_to_end']['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{level['users']} users: p95 {before['end_to_end']['p95_ms']:.0f} -> "
+                               f"{level['end_to_end']['p95_ms']:.0f} ms")
+        if level['sessions_per_minute'] < before['sessions_per_minute'] * (1 - tolerance):
+            regressions.append(f"{level['users']} users: {before['sessions_per_minute']:.1f} -> "
+                               f"{level['sessions_per_minute']:.1f} sessions/min")
+    return regressions
+
+
+LEVEL_HEADER = (f"{'users':>5} {'sess/min':>9} {'e2e p50':>9} {'e2e p95':>9} {'analyse p95':>12} "
+                f"{'report p95':>11} {'cpu':>5} {'rss MB':>7} {'errors':>6}")
+
+
+def format_level(level):
+    def value(number, spec):
+        return format(number, spec) if number is not None else '-'
+
+    return (f"{level['users']:>5} {level['sessions_per_minute']:>9.1f} "
+            f"{value(level['end_to_end']['p50_ms'], '.0f'):>9} {value(level['end_to_end']['p95_ms'], '.0f'):>9} "
+            f"{value(level['steps']['analyse']['p95_ms'], '.0f'):>12} "
+            f"{value(level['steps']['report']['p95_ms'], '.0f'):>11} {value(level['cpu_cores'], '.2f'):>5} "
+            f"{value(level['rss_peak_mb'], '.0f'):>7} {level['errors']:>6}")
+
+
+# --------------------------
+# Local server
+# --------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(script):
+    """Start `streamlit run script` on a free port; returns (process, url) once it is healthy"""
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', script, '--server.port', str(port),
+         '--server.address', '127.0.0.1', '--server.headless', 'true',
+         '--browser.gatherUsageStats', 'false'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited with status {server.returncode} while starting")
+        try:
+            if requests.get(f"{url}/_stcore/health", timeout=1).ok:
+                return server, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise SystemExit(f"Server did not become healthy within {SERVER_START_TIMEOUT}s")
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ramp concurrent simulated clinician sessions against the app")
+    parser.add_argument("images", nargs="+", help="Ultrasound image(s) uploaded as one study per session")
+    parser.add_argument("--url", default=None, help="Server to test (default: start one for --script)")
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="With --url: sample CPU and RSS of this process and its children")
+    parser.add_argument("--script", default=APP_SCRIPT, help="App script to serve when starting a server")
+    parser.add_argument("--levels", default="1,2,4,8", help="Comma-separated numbers of concurrent users")
+    parser.add_argument("--sessions", type=int, default=3, help="Sessions each user runs per level")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds a user pauses after each step")
+    parser.add_argument("--same-images", action="store_true",
+                        help="Upload identical bytes every time (store hits and coalescing) instead of new studies")
+    parser.add_argument("--output", default=None, help="Write the saturation curve JSON here")
+    parser.add_argument("--baseline", default=None, help="Earlier --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression against the baseline")
+    args = parser.parse_args(argv)
+    levels = [int(level) for level in args.levels.split(',')]
+
+    server, url, pid = None, args.url, args.server_pid
+    if url is None:
+        server, url = start_server(args.script)
+        pid = server.pid
+    sampler = ResourceSampler(pid) if pid is not None else None
+    try:
+        if sampler is not None:
+            sampler.start()
+        # One untimed session loads the model, starts the workers and traces predict
+        start = time.perf_counter()
+        try:
+            run_session(url, study_files(args.images, marker=0), "Load Test Warm-up")
+        except SessionError as e:
+            raise SystemExit(f"Warm-up session failed: {e}")
+        warm_up_s = time.perf_counter() - start
+        print(f"Warm-up session {warm_up_s:.1f}s against {url}", file=sys.stderr)
+
+        print(LEVEL_HEADER, file=sys.stderr)
+        results, first_marker = [], 1
+        for users in levels:
+            results.append(run_level(url, args.images, users, args.sessions, args.think,
+                                     args.same_images, sampler, first_marker))
+            first_marker += users * args.sessions
+            print(format_level(results[-1]), file=sys.stderr)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    saturated_at = saturation_point(results)
+    print(f"Throughput stops growing beyond {saturated_at} concurrent users" if saturated_at
+          else "Throughput still grew at the highest level; add higher --levels to find saturation", file=sys.stderr)
+    report = {
+        'url': args.url,
+        'images': args.images,
+        'sessions_per_user': args.sessions,
+        'think_s': args.think,
+        'same_images': args.same_images,
+        'cpu_count': os.cpu_count(),
+        'warm_up_s': warm_up_s,
+        'saturated_at_users': saturated_at,
+        'levels': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['levels'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Hot-path timing instrumentation with Prometheus-format export.
+
+Wrap a stage with ``timed("stage")`` either as a context manager or as a
+decorator. Durations are aggregated into process-wide histograms (shared by all
+Streamlit sessions, which run as threads of one process) and can be served as
+Prometheus text on ``METRICS_PORT`` or shown on the app's admin panel.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRIC_PREFIX = 'thyroid'
+# Bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RECENT_SAMPLES = 1024
+
+
+class StageHistogram:
+    """Cumulative histogram plus a window of recent samples for percentiles"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = collections.Counter()
+
+
+def observe(stage, seconds):
+    """Record one duration for a stage"""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = StageHistogram()
+        histogram.observe(seconds)
+
+
+def increment(name, amount=1):
+    """Bump a monotonically increasing counter"""
+    with _lock:
+        _counters[name] += amount
+
+
+class timed(contextlib.ContextDecorator):
+    """Time a block or a function under the given stage name"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._starts = threading.local()
+
+    def __enter__(self):
+        # A stack per thread keeps the decorator safe for recursion and concurrent sessions
+        stack = getattr(self._starts, 'stack', None)
+        if stack is None:
+            stack = self._starts.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self._starts.stack.pop())
+        return False
+
+
+def last_observation(stage):
+    """Most recent duration in seconds recorded for a stage, or None"""
+    with _lock:
+        histogram = _histograms.get(stage)
+        return histogram.recent[-1] if histogram is not None and histogram.recent else None
+
+
+def stage_summary():
+    """Per-stage count, mean and recent p50/p95/p99 in milliseconds"""
+    with _lock:
+        snapshot = {stage: (h.count, h.total, list(h.recent)) for stage, h in _histograms.items()}
+    summary = {}
+    for stage, (count, total, recent) in sorted(snapshot.items()):
+        recent_ms = np.array(recent) * 1000
+        summary[stage] = {
+            'count': count,
+            'mean_ms': total / count * 1000 if count else 0.0,
+            'p50_ms': float(np.percentile(recent_ms, 50)) if recent else 0.0,
+            'p95_ms': float(np.percentile(recent_ms, 95)) if recent else 0.0,
+            'p99_ms': float(np.percentile(recent_ms, 99)) if recent else 0.0,
+        }
+    return summary
+
+
+def render_prometheus():
+    """Render all histograms and counters in the Prometheus text exposition format"""
+    with _lock:
+        histograms = {stage: (list(h.bucket_counts), h.count, h.total) for stage, h in _histograms.items()}
+        counters = dict(_counters)
+
+    name = f"{METRIC_PREFIX}_stage_duration_seconds"
+    lines = [f"# HELP {name} Time spent in each pipeline stage.", f"# TYPE {name} histogram"]
+    for stage, (bucket_counts, count, total) in sorted(histograms.items()):
+        for bound, bucket_count in zip(BUCKETS, bucket_counts):
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+        lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+    for counter, value in sorted(counters.items()):
+        lines.append(f"# TYPE {METRIC_PREFIX}_{counter}_total counter")
+        lines.append(f"{METRIC_PREFIX}_{counter}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the Streamlit log
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    """Serve /metrics on a daemon thread; returns the server or None when disabled"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,180 @@
+"""Flat, memory-mapped model artifact that loads without parsing HDF5.
+
+Usage:
+    python model_artifact.py convert [--model cnn_thyroid_model.h5] [--output cnn_thyroid_model.flat]
+    python model_artifact.py check [--model cnn_thyroid_model.h5]
+
+``convert`` writes a directory next to the model with the architecture as
+Keras JSON and every weight tensor in one raw, 64-byte aligned
+``weights.bin`` (no optimizer state, so it is a fraction of the .h5).
+Loading rebuilds the graph from the JSON and hands Keras zero-copy
+``np.memmap`` views of the weight file: the only private copy of the weights
+is the one in the TensorFlow variables, and every replica on a node reads the
+same page-cache pages instead of each decoding HDF5 into its own buffers.
+
+``pipeline.load_model`` uses the artifact automatically when one exists next
+to the model and was converted from exactly that file (size and mtime, or the
+SHA-256 if those changed); otherwise it loads the .h5 as before.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+
+import pipeline
+
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACT_SUFFIX = '.flat'
+MANIFEST_FILE = 'model.json'
+WEIGHTS_FILE = 'weights.bin'
+ALIGNMENT = 64
+
+
+class StaleArtifactError(ValueError):
+    """Raised when an artifact was converted from a different model file"""
+
+
+def artifact_path(model_path=pipeline.MODEL_PATH):
+    """Default artifact directory for a model file"""
+    return os.path.splitext(model_path)[0] + ARTIFACT_SUFFIX
+
+
+def _source_stat(model_path):
+    st = os.stat(model_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+# --------------------------
+# Conversion
+# --------------------------
+def convert(model_path=pipeline.MODEL_PATH, output=None):
+    """Write the flat artifact for a Keras model file; returns the manifest dict"""
+    output = output or artifact_path(model_path)
+    model = tf.keras.models.load_model(model_path, compile=False)
+    os.makedirs(output, exist_ok=True)
+
+    tensors, offset = [], 0
+    tmp_weights = os.path.join(output, f"{WEIGHTS_FILE}.tmp")
+    with open(tmp_weights, 'wb') as f:
+        for weight in model.get_weights():
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            weight = np.ascontiguousarray(weight)
+            tensors.append({'offset': offset, 'shape': list(weight.shape), 'dtype': weight.dtype.str})
+            f.write(weight.tobytes())
+            offset += weight.nbytes
+    manifest = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'architecture': json.loads(model.to_json()),
+        'weights': tensors,
+        'weights_bytes': offset,
+        'source': {'fingerprint': pipeline.model_fingerprint(model_path), **_source_stat(model_path)},
+        'created_at': time.time(),
+    }
+    # Weights first, manifest last: a reader never sees a manifest without its weights
+    os.replace(tmp_weights, os.path.join(output, WEIGHTS_FILE))
+    tmp_manifest = os.path.join(output, f"{MANIFEST_FILE}.tmp")
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, os.path.join(output, MANIFEST_FILE))
+    return manifest
+
+
+# --------------------------
+# Loading
+# --------------------------
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != ARTIFACT_FORMAT_VERSION:
+        raise StaleArtifactError(f"{path} has format version {manifest.get('format_version')}, "
+                                 f"expected {ARTIFACT_FORMAT_VERSION}")
+    return manifest
+
+
+def check_source(manifest, model_path):
+    """Raise StaleArtifactError unless the artifact was converted from model_path as it is now"""
+    source = manifest['source']
+    if {'size': source['size'], 'mtime_ns': source['mtime_ns']} == _source_stat(model_path):
+        return
+    # Copies and checkouts change the mtime, not the content
+    if pipeline.model_fingerprint(model_path) != source['fingerprint']:
+        raise StaleArtifactError(f"Artifact was converted from a different version of {model_path}; "
+                                 f"run `python model_artifact.py convert` again")
+
+
+def weight_views(path, manifest):
+    """Read-only arrays over the memory-mapped weight file, in model.get_weights() order"""
+    mapped = np.memmap(os.path.join(path, WEIGHTS_FILE), mode='r')
+    return [np.ndarray(tuple(t['shape']), dtype=np.dtype(t['dtype']), buffer=mapped, offset=t['offset'])
+            for t in manifest['weights']]
+
+
+def load_artifact(path, model_path=None):
+    """Rebuild the Keras model from an artifact (checked against model_path when given)"""
+    manifest = read_manifest(path)
+    if model_path is not None:
+        check_source(manifest, model_path)
+    model = tf.keras.models.model_from_json(json.dumps(manifest['architecture']))
+    model.set_weights(weight_views(path, manifest))
+    return model
+
+
+def warm_page_cache(path):
+    """Ask the kernel to read the weight file ahead, so workers map pages already in memory"""
+    weights = os.path.join(path, WEIGHTS_FILE)
+    if not os.path.exists(weights) or not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(weights, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert the Keras model to a flat, memory-mapped artifact")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="Write the artifact for a model file")
+    convert_parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    convert_parser.add_argument("--output", default=None, help="Artifact directory (default: next to the model)")
+    check_parser = subparsers.add_parser("check", help="Compare artifact and .h5 load time and outputs")
+    check_parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    check_parser.add_argument("--artifact", default=None, help="Artifact directory (default: next to the model)")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        start = time.perf_counter()
+        manifest = convert(args.model, args.output)
+        print(f"Wrote {len(manifest['weights'])} tensors ({manifest['weights_bytes'] / 1e6:.1f} MB) to "
+              f"{args.output or artifact_path(args.model)} in {time.perf_counter() - start:.1f}s")
+        return
+
+    path = args.artifact or artifact_path(args.model)
+    start = time.perf_counter()
+    try:
+        fast = load_artifact(path, args.model)
+    except (OSError, StaleArtifactError) as e:
+        raise SystemExit(f"{path}: {e}")
+    fast_s = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = tf.keras.models.load_model(args.model)
+    h5_s = time.perf_counter() - start
+    batch = np.random.default_rng(0).random((4, *pipeline.IMAGE_SIZE, 3), dtype=np.float32)
+    difference = float(np.abs(fast.predict_on_batch(batch) - reference.predict_on_batch(batch)).max())
+    print(f"artifact {fast_s * 1000:.0f} ms, .h5 {h5_s * 1000:.0f} ms, max output difference {difference:.2e}",
+          file=sys.stderr)
+    if difference > 1e-5:
+        raise SystemExit("Artifact outputs differ from the .h5 model")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from result_store import ResultStore, RESULT_STORE_PATH, CONFIDENCE_LEVELS
+
+# --------------------------
+# Page Config
+# --------------------------
+st.set_page_config(
+    page_title="Study History - AI Thyroid Nodule Classifier",
+    page_icon="📚",
+    layout="wide"
+)
+
+PAGE_SIZE = 25
+
+
+@st.cache_resource
+def load_result_store():
+    return ResultStore(RESULT_STORE_PATH) if RESULT_STORE_PATH else None
+
+
+st.markdown("""
+<div style='text-align: center; padding: 1rem;'>
+    <h1 style='color: #FF8C00; margin: 0;'>📚 Study History</h1>
+    <p style='margin: 0.5rem 0;'>Past analyses and generated reports</p>
+</div>
+""", unsafe_allow_html=True)
+
+result_store = load_result_store()
+if result_store is None:
+    st.error("🚫 The result store is disabled (THYROID_RESULT_STORE is empty).")
+    st.stop()
+
+# --------------------------
+# Filters
+# --------------------------
+filter_col1, filter_col2, filter_col3 = st.columns([1, 1.2, 1.5])
+with filter_col1:
+    patient_filter = st.text_input("🆔 Patient ID", placeholder="Exact patient ID/MRN").strip()
+with filter_col2:
+    today = datetime.now().date()
+    date_range = st.date_input("📅 Scan date range", value=(today - timedelta(days=365), today))
+with filter_col3:
+    level_filter = st.multiselect("🎯 Confidence level", CONFIDENCE_LEVELS)
+
+# A half-picked range comes back as a 1-tuple while the user is still choosing
+date_from = date_range[0] if len(date_range) > 0 else None
+date_to = date_range[1] if len(date_range) > 1 else None
+filters = {
+    'patient_id': patient_filter or None,
+    'date_from': date_from.isoformat() if date_from else None,
+    'date_to': date_to.isoformat() if date_to else None,
+    'confidence_levels': level_filter or None,
+}
+
+# Keyset pagination: keep the cursor of every page visited so far, reset when filters change
+if st.session_state.get('history_filters') != filters:
+    st.session_state.history_filters = filters
+    st.session_state.history_cursors = [None]
+
+cursors = st.session_state.history_cursors
+rows, next_cursor = result_store.query_reports(page_size=PAGE_SIZE, after=cursors[-1], **filters)
+total = result_store.count_reports(**filters)
+
+st.markdown(f"**{total:,}** matching reports · page {len(cursors)} of {max(1, -(-total // PAGE_SIZE)):,}")
+
+if rows:
+    st.dataframe(
+        [
+            {
+                'Report ID': r['report_id'],
+                'Patient ID': r['patient_id'] or 'Not Assigned',
+                'Scan Date': r['scan_date'],
+                'Physician': r['physician'] or 'Not Specified',
+                'Prediction': r['prediction'].upper(),
+                'Confidence %': r['confidence'],
+                'Confidence Level': r['confidence_level'],
+                'Images': r['image_count'],
+                'Generated': datetime.fromtimestamp(r['created_at']).strftime("%Y-%m-%d %H:%M"),
+            }
+            for r in rows
+        ],
+        column_config={'Confidence %': st.column_config.NumberColumn(format="%.1f%%")},
+        hide_index=True,
+        use_container_width=True
+    )
+else:
+    st.info("No reports match these filters.")
+
+nav_prev, nav_spacer, nav_next = st.columns([1, 4, 1])
+with nav_prev:
+    if st.button("⬅ Previous", disabled=len(cursors) == 1, use_container_width=True):
+        cursors.pop()
+        st.rerun()
+with nav_next:
+    if st.button("Next ➡", disabled=next_cursor is None, use_container_width=True):
+        cursors.append(next_cursor)
+        st.rerun()
+
+# --------------------------
+# Report Download
+# --------------------------
+available = [r for r in rows if r['pdf_path'] and os.path.exists(r['pdf_path'])]
+if available:
+    st.markdown("---")
+    st.markdown("#### 📥 Download a Past Report")
+    selected = st.selectbox("Report", available, format_func=lambda r: f"{r['report_id']} · {r['patient_id'] or 'Not Assigned'} · {r['scan_date']}")
+    with open(selected['pdf_path'], 'rb') as f:
+        st.download_button("📥 Download PDF", f.read(), file_name=os.path.basename(selected['pdf_path']),
+                           mime="application/pdf")
@@ -0,0 +1,282 @@
+"""Shared inference pipeline used by the Streamlit app and the command-line tools.
+
+Keeps model loading, image decoding and preprocessing in one place so that the
+benchmark and batch tools measure exactly what the app runs.
+"""
+import hashlib
+import os
+import pickle
+import sys
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+from PIL import Image
+
+MODEL_PATH = 'cnn_thyroid_model.h5'
+LABEL_ENCODER_PATH = 'label_encoder.pkl'
+IMAGE_SIZE = (128, 128)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Upper bound on decoded pixels per image, so one upload cannot exhaust session memory
+MAX_IMAGE_PIXELS = int(os.environ.get('THYROID_MAX_IMAGE_PIXELS', str(40_000_000)))
+# JPEGs are decoded at the smallest DCT scale that still covers this size (0 disables)
+DECODE_MIN_SIDE = int(os.environ.get('THYROID_DECODE_MIN_SIDE', '768'))
+# Longest side of the copy shown in the UI
+DISPLAY_MAX_SIDE = int(os.environ.get('THYROID_DISPLAY_MAX_SIDE', '1024'))
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image would decode to more pixels than MAX_IMAGE_PIXELS"""
+
+
+# --------------------------
+# Model & Encoder
+# --------------------------
+# Models loaded ahead of the first request (see prefork.py), handed out once by load_model
+_preloaded = {}
+
+
+def load_model(path=MODEL_PATH):
+    """Load the Keras classifier (from its flat artifact when an up-to-date one exists) for the
+    runtime profile in THYROID_RUNTIME_PROFILE"""
+    if path in _preloaded:
+        return _preloaded.pop(path)
+    import model_artifact
+    import runtime_profiles
+    # Thread pools must be sized before the first TensorFlow op of the process
+    runtime_profiles.configure_process()
+    model = None
+    artifact = model_artifact.artifact_path(path)
+    if os.path.isdir(artifact):
+        try:
+            model = model_artifact.load_artifact(artifact, path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring model artifact {artifact}: {e}", file=sys.stderr)
+    if model is None:
+        model = tf.keras.models.load_model(path)
+    return runtime_profiles.configure_model(model)
+
+
+def preload_model(path=MODEL_PATH):
+    """Load the model now, so the next load_model(path) returns it without waiting"""
+    _preloaded[path] = load_model(path)
+    return _preloaded[path]
+
+
+def load_serving_model(path=MODEL_PATH, model=None):
+    """The model as the app serves it: load_model(path) (or an already loaded stand-in such as the
+    inference pool) behind the THYROID_CASCADE_STUDENT cascade when one is configured"""
+    from cascade import CASCADE_STUDENT_PATH, load_cascade
+    model = load_model(path) if model is None else model
+    return load_cascade(model) if CASCADE_STUDENT_PATH else model
+
+
+def serving_fingerprint(path=MODEL_PATH, cascade=True, roi_mode=None):
+    """Key for results of load_serving_model(path): the model file, its runtime precision, the cascade
+    (unless cascade=False, for callers using load_model directly) and THYROID_ROI_MODE (or roi_mode;
+    'off' for callers that classify whole frames)"""
+    import roi
+    import runtime_profiles
+    from cascade import CASCADE_STUDENT_PATH, CASCADE_THRESHOLD, cascade_fingerprint
+    fingerprint = runtime_profiles.runtime_fingerprint(model_fingerprint(path))
+    if cascade and CASCADE_STUDENT_PATH:
+        fingerprint = cascade_fingerprint(fingerprint, CASCADE_STUDENT_PATH, CASCADE_THRESHOLD)
+    return roi.roi_fingerprint(fingerprint, roi.ROI_MODE if roi_mode is None else roi_mode)
+
+
+def embedding_model(model):
+    """Wrap the classifier so one predict returns [probabilities, penultimate-layer embeddings].
+
+    The embedding is the input of the final (softmax) layer, so it costs no
+    extra forward pass. Sequential models loaded from .h5 have no symbolic
+    graph, so their layers are re-applied to a fresh input (weights are shared).
+    """
+    if isinstance(model, tf.keras.Sequential):
+        inputs = tf.keras.Input(shape=model.input_shape[1:])
+        embedding = inputs
+        for layer in model.layers[:-1]:
+            embedding = layer(embedding)
+        outputs = [model.layers[-1](embedding), embedding]
+    else:
+        inputs, outputs = model.inputs, [model.outputs[0], model.layers[-1].input]
+    # Embeddings of a bfloat16 runtime profile are stored as float32 like any other
+    wrapper = tf.keras.Model(inputs=inputs, outputs=[outputs[0], tf.keras.ops.cast(outputs[1], 'float32')])
+    wrapper.jit_compile = model.jit_compile
+    return wrapper
+
+
+def load_label_encoder(path=LABEL_ENCODER_PATH):
+    """Load the fitted sklearn LabelEncoder"""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class ClassMap:
+    """Index <-> class-name lookup compiled once from the label encoder's ``classes_``.
+
+    Replaces per-prediction ``inverse_transform`` calls with a NumPy take over
+    the whole batch, and finds the benign/malignant probability columns by name
+    so a retrained encoder with a different class order cannot swap them.
+    """
+
+    def __init__(self, classes):
+        self.classes = np.array([str(c) for c in classes], dtype=object)
+        lookup = {name.lower(): index for index, name in enumerate(self.classes)}
+        missing = [name for name in ('benign', 'malignant') if name not in lookup]
+        if missing:
+            raise ValueError(f"Label encoder classes {list(self.classes)} have no {', '.join(missing)} class")
+        self.benign_index = lookup['benign']
+        self.malignant_index = lookup['malignant']
+
+    @classmethod
+    def from_encoder(cls, label_encoder):
+        return cls(label_encoder.classes_)
+
+    def __len__(self):
+        return len(self.classes)
+
+    def check_model(self, model):
+        """Fail early if the model's output width does not match the class list"""
+        outputs = getattr(model, 'output_shape', (None,))[-1]  # None for an InferencePool
+        if outputs is not None and outputs != len(self.classes):
+            raise ValueError(f"Model has {outputs} outputs but the label encoder has {len(self.classes)} classes")
+
+    def labels(self, predictions):
+        """Class names for a (N, classes) probability batch"""
+        return self.classes[np.argmax(predictions, axis=-1)]
+
+    def label(self, probabilities):
+        """Class name for one probability row"""
+        return self.classes[int(np.argmax(probabilities))]
+
+    def benign(self, predictions):
+        """Benign probability column (scalar for one row, vector for a batch)"""
+        return np.asarray(predictions)[..., self.benign_index]
+
+    def malignant(self, predictions):
+        """Malignant probability column (scalar for one row, vector for a batch)"""
+        return np.asarray(predictions)[..., self.malignant_index]
+
+
+def load_class_map(path=LABEL_ENCODER_PATH):
+    """Load the label encoder and compile its ClassMap"""
+    return ClassMap.from_encoder(load_label_encoder(path))
+
+
+def model_fingerprint(path=MODEL_PATH):
+    """SHA-256 of the model file, used to tell model versions apart"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_hash(data):
+    """SHA-256 of the raw uploaded bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+# --------------------------
+# Decoding & Preprocessing
+# --------------------------
+def decode_image(source, max_pixels=MAX_IMAGE_PIXELS, min_side=DECODE_MIN_SIDE):
+    """Decode an image from a path or file-like object with bounded memory.
+
+    JPEGs use PIL's draft mode, which lets libjpeg decode directly at 1/2, 1/4
+    or 1/8 scale instead of materialising the full-resolution frame. Only the
+    first frame of multi-frame files is decoded. The original (header) size is
+    kept in ``img.info['original_size']``.
+    """
+    img = Image.open(source)
+    original_size = img.size
+    if min_side and img.format == 'JPEG':
+        img.draft(img.mode, (min_side, min_side))
+    if img.size[0] * img.size[1] > max_pixels:
+        raise ImageTooLargeError(
+            f"Image is {original_size[0]}×{original_size[1]} pixels; the limit is {max_pixels:,} pixels"
+        )
+    img.load()
+    img.info['original_size'] = original_size
+    return img
+
+
+def display_image(img, max_side=DISPLAY_MAX_SIDE):
+    """Return a copy no larger than max_side on its longest edge for on-screen display"""
+    width, height = img.size
+    if max(width, height) <= max_side:
+        return img
+    scale = max_side / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+
+def preprocess_pixels(img):
+    """Resize to the model input size and return (128, 128, 3) uint8 pixels, before normalisation"""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')  # Greyscale, palette and 16-bit TIFF exports
+    img = img.resize(IMAGE_SIZE)
+    img_array = np.array(img)
+    if len(img_array.shape) == 3 and img_array.shape[2] == 4:  # RGBA
+        img_array = img_array[:, :, :3]  # Remove alpha channel
+    return img_array
+
+
+def normalize_pixels(pixels):
+    """Scale uint8 pixels to the [0, 1] float range the model was trained on"""
+    return pixels / 255.0
+
+
+def preprocess_image(img):
+    """Preprocess image for model prediction"""
+    img_array = preprocess_pixels(img)
+    img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
+    img_array = normalize_pixels(img_array)  # Normalize to [0, 1]
+    return img_array
+
+
+def preprocess_batch(images):
+    """Preprocess several images into one (N, 128, 128, 3) batch for a single model.predict"""
+    return np.concatenate([preprocess_image(img) for img in images], axis=0)
+
+
+# --------------------------
+# Labelled datasets
+# --------------------------
+def collect_labelled_images(data_dir, classes, limit=None):
+    """Return (paths, class indices) for every image under DATA_DIR/<class>/"""
+    paths, labels = [], []
+    class_lookup = {name.lower(): index for index, name in enumerate(classes)}
+    for folder in sorted(os.listdir(data_dir)):
+        folder_path = os.path.join(data_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        if folder.lower() not in class_lookup:
+            print(f"Skipping unknown class folder: {folder}", file=sys.stderr)
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(folder_path, name))
+                labels.append(class_lookup[folder.lower()])
+    if limit:
+        # Keep the class mix when truncating
+        order = np.random.default_rng(0).permutation(len(paths))[:limit]
+        paths = [paths[i] for i in sorted(order)]
+        labels = [labels[i] for i in sorted(order)]
+    return paths, np.array(labels, dtype=np.int64)
+
+
+# --------------------------
+# Study-level aggregation
+# --------------------------
+AGGREGATE_METHODS = ('mean', 'max_malignant')
+
+
+def aggregate_predictions(predictions, method='mean', malignant_index=1):
+    """Combine per-image probabilities of one study into a single probability row"""
+    predictions = np.asarray(predictions)
+    if method == 'mean':
+        return predictions.mean(axis=0)
+    if method == 'max_malignant':
+        # Report the most suspicious view of the nodule
+        return predictions[np.argmax(predictions[:, malignant_index])]
+    raise ValueError(f"Unknown aggregation method: {method}")
@@ -0,0 +1,166 @@
+"""Pre-fork launcher: import once, then fork Streamlit workers that share it copy-on-write.
+
+Usage:
+    python prefork.py [--workers 2] [--port 8501] [--app streamlit_app.py]
+
+Every replica started with ``streamlit run`` imports TensorFlow, Keras,
+Streamlit, Plotly and ReportLab on its own and keeps a private copy of all of
+it. This launcher imports them once, freezes the garbage collector (so its
+objects are never written to again and stay shared) and forks
+``THYROID_PREFORK_WORKERS`` workers, serving on consecutive ports from
+``THYROID_PREFORK_PORT``; put a load balancer with sticky sessions in front.
+Each worker loads the model (from the flat artifact, see ``model_artifact.py``,
+whose pages are read ahead by the parent) and traces predict before it accepts
+connections, so no user waits for it. Workers that die are re-forked from the
+warm parent in about a second.
+
+The TensorFlow runtime itself cannot be shared this way: once it has created a
+model, forked children deadlock in their first predict. The parent therefore
+only imports, and each worker still holds its own copy of the weights in its
+TensorFlow variables.
+"""
+import argparse
+import gc
+import importlib
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import model_artifact
+import pipeline
+
+PREFORK_WORKERS = int(os.environ.get('THYROID_PREFORK_WORKERS', '2'))
+PREFORK_PORT = int(os.environ.get('THYROID_PREFORK_PORT', '8501'))
+# A worker that dies sooner than this after its fork is crashing, not failing once
+MIN_UPTIME_SECONDS = 30
+# Imported by the parent; nothing here may start threads or create TensorFlow state
+WARM_MODULES = ('tensorflow', 'keras', 'streamlit', 'streamlit.web.cli', 'plotly.graph_objects',
+                'plotly.subplots', 'reportlab.platypus', 'sklearn.preprocessing', 'pandas', 'sqlite3')
+
+log = logging.getLogger('prefork')
+
+
+def warm_imports(modules=WARM_MODULES):
+    """Import the heavy dependencies in the parent so every fork shares them"""
+    start = time.perf_counter()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    log.info("Imported %d modules in %.1fs", len(modules), time.perf_counter() - start)
+
+
+def run_worker(app, index, port, preload=True, model_path=pipeline.MODEL_PATH):
+    """Worker body: load the model, then run the Streamlit server on port (returns its exit code)"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Every worker gets its own /metrics port as well
+    if os.environ.get('METRICS_PORT', '0') != '0':
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+    start = time.perf_counter()
+    # With inference workers the app never loads the model in this process
+    if preload and not int(os.environ.get('THYROID_INFERENCE_WORKERS', '0')):
+        model = pipeline.preload_model(model_path)
+        model.predict(np.zeros((1, *pipeline.IMAGE_SIZE, 3), dtype=np.float32), verbose=0)
+    log.info("Worker %d (pid %d) ready in %.1fs, serving on port %d",
+             index, os.getpid(), time.perf_counter() - start, port)
+    from streamlit.web import cli
+    try:
+        cli.main(args=['run', app, '--server.port', str(port), '--server.headless', 'true'], prog_name='streamlit')
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 0
+    return 0
+
+
+class Supervisor:
+    """Forks the workers from the warm parent and re-forks any that die"""
+
+    def __init__(self, app, workers=PREFORK_WORKERS, port=PREFORK_PORT, preload=True):
+        self.app = app
+        self.workers = workers
+        self.port = port
+        self.preload = preload
+        self.children = {}  # pid -> (worker index, fork time)
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_worker(self.app, index, self.port + index, self.preload)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                # Never fall back into the parent's loop or its atexit handlers
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """Start all workers and supervise them until they have all exited; returns the exit code"""
+        for index in range(self.workers):
+            self.spawn(index)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        code = 0
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if time.monotonic() - started < MIN_UPTIME_SECONDS:
+                log.error("Worker %d exited with status %d right after starting; stopping", index,
+                          os.waitstatus_to_exitcode(status))
+                code = 1
+                self.stop()
+                continue
+            log.warning("Worker %d exited with status %d; forking a new one", index,
+                        os.waitstatus_to_exitcode(status))
+            self.spawn(index)
+        return code
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the app from workers forked off one warm parent")
+    parser.add_argument("--app", default="streamlit_app.py", help="Streamlit script to serve")
+    parser.add_argument("--workers", type=int, default=PREFORK_WORKERS, help="Number of Streamlit workers")
+    parser.add_argument("--port", type=int, default=PREFORK_PORT, help="Port of worker 0; worker i uses port + i")
+    parser.add_argument("--no-preload", action="store_true", help="Load the model on the first request instead")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    warm_imports()
+    artifact = model_artifact.artifact_path(pipeline.MODEL_PATH)
+    if os.path.isdir(artifact):
+        model_artifact.warm_page_cache(artifact)
+    else:
+        log.warning("No model artifact at %s; workers parse the .h5 (run `python model_artifact.py convert`)",
+                    artifact)
+    # Objects that survive to here are never collected, so the GC does not dirty their pages in the workers
+    gc.collect()
+    gc.freeze()
+    sys.exit(Supervisor(args.app, args.workers, args.port, not args.no_preload).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Built-in profiler for one upload -> predict -> report cycle.
+
+A Streamlit "session" is a sequence of script reruns, so the profiler is paused
+at the end of every run and resumed at the start of the next one until the
+cycle is finished. A session that stays idle for THYROID_PROFILE_MAX_IDLE_SECONDS
+(tab closed, analysis abandoned) loses the profiler to the next session that
+asks for it, and a discarded session releases it straight away. Each finished
+profile is bundled as a zip containing:
+
+- ``profile.prof``      cProfile stats (open with ``snakeviz`` or ``pstats``)
+- ``profile.txt``       top functions by cumulative time
+- ``stacks.collapsed``  sampled stacks in collapsed format (flamegraph.pl, speedscope)
+- ``tracemalloc.txt``   allocation growth and peak traced memory over the cycle
+"""
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+import zipfile
+from datetime import datetime
+
+PROFILE_ENABLED = os.environ.get('THYROID_PROFILE', '') == '1'
+SAMPLE_INTERVAL_MS = float(os.environ.get('THYROID_PROFILE_INTERVAL_MS', '5'))
+# A paused profile idle for longer than this may be taken over by another session
+PROFILE_MAX_IDLE_SECONDS = float(os.environ.get('THYROID_PROFILE_MAX_IDLE_SECONDS', '600'))
+TRACEMALLOC_FRAMES = 10
+TOP_N = 40
+
+# cProfile and tracemalloc are process-wide on recent Pythons, so only one
+# session may be profiled at a time.
+_active_lock = threading.Lock()
+# Guards handing _active_lock over; _holder weakly references the profiler holding it
+_holder_lock = threading.Lock()
+_holder = None
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and counts collapsed stacks"""
+
+    def __init__(self, interval_ms=SAMPLE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stacks = collections.Counter()
+        self._thread = None
+        self._running = threading.Event()
+
+    def start(self, target_thread_id):
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, args=(target_thread_id,),
+                                        name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, target_thread_id):
+        while self._running.is_set():
+            frame = sys._current_frames().get(target_thread_id)
+            if frame is not None:
+                # Keep raw (code, line) tuples while sampling; formatting is deferred to collapsed()
+                stack = []
+                while frame is not None:
+                    stack.append((frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                self.stacks[tuple(stack)] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        lines = []
+        for stack, count in self.stacks.most_common():
+            names = [f"{code.co_name} ({os.path.basename(code.co_filename)}:{line})" for code, line in reversed(stack)]
+            lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class SessionProfiler:
+    """Accumulates cProfile, stack samples and tracemalloc across several script runs"""
+
+    def __init__(self, label='session'):
+        self.label = label
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.started_at = None
+        self.wall_seconds = 0.0
+        self.runs = 0
+        self._resumed_at = None
+        self._paused_at = None
+        self._start_snapshot = None
+        self._owns_lock = False
+        self._owns_tracemalloc = False
+
+    def __del__(self):
+        # A discarded session (closed tab, expired session state) frees the profiler for the others
+        self._release()
+
+    @property
+    def running(self):
+        return self._resumed_at is not None
+
+    @property
+    def idle_expired(self):
+        return (not self.running and self._paused_at is not None
+                and time.monotonic() - self._paused_at > PROFILE_MAX_IDLE_SECONDS)
+
+    def resume(self):
+        """Start (or continue) profiling the calling thread; False if another session holds the profiler"""
+        global _holder
+        if self.running:
+            return True
+        with _holder_lock:
+            if not self._owns_lock:
+                if not _active_lock.acquire(blocking=False):
+                    holder = _holder() if _holder is not None else None
+                    if holder is None or not holder.idle_expired:
+                        return False
+                    print(f"Profile '{holder.label}' idle for over {PROFILE_MAX_IDLE_SECONDS:.0f}s; "
+                          f"discarding it", file=sys.stderr)
+                    holder._release()
+                    _active_lock.acquire()
+                if self.runs:
+                    # This profile was itself discarded while idle: start over
+                    self.profile, self.sampler = cProfile.Profile(), StackSampler()
+                    self.runs, self.wall_seconds = 0, 0.0
+                self._owns_lock = True
+                _holder = weakref.ref(self)
+                self.started_at = datetime.now()
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                    self._owns_tracemalloc = True
+                tracemalloc.reset_peak()
+                self._start_snapshot = tracemalloc.take_snapshot()
+            self.runs += 1
+            self._resumed_at = time.perf_counter()
+        self.sampler.start(threading.get_ident())
+        self.profile.enable()
+        return True
+
+    def pause(self):
+        """Stop collecting until the next resume()"""
+        if not self.running:
+            return
+        self.profile.disable()
+        self.sampler.stop()
+        self.wall_seconds += time.perf_counter() - self._resumed_at
+        self._paused_at = time.monotonic()
+        self._resumed_at = None
+
+    def _release(self):
+        """Stop tracemalloc (if this profile started it) and give up the process-wide profiler"""
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        if self._owns_lock:
+            self._owns_lock = False
+            _active_lock.release()
+
+    def finish(self):
+        """Stop profiling for good and return the zipped artifacts as bytes"""
+        self.pause()
+        end_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+        self._release()
+
+        stats_text = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stats_text)
+        # Same bytes as Profile.dump_stats(), without a temporary file
+        raw_stats = marshal.dumps(stats.stats)
+        stats.sort_stats('cumulative').print_stats(TOP_N)
+        stats.sort_stats('tottime').print_stats(TOP_N)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr('profile.prof', raw_stats)
+            bundle.writestr('profile.txt', self._header() + stats_text.getvalue())
+            bundle.writestr('stacks.collapsed', self.sampler.collapsed())
+            bundle.writestr('tracemalloc.txt', self._header() + self._allocation_report(end_snapshot, peak))
+        return buffer.getvalue()
+
+    def _header(self):
+        started = self.started_at.isoformat(timespec='seconds') if self.started_at else 'n/a'
+        return (f"Profile: {self.label}\nStarted: {started}\nScript runs: {self.runs}\n"
+                f"Profiled wall time: {self.wall_seconds:.3f} s\n\n")
+
+    def _allocation_report(self, end_snapshot, peak):
+        lines = [f"Peak traced memory: {peak / (1024 * 1024):.1f} MiB",
+                 "(tracemalloc is process-wide: concurrent sessions are included)", ""]
+        if end_snapshot is not None and self._start_snapshot is not None:
+            # Hide the profiler's own bookkeeping
+            ignore = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+            end_snapshot = end_snapshot.filter_traces(ignore)
+            start_snapshot = self._start_snapshot.filter_traces(ignore)
+            lines.append(f"Top {TOP_N} allocation sites by growth over the cycle:")
+            for stat in end_snapshot.compare_to(start_snapshot, 'lineno')[:TOP_N]:
+                lines.append(str(stat))
+            lines.append("")
+            lines.append(f"Top {TOP_N} live allocation sites at the end of the cycle:")
+            for stat in end_snapshot.statistics('lineno')[:TOP_N]:
+                lines.append(str(stat))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,114 @@
+"""Cheap input-quality / out-of-distribution gate run before the CNN.
+
+Screenshots, blank frames, photos and other non-ultrasound uploads would
+otherwise cost a full inference and come back with a confident-looking label.
+The gate looks at the 128×128 pixels the model is fed anyway (no extra decode
+or resize) and computes a few vectorised statistics: grey-level spread and
+histogram entropy, the share of near-black and near-white pixels, the share of
+chromatic pixels (B-mode ultrasound is near-greyscale; small colour Doppler
+boxes and annotations are tolerated) and the original aspect ratio. That is a
+handful of NumPy passes over 49k bytes, well under a millisecond per image.
+
+``THYROID_QUALITY_GATE`` selects what happens to failing images: ``flag``
+(default) only warns, ``reject`` keeps them away from the model and ``off``
+skips the gate. After inference, ``ood_reason`` adds an optional check on
+the similar-case search the app already runs: an image whose nearest indexed
+study is far away in embedding space is flagged as out of distribution.
+"""
+import os
+
+import numpy as np
+
+import pipeline
+
+QUALITY_GATE_MODES = ('off', 'flag', 'reject')
+QUALITY_GATE_MODE = os.environ.get('THYROID_QUALITY_GATE', 'flag').lower()
+# A typo must not fall through to reject (or skip) behaviour
+if QUALITY_GATE_MODE not in QUALITY_GATE_MODES:
+    raise ValueError(f"Unknown THYROID_QUALITY_GATE {QUALITY_GATE_MODE!r}; choose one of {', '.join(QUALITY_GATE_MODES)}")
+# 1 - cosine similarity to the nearest indexed study above which a result is flagged (0 disables)
+OOD_MAX_DISTANCE = float(os.environ.get('THYROID_OOD_MAX_DISTANCE', '0.25'))
+OOD_MIN_INDEXED = int(os.environ.get('THYROID_OOD_MIN_INDEXED', '1000'))
+
+MIN_SIDE_PX = 64
+MAX_ASPECT_RATIO = 3.0
+BLANK_STD = 4.0            # grey-level standard deviation of a uniform frame
+DARK_LEVEL, BRIGHT_LEVEL = 16, 240
+MAX_DARK_FRACTION = 0.98   # an all-black frame (probe lifted, frozen display)
+MAX_BRIGHT_FRACTION = 0.35  # white backgrounds: screenshots, scanned documents
+CHROMA_LEVEL = 30          # max - min channel difference of a "coloured" pixel
+FLAG_COLOUR_FRACTION = 0.10
+MAX_COLOUR_FRACTION = 0.40
+MIN_ENTROPY_BITS = 1.0     # of a 32-bin grey histogram; flat-colour graphics fall below it
+_GREY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)  # ITU-R 601 luma
+_LEVELS = np.arange(256, dtype=np.float64)
+
+
+def image_stats(pixels, original_size=None):
+    """Vectorised statistics of one (H, W, 3) uint8 image"""
+    # Per-channel views: NumPy reductions over a length-3 last axis are slow
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    chroma = np.maximum(np.maximum(red, green), blue) - np.minimum(np.minimum(red, green), blue)
+    grey = (pixels.reshape(-1, 3) @ _GREY_WEIGHTS).astype(np.uint8)
+    # Mean, spread and the coarse histogram all come from one 256-level histogram
+    levels = np.bincount(grey, minlength=256) / grey.size
+    mean = float(levels @ _LEVELS)
+    histogram = levels.reshape(32, 8).sum(axis=1)
+    nonzero = histogram[histogram > 0]
+    width, height = original_size if original_size is not None else pixels.shape[1::-1]
+    return {
+        'mean': mean,
+        'std': float(np.sqrt(levels @ (_LEVELS - mean) ** 2)),
+        'entropy_bits': float(-(nonzero * np.log2(nonzero)).sum()),
+        'dark_fraction': float(levels[:DARK_LEVEL].sum()),
+        'bright_fraction': float(levels[BRIGHT_LEVEL:].sum()),
+        'colour_fraction': float(np.count_nonzero(chroma > CHROMA_LEVEL) / chroma.size),
+        'aspect_ratio': max(width, height) / max(1, min(width, height)),
+        'min_side': min(width, height),
+    }
+
+
+def assess(pixels, original_size=None, mode=QUALITY_GATE_MODE):
+    """Gate one image; returns {'verdict': 'pass' | 'flag' | 'reject', 'reasons': [...], 'stats': {...}}"""
+    if mode == 'off':
+        return {'verdict': 'pass', 'reasons': [], 'stats': {}}
+    stats = image_stats(pixels, original_size)
+    rejects, flags = [], []
+    if stats['std'] < BLANK_STD:
+        rejects.append("blank or uniform frame")
+    elif stats['dark_fraction'] > MAX_DARK_FRACTION:
+        rejects.append("almost entirely black")
+    if stats['colour_fraction'] > MAX_COLOUR_FRACTION:
+        rejects.append(f"{stats['colour_fraction']:.0%} colour pixels; ultrasound is near-greyscale")
+    elif stats['colour_fraction'] > FLAG_COLOUR_FRACTION:
+        flags.append(f"{stats['colour_fraction']:.0%} colour pixels (Doppler overlay or annotations?)")
+    if stats['bright_fraction'] > MAX_BRIGHT_FRACTION:
+        rejects.append(f"{stats['bright_fraction']:.0%} near-white pixels (screenshot or document?)")
+    if stats['aspect_ratio'] > MAX_ASPECT_RATIO:
+        rejects.append(f"aspect ratio {stats['aspect_ratio']:.1f}:1")
+    if stats['min_side'] < MIN_SIDE_PX:
+        rejects.append(f"only {stats['min_side']} px on the short side")
+    if not rejects and stats['entropy_bits'] < MIN_ENTROPY_BITS:
+        flags.append(f"low texture ({stats['entropy_bits']:.1f} bits); may be a graphic rather than a scan")
+
+    if mode == 'flag':
+        flags, rejects = rejects + flags, []
+    verdict = 'reject' if rejects else 'flag' if flags else 'pass'
+    return {'verdict': verdict, 'reasons': rejects + flags, 'stats': stats}
+
+
+def assess_image(img, mode=QUALITY_GATE_MODE):
+    """Gate a decoded PIL image; returns (model-input uint8 pixels, assessment)"""
+    pixels = pipeline.preprocess_pixels(img)
+    return pixels, assess(pixels, img.info.get('original_size', img.size), mode)
+
+
+def ood_reason(similar_cases, indexed_count):
+    """Flag reason when the nearest indexed study (first search result) is too far away, else None"""
+    # A handful of indexed studies says nothing about the training distribution
+    if not OOD_MAX_DISTANCE or not similar_cases or indexed_count < OOD_MIN_INDEXED:
+        return None
+    distance = 1.0 - similar_cases[0]['similarity']
+    if distance <= OOD_MAX_DISTANCE:
+        return None
+    return f"embedding distance {distance:.2f} to the nearest prior study exceeds {OOD_MAX_DISTANCE:.2f}"
@@ -0,0 +1,225 @@
+"""Background job queue for PDF report generation.
+
+Report requests are submitted as jobs with IDs and built by a pool of worker
+processes, so layout work never runs on a Streamlit script thread or competes
+with inference for the GIL. No external broker is needed: jobs are dispatched
+through a local process pool and their state is kept in the shared SQLite
+store, which lets the UI poll a job across reruns (or from another session).
+A report already queued or running for the same ``report_key`` is not built
+again; the second request gets the first one's job ID.
+"""
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+import types
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import increment
+from result_store import ResultStore, RESULT_STORE_PATH, connect
+
+REPORT_WORKERS = int(os.environ.get('THYROID_REPORT_WORKERS', '2'))
+# A job whose worker process died is run once more on a fresh pool before it is marked failed
+MAX_JOB_ATTEMPTS = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    report_id TEXT,
+    pdf_path TEXT,
+    error TEXT,
+    duration_ms REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+) WITHOUT ROWID;
+"""
+JOB_COLUMNS = ('job_id', 'status', 'report_id', 'pdf_path', 'error', 'duration_ms',
+               'created_at', 'started_at', 'finished_at')
+
+
+def report_key(patient_info, prediction_results, image_hashes=(), model_fingerprint=None):
+    """Identifies identical report requests: same patient details, findings, images and model"""
+    content = {
+        'patient': {k: v for k, v in patient_info.items() if k != 'report_id'},
+        'prediction': prediction_results.get('prediction'),
+        'confidence': round(float(prediction_results.get('confidence', 0)), 4),
+        'images': sorted(image_hashes),
+        'model': model_fingerprint,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_report(pdf_bytes, pdf_path, store, history_record=None, image_hashes=(), model_fingerprint=None):
+    """Write a finished PDF and record it in the result store"""
+    os.makedirs(os.path.dirname(pdf_path) or '.', exist_ok=True)
+    # Write-then-rename so the history page never serves a half-written file
+    tmp_path = f"{pdf_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(pdf_bytes)
+    os.replace(tmp_path, pdf_path)
+    if store is None:
+        return
+    if history_record is not None:
+        if image_hashes:
+            store.attach_report(image_hashes, model_fingerprint, history_record['report_id'],
+                                patient_id=history_record.get('patient_id'),
+                                scan_date=history_record.get('scan_date'))
+        store.add_report({**history_record, 'pdf_path': pdf_path})
+
+
+@contextlib.contextmanager
+def script_main_hidden():
+    """Start spawn-context processes without re-running the Streamlit script in them.
+
+    Streamlit executes the app as ``sys.modules['__main__']``, and spawn children
+    re-import ``__main__`` from its file, i.e. they would run the whole app again.
+    """
+    main_module = sys.modules.get('__main__')
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main_module
+
+
+def _update_job(conn, job_id, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with conn:
+        conn.execute(f"UPDATE report_jobs SET {assignments} WHERE job_id = ?", [*fields.values(), job_id])
+
+
+def _warm_up_worker():
+    """Import the PDF stack ahead of the first job"""
+    import report_pdf  # noqa: F401
+
+
+def build_report_job(db_path, job_id, patient_info, prediction_results, pdf_path,
+                     history_record=None, image_hashes=(), model_fingerprint=None):
+    """Worker entry point: build one PDF, save it and mark the job done or failed"""
+    # Imported here so the parent process does not pay for it twice
+    from report_pdf import create_enhanced_pdf_report
+
+    conn = connect(db_path)
+    _update_job(conn, job_id, status='running', started_at=time.time())
+    try:
+        start = time.perf_counter()
+        pdf_buffer = create_enhanced_pdf_report(patient_info, prediction_results)
+        duration_ms = (time.perf_counter() - start) * 1000
+        save_report(pdf_buffer.getvalue(), pdf_path, ResultStore(db_path),
+                    history_record, image_hashes, model_fingerprint)
+        _update_job(conn, job_id, status='done', duration_ms=duration_ms, finished_at=time.time())
+    except Exception:
+        _update_job(conn, job_id, status='failed', error=traceback.format_exc(limit=5), finished_at=time.time())
+    finally:
+        conn.close()
+
+
+class ReportJobQueue:
+    """Submits report jobs to a local worker pool and reports their status"""
+
+    def __init__(self, db_path=RESULT_STORE_PATH, workers=REPORT_WORKERS):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        # report key -> job ID of the job building it, while queued or running
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.workers = workers
+        self._executor_lock = threading.Lock()
+        self._executor = self._start_executor()
+
+    def _start_executor(self):
+        # spawn: workers must not inherit TensorFlow's threads or the Streamlit server state
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        # Start every worker now so the first reports do not wait for process spawn and imports
+        with script_main_hidden():
+            for _ in range(self.workers):
+                executor.submit(_warm_up_worker)
+        return executor
+
+    def _replace_executor(self, broken):
+        """Swap a pool that lost a worker (OOM, kill) for a fresh one; returns the current pool"""
+        with self._executor_lock:
+            # Every job of the broken pool fails at once; only the first one replaces it
+            if self._executor is broken:
+                print("Report worker process died; starting a new report pool", file=sys.stderr)
+                increment('report_pool_restarts')
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start_executor()
+            return self._executor
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.db_path)
+        return conn
+
+    def submit(self, patient_info, prediction_results, pdf_path, history_record=None,
+               image_hashes=(), model_fingerprint=None, key=None):
+        """Queue a report and return its job ID immediately (an in-flight job's ID for a known key)"""
+        with self._in_flight_lock:
+            if key is not None and key in self._in_flight:
+                increment('report_shared')
+                return self._in_flight[key]
+            job_id = uuid.uuid4().hex
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO report_jobs (job_id, status, report_id, pdf_path, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, 'queued', patient_info.get('report_id'), pdf_path, time.time())
+                )
+            if key is not None:
+                self._in_flight[key] = job_id
+        # Outside the lock: the done callback runs right here if the job has already finished
+        self._dispatch(job_id, (patient_info, prediction_results, pdf_path, history_record,
+                                tuple(image_hashes), model_fingerprint), key)
+        increment('report_executed')
+        return job_id
+
+    def _dispatch(self, job_id, job_args, key, attempt=1):
+        executor = self._executor
+        try:
+            future = executor.submit(build_report_job, self.db_path, job_id, *job_args)
+        except BrokenProcessPool:
+            executor = self._replace_executor(executor)
+            future = executor.submit(build_report_job, self.db_path, job_id, *job_args)
+        future.add_done_callback(lambda done: self._job_done(done, executor, job_id, job_args, key, attempt))
+
+    def _job_done(self, future, executor, job_id, job_args, key, attempt):
+        """Retry jobs lost with their worker and record failures the worker could not record itself"""
+        error = RuntimeError("Report job was cancelled") if future.cancelled() else future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._replace_executor(executor)
+            if attempt < MAX_JOB_ATTEMPTS:
+                self._dispatch(job_id, job_args, key, attempt + 1)
+                return
+        if error is not None:
+            print(f"Report job {job_id} failed: {error!r}", file=sys.stderr)
+            increment('report_failed')
+            _update_job(self._conn(), job_id, status='failed', finished_at=time.time(),
+                        error=''.join(traceback.format_exception_only(type(error), error)))
+        if key is not None:
+            self._release(key)
+
+    def _release(self, key):
+        with self._in_flight_lock:
+            self._in_flight.pop(key, None)
+
+    def status(self, job_id):
+        """Current state of a job as a dict, or None for an unknown ID"""
+        row = self._conn().execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM report_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,375 @@
+"""PDF report generation.
+
+Kept free of Streamlit and TensorFlow imports so that report jobs can be built
+in lightweight worker processes (see report_jobs.py).
+"""
+import io
+import os
+import time
+from datetime import datetime
+
+from reportlab.lib.pagesizes import letter, A4
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY
+
+from metrics import timed
+
+# Generated PDFs are kept here so the study history page can offer them again
+REPORT_DIR = os.environ.get('THYROID_REPORT_DIR', 'reports')
+
+# --------------------------
+# Enhanced PDF Report Generation with Better Formatting
+# --------------------------
+@timed('pdf_report')
+def create_enhanced_pdf_report(patient_info, prediction_results, image_data=None):
+    """Generate a comprehensive professional PDF report with improved formatting"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, 
+                          topMargin=0.75*inch, bottomMargin=0.75*inch,
+                          leftMargin=0.75*inch, rightMargin=0.75*inch)
+    
+    # Get styles and create custom styles
+    styles = getSampleStyleSheet()
+    
+    # Custom title style
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        spaceAfter=24,
+        spaceBefore=12,
+        alignment=TA_CENTER,
+        textColor=colors.HexColor('#FF8C00'),
+        fontName='Helvetica-Bold'
+    )
+    
+    # Custom subtitle style
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Heading2'],
+        fontSize=16,
+        spaceAfter=20,
+        spaceBefore=8,
+        alignment=TA_CENTER,
+        textColor=colors.HexColor('#2F2F2F'),
+        fontName='Helvetica'
+    )
+    
+    # Custom section heading style
+    section_heading_style = ParagraphStyle(
+        'SectionHeading',
+        parent=styles['Heading2'],
+        fontSize=14,
+        spaceAfter=10,
+        spaceBefore=16,
+        textColor=colors.HexColor('#FF8C00'),
+        fontName='Helvetica-Bold'
+    )
+    
+    # Custom normal style with better spacing
+    normal_style = ParagraphStyle(
+        'CustomNormal',
+        parent=styles['Normal'],
+        fontSize=10,
+        spaceAfter=4,
+        spaceBefore=2,
+        leading=12,
+        alignment=TA_LEFT,
+        fontName='Helvetica'
+    )
+    
+    # Custom bold style
+    bold_style = ParagraphStyle(
+        'CustomBold',
+        parent=normal_style,
+        fontName='Helvetica-Bold'
+    )
+    
+    # Build story
+    story = []
+    
+    # Header
+    story.append(Paragraph("AI THYROID NODULE ANALYSIS REPORT", title_style))
+    story.append(Paragraph("Comprehensive Diagnostic Assessment", subtitle_style))
+    story.append(Spacer(1, 20))
+    
+    # Report Information Section
+    story.append(Paragraph("REPORT INFORMATION", section_heading_style))
+    
+    report_info_data = [
+        ['Report Generated:', datetime.now().strftime("%A, %B %d, %Y at %I:%M %p")],
+        ['Report ID:', patient_info.get('report_id') or f"THY-AI-{int(time.time())}"],
+        ['AI Model Version:', "CNN Deep Learning v2.1"],
+        ['Analysis Type:', "Binary Classification (Benign/Malignant)"]
+    ]
+    if prediction_results.get('image_count', 1) > 1:
+        report_info_data.append(['Images Analysed:', f"{prediction_results['image_count']} ({prediction_results['aggregate']})"])
+    for result in (prediction_results.get('roi') or {}).values():
+        if result.get('peak_tile'):
+            left, top, right, bottom = result['peak_tile']['box']
+            report_info_data.append(['Most Suspicious Region:', f"{result['name']}: ({left}, {top})–({right}, {bottom}) px, "
+                                                                f"{result['peak_malignant']:.1f}% malignant "
+                                                                f"({result['tiles']} tiles)"])
+    for clip in (prediction_results.get('clips') or {}).values():
+        report_info_data.append(['Cine Clip:', f"{clip['name']}: {len(clip['frame_indices'])} frames scored "
+                                               f"(every {clip['stride']}th, {clip['aggregate']} of frames)"])
+    
+    report_table = Table(report_info_data, colWidths=[2*inch, 4*inch])
+    report_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+        ('LINEBELOW', (0, -1), (-1, -1), 1, colors.HexColor('#CCCCCC'))
+    ]))
+    story.append(report_table)
+    story.append(Spacer(1, 16))
+    
+    # Patient Information Section
+    story.append(Paragraph("PATIENT INFORMATION", section_heading_style))
+    
+    patient_data = [
+        ['Patient Name:', patient_info.get('name', 'Not Provided')],
+        ['Patient ID:', patient_info.get('patient_id', 'Not Assigned')],
+        ['Age:', f"{patient_info.get('age', 'Not Provided')} years" if patient_info.get('age') else 'Not Provided'],
+        ['Gender:', patient_info.get('gender', 'Not Specified')],
+        ['Date of Examination:', patient_info.get('scan_date', 'Not Specified')],
+        ['Referring Physician:', patient_info.get('physician', 'Not Specified')],
+        ['Examination Type:', 'Thyroid Ultrasound Analysis']
+    ]
+    
+    patient_table = Table(patient_data, colWidths=[2*inch, 4*inch])
+    patient_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+        ('LINEBELOW', (0, -1), (-1, -1), 1, colors.HexColor('#CCCCCC'))
+    ]))
+    story.append(patient_table)
+    story.append(Spacer(1, 20))
+    
+    # Analysis Results Section
+    story.append(Paragraph("AI ANALYSIS RESULTS", section_heading_style))
+    
+    prediction = prediction_results['prediction']
+    confidence = prediction_results['confidence']
+    
+    # Main prediction result
+    if prediction.lower() == 'benign':
+        result_color = colors.HexColor('#228B22')
+        result_text = "BENIGN (NON-CANCEROUS)"
+        predicted_conf = prediction_results['benign_conf']
+    else:
+        result_color = colors.HexColor('#DC143C')
+        result_text = "MALIGNANT (POTENTIALLY CANCEROUS)"
+        predicted_conf = prediction_results['malignant_conf']
+    
+    result_para = Paragraph(
+        f"<b>CLASSIFICATION:</b> {result_text}<br/><b>CONFIDENCE LEVEL:</b> {confidence:.1f}%",
+        ParagraphStyle('ResultPara', parent=normal_style, fontSize=12, 
+                      textColor=result_color, spaceAfter=10, fontName='Helvetica-Bold')
+    )
+    story.append(result_para)
+    story.append(Spacer(1, 10))
+    
+    # Single prediction confidence table (only showing predicted class)
+    confidence_data = [
+        ['Classification Category', 'Probability', 'Confidence Level', 'Clinical Interpretation'],
+        [result_text, f"{predicted_conf:.2f}%", 
+         get_confidence_level(predicted_conf), 
+         'Further evaluation recommended' if prediction.lower() == 'malignant' else 'Routine monitoring may be sufficient']
+    ]
+    
+    confidence_table = Table(confidence_data, colWidths=[2*inch, 1.2*inch, 1.3*inch, 2.5*inch])
+    confidence_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#F0F0F0')),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#CCCCCC')),
+        ('LEFTPADDING', (0, 0), (-1, -1), 4),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 4),
+        ('TOPPADDING', (0, 0), (-1, -1), 6),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 6)
+    ]))
+    story.append(confidence_table)
+    story.append(Spacer(1, 16))
+    
+    # Technical Analysis Section
+    story.append(Paragraph("TECHNICAL ANALYSIS DETAILS", section_heading_style))
+    
+    technical_data = [
+        ['Model Architecture:', 'Convolutional Neural Network (CNN)'],
+        ['Input Preprocessing:', 'Image resized to 128x128 pixels, normalized to [0,1] range'],
+        ['Feature Extraction:', 'Multi-layer convolutional feature extraction'],
+        ['Classification Method:', 'Binary classification with softmax activation'],
+        ['Training Dataset:', 'Thousands of validated thyroid ultrasound images'],
+        ['Model Performance:', 'Optimized for medical image analysis'],
+        ['Processing Time:', 'Real-time analysis (< 2 seconds)']
+    ]
+    if prediction_results.get('calibration'):
+        technical_data.append(['Confidence Calibration:', prediction_results['calibration']])
+    
+    tech_table = Table(technical_data, colWidths=[2*inch, 4*inch])
+    tech_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+    ]))
+    story.append(tech_table)
+    story.append(Spacer(1, 16))
+    
+    # Clinical Interpretation
+    story.append(Paragraph("CLINICAL INTERPRETATION", section_heading_style))
+    
+    if confidence >= 90:
+        interpretation = "High Confidence Prediction (≥90%): The AI model demonstrates strong certainty in this classification. The extracted features strongly align with the predicted category. This level of confidence suggests a reliable preliminary assessment, though clinical correlation remains essential."
+    elif confidence >= 70:
+        interpretation = "Moderate Confidence Prediction (70-89%): The AI model shows reasonable certainty in this classification. While the prediction is reliable, additional clinical evaluation and possibly alternative imaging modalities may provide valuable complementary information."
+    else:
+        interpretation = "Low Confidence Prediction (<70%): The AI model shows uncertainty in this classification. This may be due to image quality, atypical features, or borderline characteristics. Strong recommendation for additional clinical evaluation and expert consultation."
+    
+    story.append(Paragraph(interpretation, normal_style))
+    story.append(Spacer(1, 16))
+    
+    # Clinical Recommendations
+    story.append(Paragraph("CLINICAL RECOMMENDATIONS", section_heading_style))
+    
+    if prediction.lower() == 'benign' and confidence >= 80:
+        recommendations = [
+            "Continue routine clinical monitoring as per institutional guidelines",
+            "Schedule follow-up ultrasound imaging at appropriate intervals", 
+            "Patient counseling regarding benign nature of findings",
+            "Document findings in patient medical record",
+            "Consider discharge to primary care for ongoing monitoring"
+        ]
+    elif prediction.lower() == 'malignant' or confidence < 70:
+        recommendations = [
+            "URGENT: Immediate specialist endocrinology consultation",
+            "Consider fine needle aspiration (FNA) biopsy",
+            "Evaluate for additional imaging studies (CT, MRI if indicated)",
+            "Multidisciplinary team discussion recommended",
+            "Patient counseling regarding findings and next steps",
+            "Expedited scheduling for follow-up procedures"
+        ]
+    else:
+        recommendations = [
+            "Clinical correlation with patient history and physical examination",
+            "Follow institutional protocols for thyroid nodule management",
+            "Consider repeat imaging if clinically indicated",
+            "Specialist consultation may be beneficial",
+            "Document findings and recommendations clearly"
+        ]
+    
+    for i, rec in enumerate(recommendations, 1):
+        story.append(Paragraph(f"{i}. {rec}", normal_style))
+        story.append(Spacer(1, 3))
+    
+    story.append(Spacer(1, 16))
+    
+    # Quality Assurance
+    story.append(Paragraph("QUALITY ASSURANCE", section_heading_style))
+    
+    qa_data = [
+        ['Image Quality Assessment:', 'Processed successfully'],
+        ['Model Validation:', 'Algorithm functioning within normal parameters'],
+        ['Processing Verification:', 'All preprocessing steps completed successfully'],
+        ['Output Validation:', 'Results within expected confidence ranges'],
+        ['System Check:', 'All diagnostic modules operational'],
+        ['Report Generation:', datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+    ]
+    
+    qa_table = Table(qa_data, colWidths=[2*inch, 4*inch])
+    qa_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+    ]))
+    story.append(qa_table)
+    story.append(Spacer(1, 20))
+    
+    # Page break before disclaimer
+    story.append(PageBreak())
+    
+    # Medical Disclaimer
+    story.append(Paragraph("IMPORTANT MEDICAL DISCLAIMER", 
+                          ParagraphStyle('DisclaimerTitle', parent=section_heading_style,
+                                       fontSize=16, textColor=colors.HexColor('#DC143C'),
+                                       alignment=TA_CENTER, spaceAfter=12)))
+    
+    disclaimer_text = """
+CRITICAL NOTICE - PLEASE READ CAREFULLY:
+
+1. RESEARCH AND EDUCATIONAL PURPOSE ONLY: This AI-generated analysis is developed and provided exclusively for research, educational, and academic purposes. It is NOT intended for clinical decision-making in patient care.
+
+2. NOT A SUBSTITUTE FOR PROFESSIONAL MEDICAL JUDGMENT: This report does NOT replace professional medical diagnosis, clinical judgment, or expert radiological interpretation. All findings must be evaluated by qualified healthcare professionals.
+
+3. LIMITATIONS OF AI ANALYSIS: Artificial intelligence models have inherent limitations and may not detect all pathological conditions. False positives and false negatives are possible. Image quality, patient factors, and technical limitations can affect results.
+
+4. CLINICAL CORRELATION ESSENTIAL: Results must be interpreted in conjunction with complete clinical history, physical examination, laboratory findings, and other diagnostic information.
+
+5. REGULATORY STATUS: This AI system is not FDA-approved for clinical diagnostic use. It is an investigational tool for research purposes only.
+
+6. LIABILITY LIMITATION: The developers, institution, and associated personnel assume no responsibility for clinical decisions based on this analysis. Users assume full responsibility for appropriate use and interpretation.
+
+7. DATA PRIVACY: Ensure patient data is handled in compliance with applicable privacy laws and institutional policies.
+    """
+    
+    disclaimer_style = ParagraphStyle(
+        'DisclaimerStyle',
+        parent=normal_style,
+        fontSize=9,
+        alignment=TA_JUSTIFY,
+        spaceAfter=4,
+        spaceBefore=4
+    )
+    
+    story.append(Paragraph(disclaimer_text, disclaimer_style))
+    story.append(Spacer(1, 20))
+    
+    
+    # Build PDF
+    doc.build(story)
+    buffer.seek(0)
+    return buffer
+
+def get_confidence_level(confidence):
+    """Get confidence level description"""
+    if confidence >= 90:
+        return "Very High"
+    elif confidence >= 80:
+        return "High"
+    elif confidence >= 70:
+        return "Moderate"
+    elif confidence >= 60:
+        return "Fair"
+    else:
+        return "Low"
@@ -0,0 +1,187 @@
+"""Per-interaction rerun cost of the Streamlit page.
+
+Usage:
+    python rerun_benchmark.py IMAGE [IMAGE ...] [--baseline-rev HEAD~1] [--repeat 5] [--output rerun.json]
+
+Drives ``streamlit_app.py`` headlessly with Streamlit's ``AppTest``: uploads the
+images, waits for the analysis, then times typical edits (patient name, ID,
+age, clinical notes, opening the digital report). Widgets that live in an
+``st.fragment`` are timed with a fragment-scoped rerun, exactly what the
+browser triggers; everything else is a full script rerun. With
+``--baseline-rev`` the same interactions are timed against the app script from
+that git revision, giving before/after numbers.
+
+Two numbers are reported per interaction: ``app_ms`` is the time the app
+itself spent (from the ``script_run`` / ``fragment_*`` metrics the page
+records) and ``wall_ms`` adds AppTest's own per-run overhead, which includes
+recompiling the script on every run.
+
+Fragment reruns go through private ``AppTest`` internals, so the script is
+pinned to the Streamlit version in ``requirements.txt`` and stops with a clear
+message when those internals are missing.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import metrics
+
+APP_SCRIPT = 'streamlit_app.py'
+RUN_TIMEOUT = 120
+# The AppTest internals used below were read from this release (pinned in requirements.txt)
+STREAMLIT_VERSION = '1.66.0'
+
+
+def _unsupported(what):
+    """Stop with a message naming the Streamlit internal that is missing"""
+    import streamlit
+    return SystemExit(f"rerun_benchmark.py relies on {what}, which Streamlit {streamlit.__version__} does not "
+                      f"provide; install streamlit=={STREAMLIT_VERSION} (see requirements.txt)")
+
+
+def _interactions():
+    """(name, fragment function the widget lives in, action) for each timed edit"""
+    def widget(kind, label):
+        def find(at):
+            for w in getattr(at, kind):
+                if label in w.label:
+                    return w
+            raise SystemExit(f"No {kind} labelled {label!r} on the page; the app layout changed")
+        return find
+
+    return [
+        ('patient_name', 'patient_report_section', lambda at, i: widget('text_input', 'Patient Name')(at).set_value(f"Patient {i}")),
+        ('patient_id', 'patient_report_section', lambda at, i: widget('text_input', 'Patient ID')(at).set_value(f"MRN-{i}")),
+        ('patient_age', 'patient_report_section', lambda at, i: widget('number_input', 'Age')(at).set_value(30 + i)),
+        ('clinical_notes', 'patient_report_section', lambda at, i: widget('text_area', 'Clinical Notes')(at).set_value(f"Note {i}")),
+        ('open_digital_report', 'digital_report_preview', lambda at, i: widget('button', 'Open Full Digital Report')(at).click()),
+    ]
+
+
+def _fragment_ids(at):
+    """Map fragment function name -> fragment ID registered during the last full run.
+
+    AppTest has no public API for fragment reruns, so this reads its fragment
+    storage and the name of the function each wrapped fragment closes over.
+    """
+    fragments = getattr(getattr(at, '_fragment_storage', None), '_fragments', None)
+    if not isinstance(fragments, dict):
+        raise _unsupported("AppTest._fragment_storage._fragments")
+    ids = {}
+    for fragment_id, wrapped in fragments.items():
+        for cell in getattr(wrapped, '__closure__', None) or ():
+            name = getattr(cell.cell_contents, '__name__', None)
+            if isinstance(name, str) and callable(cell.cell_contents):
+                ids[name] = fragment_id
+    if fragments and not ids:
+        raise _unsupported("fragment wrappers that close over the decorated function")
+    return ids
+
+
+def _run(at, fragment_id=None, stage='script_run'):
+    """Rerun the app (or only one fragment); returns (wall ms, ms the app recorded for stage)"""
+    from streamlit.testing.v1 import local_script_runner
+
+    before = metrics.stage_summary().get(stage, {}).get('count', 0)
+    start = time.perf_counter()
+    if fragment_id is None:
+        at.run(timeout=RUN_TIMEOUT)
+    else:
+        rerun_data = local_script_runner.RerunData
+        with mock.patch.object(local_script_runner, 'RerunData',
+                               lambda **kwargs: rerun_data(fragment_id_queue=[fragment_id], **kwargs)):
+            at.run(timeout=RUN_TIMEOUT)
+    wall_ms = (time.perf_counter() - start) * 1000
+    # Scripts without the metric (e.g. an old baseline) fall back to wall time
+    if metrics.stage_summary().get(stage, {}).get('count', 0) == before:
+        return wall_ms, wall_ms
+    return wall_ms, metrics.last_observation(stage) * 1000
+
+
+def measure_script(script_path, images, repeat):
+    """Time every interaction against one app script; returns a JSON-able dict"""
+    import dataclasses
+    from streamlit.testing.v1 import AppTest, local_script_runner
+
+    rerun_data = getattr(local_script_runner, 'RerunData', None)
+    if not dataclasses.is_dataclass(rerun_data) or \
+            'fragment_id_queue' not in {field.name for field in dataclasses.fields(rerun_data)}:
+        raise _unsupported("local_script_runner.RerunData(fragment_id_queue=...)")
+    at = AppTest.from_file(os.path.abspath(script_path), default_timeout=RUN_TIMEOUT)
+    cold_ms = _run(at)[0]
+    uploader = at.file_uploader[0]
+    files = [(os.path.basename(path), open(path, 'rb').read(), 'image/jpeg') for path in images]
+    if uploader.accept_multiple_files:
+        uploader.set_value(files)
+    else:
+        uploader.upload(*files[0])
+    analysis_ms = _run(at)[0]
+    if at.exception:
+        raise SystemExit(f"{script_path} raised: {at.exception[0].value}")
+    full_rerun_ms = [_run(at)[1] for _ in range(repeat)]
+
+    fragments = _fragment_ids(at)
+    results = {}
+    for name, fragment, action in _interactions():
+        fragment_id = fragments.get(fragment)
+        stage = f"fragment_{fragment}" if fragment_id else 'script_run'
+        wall, app = [], []
+        for i in range(repeat):
+            # A full run first re-registers the fragments and resets button state
+            _run(at)
+            action(at, i)
+            wall_ms, app_ms = _run(at, fragment_id, stage)
+            wall.append(wall_ms)
+            app.append(app_ms)
+        results[name] = {'scope': 'fragment' if fragment_id else 'full',
+                         'app_ms': statistics.median(app), 'wall_ms': statistics.median(wall)}
+    return {
+        'script': script_path,
+        'cold_start_ms': cold_ms,
+        'analysis_ms': analysis_ms,
+        'full_rerun_median_ms': statistics.median(full_rerun_ms),
+        'interactions': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure Streamlit rerun cost per interaction")
+    parser.add_argument("images", nargs="+", help="Ultrasound image(s) to upload before timing")
+    parser.add_argument("--script", default=APP_SCRIPT, help="App script to measure")
+    parser.add_argument("--baseline-rev", default=None, help="Also measure the app script at this git revision")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per interaction")
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    args = parser.parse_args(argv)
+
+    runs = {}
+    if args.baseline_rev:
+        # Written next to the current script so it imports the same local modules
+        baseline_path = os.path.join(os.path.dirname(os.path.abspath(args.script)), f".rerun_baseline_{APP_SCRIPT}")
+        source = subprocess.run(["git", "show", f"{args.baseline_rev}:{APP_SCRIPT}"],
+                                check=True, capture_output=True).stdout
+        with open(baseline_path, 'wb') as f:
+            f.write(source)
+        try:
+            runs['baseline'] = measure_script(baseline_path, args.images, args.repeat)
+            runs['baseline']['revision'] = args.baseline_rev
+        finally:
+            os.remove(baseline_path)
+    runs['current'] = measure_script(args.script, args.images, args.repeat)
+
+    print(f"{'interaction':<22}" + "".join(f"{name:>22}" for name in runs), file=sys.stderr)
+    for interaction in runs['current']['interactions']:
+        cells = [f"{r['interactions'][interaction]['app_ms']:9.1f} ms ({r['interactions'][interaction]['scope']})"
+                 for r in runs.values()]
+        print(f"{interaction:<22}" + "".join(f"{cell:>22}" for cell in cells), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Persistent prediction store shared by all sessions and worker processes on a node.
+
+Results are keyed by (image SHA-256, model fingerprint), so the same study
+re-uploaded by another clinician, after a reconnect or after a restart is served
+from disk instead of being re-inferred. Backed by SQLite in WAL mode: readers
+never block the writer, and every process on the node can open the same file.
+
+The same database keeps the metadata of every generated report for the study
+history page. History queries use keyset pagination on indexed columns, so a
+page costs the same at row 10 as at row 500,000.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+RESULT_STORE_PATH = os.environ.get('THYROID_RESULT_STORE', 'thyroid_results.db')
+# Same buckets as get_confidence_level() in report_pdf.py
+CONFIDENCE_LEVELS = ('Very High', 'High', 'Moderate', 'Fair', 'Low')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    image_hash TEXT NOT NULL,
+    model_fingerprint TEXT NOT NULL,
+    label TEXT NOT NULL,
+    probabilities TEXT NOT NULL,
+    timings TEXT NOT NULL DEFAULT '{}',
+    report_ids TEXT NOT NULL DEFAULT '[]',
+    patient_id TEXT,
+    scan_date TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (image_hash, model_fingerprint)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_predictions_patient ON predictions (patient_id, scan_date);
+CREATE INDEX IF NOT EXISTS idx_predictions_scan_date ON predictions (scan_date);
+
+CREATE TABLE IF NOT EXISTS reports (
+    report_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    scan_date TEXT NOT NULL,
+    physician TEXT,
+    prediction TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    confidence_level TEXT NOT NULL,
+    pdf_path TEXT,
+    model_fingerprint TEXT,
+    image_count INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+-- Every index ends in (scan_date, report_id) to match the history page ordering
+CREATE INDEX IF NOT EXISTS idx_reports_date ON reports (scan_date, report_id);
+CREATE INDEX IF NOT EXISTS idx_reports_patient ON reports (patient_id, scan_date, report_id);
+CREATE INDEX IF NOT EXISTS idx_reports_level ON reports (confidence_level, scan_date, report_id);
+"""
+
+
+def connect(path):
+    """Open a SQLite connection tuned for many concurrent readers and one writer"""
+    conn = sqlite3.connect(path, timeout=10.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+class ResultStore:
+    """Key-value style access to cached predictions"""
+
+    def __init__(self, path=RESULT_STORE_PATH):
+        self.path = path
+        # sqlite3 connections must stay on the thread that created them
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    @staticmethod
+    def _row_to_record(row):
+        return {
+            'image_hash': row[0],
+            'model_fingerprint': row[1],
+            'label': row[2],
+            'probabilities': json.loads(row[3]),
+            'timings': json.loads(row[4]),
+            'report_ids': json.loads(row[5]),
+            'patient_id': row[6],
+            'scan_date': row[7],
+            'created_at': row[8],
+        }
+
+    def get(self, image_hash, model_fingerprint):
+        """Return the stored record for one image, or None"""
+        return self.get_many([image_hash], model_fingerprint).get(image_hash)
+
+    def get_many(self, image_hashes, model_fingerprint):
+        """Return {image_hash: record} for every hash that is already stored"""
+        if not image_hashes:
+            return {}
+        placeholders = ",".join("?" * len(image_hashes))
+        rows = self._conn().execute(
+            f"SELECT image_hash, model_fingerprint, label, probabilities, timings, report_ids, "
+            f"patient_id, scan_date, created_at FROM predictions "
+            f"WHERE model_fingerprint = ? AND image_hash IN ({placeholders})",
+            [model_fingerprint, *image_hashes]
+        ).fetchall()
+        return {row[0]: self._row_to_record(row) for row in rows}
+
+    def put_many(self, records, model_fingerprint):
+        """Insert or refresh predictions; each record has image_hash, label, probabilities and timings"""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO predictions (image_hash, model_fingerprint, label, probabilities, timings, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (image_hash, model_fingerprint) DO UPDATE SET "
+                "label = excluded.label, probabilities = excluded.probabilities, timings = excluded.timings",
+                [
+                    (r['image_hash'], model_fingerprint, str(r['label']),
+                     json.dumps([float(p) for p in r['probabilities']]),
+                     json.dumps(r.get('timings', {})), now)
+                    for r in records
+                ]
+            )
+
+    def attach_report(self, image_hashes, model_fingerprint, report_id, patient_id=None, scan_date=None):
+        """Record that a report was generated for these images"""
+        conn = self._conn()
+        with conn:
+            for image_hash in image_hashes:
+                row = conn.execute(
+                    "SELECT report_ids FROM predictions WHERE image_hash = ? AND model_fingerprint = ?",
+                    (image_hash, model_fingerprint)
+                ).fetchone()
+                if row is None:
+                    continue
+                report_ids = json.loads(row[0])
+                if report_id not in report_ids:
+                    report_ids.append(report_id)
+                conn.execute(
+                    "UPDATE predictions SET report_ids = ?, patient_id = COALESCE(?, patient_id), "
+                    "scan_date = COALESCE(?, scan_date) WHERE image_hash = ? AND model_fingerprint = ?",
+                    (json.dumps(report_ids), patient_id, scan_date, image_hash, model_fingerprint)
+                )
+
+    def find_by_patient(self, patient_id, limit=100):
+        """Most recent predictions for a patient, newest scan first"""
+        rows = self._conn().execute(
+            "SELECT image_hash, model_fingerprint, label, probabilities, timings, report_ids, "
+            "patient_id, scan_date, created_at FROM predictions "
+            "WHERE patient_id = ? ORDER BY scan_date DESC LIMIT ?",
+            (patient_id, limit)
+        ).fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    # --------------------------
+    # Report history
+    # --------------------------
+    def add_report(self, report):
+        """Store the metadata of one generated report"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reports (report_id, patient_id, scan_date, physician, prediction, confidence, "
+                "confidence_level, pdf_path, model_fingerprint, image_count, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (report['report_id'], report.get('patient_id'), report['scan_date'], report.get('physician'),
+                 report['prediction'], float(report['confidence']), report['confidence_level'],
+                 report.get('pdf_path'), report.get('model_fingerprint'), int(report.get('image_count', 1)),
+                 time.time())
+            )
+
+    @staticmethod
+    def _report_filters(patient_id=None, date_from=None, date_to=None, confidence_levels=None):
+        clauses, params = [], []
+        if patient_id:
+            clauses.append("patient_id = ?")
+            params.append(patient_id)
+        if date_from:
+            clauses.append("scan_date >= ?")
+            params.append(str(date_from))
+        if date_to:
+            clauses.append("scan_date <= ?")
+            params.append(str(date_to))
+        if confidence_levels:
+            clauses.append(f"confidence_level IN ({','.join('?' * len(confidence_levels))})")
+            params.extend(confidence_levels)
+        return clauses, params
+
+    def query_reports(self, patient_id=None, date_from=None, date_to=None, confidence_levels=None,
+                      page_size=25, after=None):
+        """Return (rows, next_cursor) for one page, newest scan first.
+
+        ``after`` is the cursor returned for the previous page; None starts at the top.
+        """
+        clauses, params = self._report_filters(patient_id, date_from, date_to, confidence_levels)
+        if after is not None:
+            clauses.append("(scan_date, report_id) < (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._conn().execute(
+            f"SELECT report_id, patient_id, scan_date, physician, prediction, confidence, confidence_level, "
+            f"pdf_path, image_count, created_at FROM reports {where} "
+            f"ORDER BY scan_date DESC, report_id DESC LIMIT ?",
+            [*params, page_size + 1]
+        ).fetchall()
+        columns = ('report_id', 'patient_id', 'scan_date', 'physician', 'prediction', 'confidence',
+                   'confidence_level', 'pdf_path', 'image_count', 'created_at')
+        records = [dict(zip(columns, row)) for row in rows[:page_size]]
+        next_cursor = (records[-1]['scan_date'], records[-1]['report_id']) if len(rows) > page_size else None
+        return records, next_cursor
+
+    def count_reports(self, patient_id=None, date_from=None, date_to=None, confidence_levels=None):
+        """Number of reports matching the filters (answered from the covering indexes)"""
+        clauses, params = self._report_filters(patient_id, date_from, date_to, confidence_levels)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self._conn().execute(f"SELECT COUNT(*) FROM reports {where}", params).fetchone()[0]
@@ -0,0 +1,209 @@
+"""Region-of-interest cropping and tiled inference.
+
+Usage:
+    python roi.py IMAGE [IMAGE ...] [--mode tiles] [--output roi.json]
+
+Squashing a whole export to 128×128 spends most of the model input on black
+borders, side panels and text. With ``THYROID_ROI_MODE=crop`` the active scan
+area is found first and only that is resized for the model; ``tiles`` also
+cuts the region into overlapping squares (each ``THYROID_ROI_TILE_FRACTION``
+of its short side, overlapping by ``THYROID_ROI_TILE_OVERLAP``) so a small
+nodule is seen at a higher resolution. The region row and all tiles of all
+images go to the model in one batch; per image they are combined with
+``THYROID_ROI_AGGREGATE`` and the tile with the highest malignant probability
+is reported with its location.
+
+The region is detected on a copy box-reduced to about 256 px: pixels that are neither
+near-black nor chromatic (colour overlays, Doppler scales) count as content,
+and the longest run of rows and of columns with enough content bounds the scan
+area. Thin text lines and calipers in the margins do not reach that density.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import pipeline
+
+ROI_MODES = ('off', 'crop', 'tiles')
+ROI_MODE = os.environ.get('THYROID_ROI_MODE', 'off').lower()
+# An unknown mode would otherwise run whole frames under a fingerprint of its own
+if ROI_MODE not in ROI_MODES:
+    raise ValueError(f"Unknown THYROID_ROI_MODE {ROI_MODE!r}; choose one of {', '.join(ROI_MODES)}")
+TILE_FRACTION = float(os.environ.get('THYROID_ROI_TILE_FRACTION', '0.5'))
+TILE_OVERLAP = float(os.environ.get('THYROID_ROI_TILE_OVERLAP', '0.5'))
+# How the region row and its tiles are combined (see pipeline.AGGREGATE_METHODS)
+ROI_AGGREGATE = os.environ.get('THYROID_ROI_AGGREGATE', 'mean')
+
+DETECT_SIDE = 256          # longest side of the copy the region is detected on
+CONTENT_LEVEL = 12         # grey level above which a pixel is scan content
+CHROMA_LEVEL = 30          # max - min channel difference of an overlay pixel
+MIN_DENSITY = 0.25         # share of the densest row/column's content a row/column needs
+MIN_REGION_FRACTION = 0.2  # smaller detections are ignored and the whole frame is used
+
+
+def roi_fingerprint(model_fingerprint, mode=ROI_MODE):
+    """Results of ROI inference are stored apart from whole-frame results of the same model"""
+    if mode == 'off':
+        return model_fingerprint
+    settings = f"{model_fingerprint}|roi:{mode}:{TILE_FRACTION}:{TILE_OVERLAP}:{ROI_AGGREGATE}"
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+
+# --------------------------
+# Region detection
+# --------------------------
+def _longest_run(mask):
+    """(start, stop) of the longest run of True values, or None"""
+    padded = np.concatenate([[False], mask, [False]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    if not edges.size:
+        return None
+    starts, stops = edges[::2], edges[1::2]
+    longest = int(np.argmax(stops - starts))
+    return int(starts[longest]), int(stops[longest])
+
+
+def active_region(img):
+    """(left, top, right, bottom) of the scan area in img's pixel coordinates"""
+    width, height = img.size
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGB')
+    # An integer box reduction is several times cheaper than a filtered resize
+    small = img.reduce(max(1, max(width, height) // DETECT_SIDE)).convert('RGB')
+    scale = small.size[0] / width
+    pixels = np.asarray(small)
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    brightest = np.maximum(np.maximum(red, green), blue)
+    chroma = brightest - np.minimum(np.minimum(red, green), blue)
+    content = (brightest > CONTENT_LEVEL) & (chroma <= CHROMA_LEVEL)
+
+    rows, cols = content.mean(axis=1), content.mean(axis=0)
+    row_run = _longest_run(rows >= MIN_DENSITY * rows.max()) if rows.max() > 0 else None
+    col_run = _longest_run(cols >= MIN_DENSITY * cols.max()) if cols.max() > 0 else None
+    if row_run is None or col_run is None:
+        return 0, 0, width, height
+    (top, bottom), (left, right) = row_run, col_run
+    if (bottom - top) * (right - left) < MIN_REGION_FRACTION * content.size:
+        return 0, 0, width, height
+    return (int(left / scale), int(top / scale), min(width, int(np.ceil(right / scale))),
+            min(height, int(np.ceil(bottom / scale))))
+
+
+# --------------------------
+# Model inputs
+# --------------------------
+def _offsets(length, side, step):
+    """Tile start positions covering [0, length) with the last tile flush against the end"""
+    count = max(1, int(np.ceil((length - side) / step)) + 1)
+    return np.linspace(0, max(0, length - side), count).round().astype(int)
+
+
+def _tiles(region, tile_fraction, overlap):
+    """(uint8 region row and tiles, tile boxes in region coordinates) from one resize of the region"""
+    side_x, side_y = pipeline.IMAGE_SIZE
+    width, height = region.size
+    # Scale the region once so a tile is exactly model-sized; tiles are then plain array slices
+    scale = side_x / max(1.0, min(width, height) * tile_fraction)
+    size = (max(side_x, round(width * scale)), max(side_y, round(height * scale)))
+    pixels = np.asarray(region.resize(size, reducing_gap=2.0))[..., :3]
+    xs = _offsets(size[0], side_x, side_x * (1 - overlap))
+    ys = _offsets(size[1], side_y, side_y * (1 - overlap))
+    # The whole-region row is taken from the already reduced copy as well
+    rows = [np.asarray(Image.fromarray(pixels).resize(pipeline.IMAGE_SIZE))]
+    rows += [pixels[y:y + side_y, x:x + side_x] for y in ys for x in xs]
+    boxes = [(x / scale, y / scale, (x + side_x) / scale, (y + side_y) / scale) for y in ys for x in xs]
+    return np.stack(rows), boxes
+
+
+def model_inputs(img, mode=ROI_MODE, tile_fraction=TILE_FRACTION, overlap=TILE_OVERLAP):
+    """(uint8 (k, 128, 128, 3) model inputs, region box, tile boxes) for one decoded image.
+
+    Row 0 is the whole region; tiles follow in ``tiles`` mode. Boxes are in
+    the original image's pixel coordinates (JPEGs may be decoded reduced).
+    """
+    box = active_region(img) if mode != 'off' else (0, 0, *img.size)
+    region = img.crop(box)
+    if region.mode not in ('RGB', 'RGBA'):
+        region = region.convert('RGB')
+    if mode == 'tiles':
+        rows, tile_boxes = _tiles(region, tile_fraction, overlap)
+    else:
+        rows, tile_boxes = pipeline.preprocess_pixels(region)[None], []
+    original_width, original_height = img.info.get('original_size', img.size)
+    sx, sy = original_width / img.size[0], original_height / img.size[1]
+
+    def to_original(b, dx=0, dy=0):
+        return [round((b[0] + dx) * sx), round((b[1] + dy) * sy), round((b[2] + dx) * sx), round((b[3] + dy) * sy)]
+
+    return rows, to_original(box), [to_original(b, box[0], box[1]) for b in tile_boxes]
+
+
+def combine(probabilities, tile_boxes, method=ROI_AGGREGATE, malignant_index=1):
+    """(image probability row, most suspicious tile or None) from the k rows of one image"""
+    row = pipeline.aggregate_predictions(probabilities, method, malignant_index)
+    if not tile_boxes:
+        return row, None
+    peak = int(np.argmax(probabilities[1:, malignant_index]))
+    return row, {'box': tile_boxes[peak], 'probabilities': [float(p) for p in probabilities[1 + peak]]}
+
+
+def classify_images(model, images, mode=ROI_MODE, method=ROI_AGGREGATE, malignant_index=1):
+    """ROI inference for several decoded images in one predict call; returns one result dict per image"""
+    inputs = [model_inputs(img, mode) for img in images]
+    counts = [len(rows) for rows, _, _ in inputs]
+    batch = pipeline.normalize_pixels(np.concatenate([rows for rows, _, _ in inputs]))
+    probabilities = np.asarray(model.predict(batch, batch_size=len(batch), verbose=0))
+    results, offset = [], 0
+    for (_, box, tile_boxes), count in zip(inputs, counts):
+        row, peak = combine(probabilities[offset:offset + count], tile_boxes, method, malignant_index)
+        results.append({'probabilities': row, 'region': box, 'tiles': len(tile_boxes), 'peak_tile': peak})
+        offset += count
+    return results
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify images on their detected scan region and tiles")
+    parser.add_argument("images", nargs="+", help="Ultrasound image(s)")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--encoder", default=pipeline.LABEL_ENCODER_PATH, help="Path to the label encoder pickle")
+    parser.add_argument("--mode", choices=ROI_MODES, default=ROI_MODE if ROI_MODE != 'off' else 'tiles',
+                        help="Whole frame, detected region only, or region plus tiles")
+    parser.add_argument("--aggregate", choices=pipeline.AGGREGATE_METHODS, default=ROI_AGGREGATE,
+                        help="How the region and tile results are combined")
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    args = parser.parse_args(argv)
+
+    model = pipeline.load_model(args.model)
+    class_map = pipeline.load_class_map(args.encoder)
+    class_map.check_model(model)
+    images = [pipeline.decode_image(path) for path in args.images]
+    start = time.perf_counter()
+    results = classify_images(model, images, args.mode, args.aggregate, class_map.malignant_index)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    for path, result in zip(args.images, results):
+        row = result['probabilities']
+        line = f"{path}: {class_map.label(row).upper()} ({float(row.max()):.1%}), region {result['region']}"
+        if result['peak_tile']:
+            line += (f", most suspicious of {result['tiles']} tiles at {result['peak_tile']['box']} "
+                     f"({float(class_map.malignant(result['peak_tile']['probabilities'])):.1%} malignant)")
+        print(line, file=sys.stderr)
+        result['image'] = path
+        result['prediction'] = str(class_map.label(row))
+        result['probabilities'] = row.tolist()
+    print(f"{len(images)} image(s) in {elapsed_ms:.0f} ms", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
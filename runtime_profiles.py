@@ -0,0 +1,290 @@
+"""Named TensorFlow runtime profiles for CPU inference, and an autotuner that picks one per host.
+
+Usage:
+    python runtime_profiles.py list
+    python runtime_profiles.py autotune [--data DATA_DIR] [--objective latency] [--output runtime_profile.json]
+
+``THYROID_RUNTIME_PROFILE`` is applied whenever ``pipeline.load_model`` loads
+a model:
+
+* ``default``: TensorFlow's own choices (every thread pool sized to all cores)
+* ``latency``: all cores work on one request (intra-op = cores, inter-op = 1)
+* ``throughput``: XLA-compiled predict, intra-op = cores, inter-op = 2
+* ``shared-node``: a fair core share per replica (intra-op = cores //
+  ``THYROID_RUNTIME_REPLICAS``, inter-op = 1), so replicas do not oversubscribe
+* ``auto``: the profile and precision ``autotune`` chose for this host
+  (``THYROID_RUNTIME_PROFILE_FILE``)
+
+``THYROID_RUNTIME_PRECISION=bfloat16`` additionally runs every layer but the
+output layer in ``mixed_bfloat16`` on CPUs with AVX512-BF16 or AMX (weights
+and probabilities stay float32). Results computed in bfloat16 are stored
+under their own model fingerprint.
+
+Thread pools can only be sized before TensorFlow runs its first op, so they
+are set at the first model load of a process, and only if nothing sized them
+earlier (the inference pool workers split cores themselves). ``autotune``
+benchmarks every profile and precision in a fresh process, skips bfloat16 if
+its labels differ from float32 or its probabilities by more than
+``BF16_TOLERANCE``, and writes the winner for ``auto``.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+
+import pipeline
+
+PROFILES = ('default', 'latency', 'throughput', 'shared-node')
+PRECISIONS = ('float32', 'bfloat16')
+RUNTIME_PROFILE = os.environ.get('THYROID_RUNTIME_PROFILE', 'default').lower()
+RUNTIME_PRECISION = os.environ.get('THYROID_RUNTIME_PRECISION', 'float32').lower()
+# Replicas sharing this node's cores under the shared-node profile
+RUNTIME_REPLICAS = int(os.environ.get('THYROID_RUNTIME_REPLICAS', '2'))
+RUNTIME_PROFILE_PATH = os.environ.get('THYROID_RUNTIME_PROFILE_FILE', 'runtime_profile.json')
+# Largest probability difference from float32 that autotune accepts for bfloat16
+BF16_TOLERANCE = 0.02
+OBJECTIVES = ('latency', 'throughput')
+
+
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+
+def profile_settings(name, cores=None, replicas=RUNTIME_REPLICAS):
+    """Thread pool sizes (None = TensorFlow's default) and XLA flag of a named profile"""
+    cores = cores or available_cores()
+    if name == 'default':
+        return {'intra_op_threads': None, 'inter_op_threads': None, 'jit_compile': False}
+    if name == 'latency':
+        return {'intra_op_threads': cores, 'inter_op_threads': 1, 'jit_compile': False}
+    if name == 'throughput':
+        return {'intra_op_threads': cores, 'inter_op_threads': 2, 'jit_compile': True}
+    if name == 'shared-node':
+        return {'intra_op_threads': max(1, cores // max(1, replicas)), 'inter_op_threads': 1, 'jit_compile': False}
+    raise ValueError(f"Unknown runtime profile {name!r}; choose one of {', '.join(PROFILES + ('auto',))}")
+
+
+def bf16_supported():
+    """True on CPUs with native bfloat16 math (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = set(next((line for line in f if line.startswith('flags')), '').split())
+    except OSError:
+        return False
+    return bool(flags & {'avx512_bf16', 'amx_bf16'})
+
+
+def resolve(name=RUNTIME_PROFILE, precision=RUNTIME_PRECISION, path=RUNTIME_PROFILE_PATH):
+    """(profile, precision) to run with; 'auto' reads the autotune result"""
+    if name == 'auto':
+        try:
+            with open(path) as f:
+                chosen = json.load(f)['chosen']
+            name, precision = chosen['profile'], chosen['precision']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"No usable autotune result in {path} ({e}); using the default runtime profile", file=sys.stderr)
+            return 'default', 'float32'
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}; choose one of {', '.join(PRECISIONS)}")
+    if precision == 'bfloat16' and not bf16_supported():
+        print("This CPU has no native bfloat16 support; running in float32", file=sys.stderr)
+        precision = 'float32'
+    return name, precision
+
+
+def runtime_fingerprint(model_fingerprint, precision=None):
+    """Results computed in bfloat16 are stored apart from float32 results of the same model"""
+    precision = precision or resolve()[1]
+    if precision == 'float32':
+        return model_fingerprint
+    return hashlib.sha256(f"{model_fingerprint}|precision:{precision}".encode()).hexdigest()
+
+
+# --------------------------
+# Applying a profile
+# --------------------------
+def configure_process(name=RUNTIME_PROFILE):
+    """Size TensorFlow's thread pools for a profile, unless they are already fixed in this process"""
+    settings = profile_settings(resolve(name)[0])
+    threading = tf.config.threading
+    try:
+        if settings['intra_op_threads'] and not threading.get_intra_op_parallelism_threads():
+            threading.set_intra_op_parallelism_threads(settings['intra_op_threads'])
+        if settings['inter_op_threads'] and not threading.get_inter_op_parallelism_threads():
+            threading.set_inter_op_parallelism_threads(settings['inter_op_threads'])
+    except RuntimeError:
+        # TensorFlow already ran an op in this process; its pools can no longer change
+        pass
+
+
+def to_bfloat16(model):
+    """Copy of a float32 model computing in bfloat16; the output layer and all weights stay float32"""
+    output_layer = model.layers[-1]
+
+    def clone(layer):
+        config = layer.get_config()
+        if layer is not output_layer:
+            config['dtype'] = 'mixed_bfloat16'
+        return layer.__class__.from_config(config)
+
+    copy = tf.keras.models.clone_model(model, clone_function=clone)
+    copy.set_weights(model.get_weights())
+    return copy
+
+
+def configure_model(model, name=RUNTIME_PROFILE, precision=RUNTIME_PRECISION):
+    """Apply a profile's precision and XLA setting to a freshly loaded model; returns the model to use"""
+    name, precision = resolve(name, precision)
+    if precision == 'bfloat16':
+        model = to_bfloat16(model)
+    if profile_settings(name)['jit_compile']:
+        model.jit_compile = True
+        model.predict_function = None
+    return model
+
+
+# --------------------------
+# Autotune
+# --------------------------
+def _benchmark_inputs(data_dir, count):
+    if data_dir:
+        paths, _ = pipeline.collect_labelled_images(data_dir, pipeline.load_class_map().classes, count)
+        if paths:
+            batch = np.stack([pipeline.preprocess_pixels(pipeline.decode_image(path)) for path in paths])
+            return pipeline.normalize_pixels(np.resize(batch, (count, *batch.shape[1:])))
+    return np.random.default_rng(0).random((count, *pipeline.IMAGE_SIZE, 3), dtype=np.float32)
+
+
+def measure(model_path, data_dir=None, batch_size=32, repeats=30):
+    """Time the configured model in this process: batch-1 latency and batch throughput (plus its outputs).
+
+    Uses predict_on_batch, which runs the same (possibly XLA-compiled) predict
+    function as model.predict without its per-call data-adapter overhead; that
+    overhead is the same under every profile and would only add noise.
+    """
+    configure_process()
+    start = time.perf_counter()
+    model = pipeline.load_model(model_path)
+    load_s = time.perf_counter() - start
+    batch = _benchmark_inputs(data_dir, batch_size)
+    # The first calls trace (and with XLA compile) the predict function for both shapes
+    model.predict_on_batch(batch[:1])
+    model.predict_on_batch(batch)
+    single = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(batch[i % batch_size:i % batch_size + 1])
+        single.append(time.perf_counter() - start)
+    full = []
+    for _ in range(max(5, repeats // 3)):
+        start = time.perf_counter()
+        outputs = model.predict_on_batch(batch)
+        full.append(time.perf_counter() - start)
+    return {
+        'load_s': load_s,
+        'latency_ms': float(np.median(single) * 1000),
+        'throughput_ips': float(batch_size / np.median(full)),
+        'outputs': np.asarray(outputs, dtype=np.float32).tolist(),
+    }
+
+
+def autotune(model_path=pipeline.MODEL_PATH, data_dir=None, objective='latency', batch_size=32, rounds=2):
+    """Benchmark every profile and precision in its own process; returns the report with the winner.
+
+    Candidates are measured in interleaved rounds and each keeps its best
+    round, so a noisy neighbour during one run does not decide the choice.
+    """
+    candidates = [(name, precision) for name in PROFILES
+                  for precision in PRECISIONS if precision == 'float32' or bf16_supported()]
+    best_runs = {}
+    for _ in range(rounds):
+        for name, precision in candidates:
+            env = dict(os.environ, THYROID_RUNTIME_PROFILE=name, THYROID_RUNTIME_PRECISION=precision)
+            command = [sys.executable, os.path.abspath(__file__), 'measure', '--model', model_path,
+                       '--batch-size', str(batch_size)] + (['--data', data_dir] if data_dir else [])
+            run = subprocess.run(command, env=env, capture_output=True, text=True)
+            if run.returncode != 0:
+                print(f"{name}/{precision}: failed\n{run.stderr[-2000:]}", file=sys.stderr)
+                continue
+            result = json.loads(run.stdout.strip().splitlines()[-1])
+            print(f"{name}/{precision}: {result['latency_ms']:.1f} ms per image, "
+                  f"{result['throughput_ips']:.0f} images/s at batch {batch_size}", file=sys.stderr)
+            best = best_runs.setdefault((name, precision), result)
+            best['load_s'] = min(best['load_s'], result['load_s'])
+            best['latency_ms'] = min(best['latency_ms'], result['latency_ms'])
+            best['throughput_ips'] = max(best['throughput_ips'], result['throughput_ips'])
+    results = [{'profile': name, 'precision': precision, **result}
+               for (name, precision), result in best_runs.items()]
+    if not results:
+        raise SystemExit("No runtime profile could be measured")
+
+    outputs = [np.asarray(result.pop('outputs')) for result in results]
+    expected = next((o for r, o in zip(results, outputs) if r['precision'] == 'float32'), None)
+    for result, output in zip(results, outputs):
+        result['eligible'] = True
+        if result['precision'] != 'float32' and expected is not None:
+            result['max_difference'] = float(np.abs(output - expected).max())
+            result['labels_match'] = bool((output.argmax(axis=1) == expected.argmax(axis=1)).all())
+            result['eligible'] = result['labels_match'] and result['max_difference'] <= BF16_TOLERANCE
+
+    eligible = [r for r in results if r['eligible']]
+    if objective == 'latency':
+        best = min(eligible, key=lambda r: r['latency_ms'])
+    else:
+        best = max(eligible, key=lambda r: r['throughput_ips'])
+    return {
+        'chosen': {'profile': best['profile'], 'precision': best['precision']},
+        'objective': objective,
+        'host': {'cores': available_cores(), 'machine': platform.machine(), 'bf16': bf16_supported(),
+                 'tensorflow': tf.__version__},
+        'model_fingerprint': pipeline.model_fingerprint(model_path),
+        'batch_size': batch_size,
+        'rounds': rounds,
+        'results': results,
+    }
+
+
+# --------------------------
+# CLI
+# --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TensorFlow runtime profiles for CPU inference")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="Show the profiles as they resolve on this host")
+    autotune_parser = subparsers.add_parser("autotune", help="Benchmark all profiles and pick the best one")
+    measure_parser = subparsers.add_parser("measure", help="Benchmark the profile from the environment (JSON)")
+    for sub in (autotune_parser, measure_parser):
+        sub.add_argument("--model", default=pipeline.MODEL_PATH, help="Path to the Keras model")
+        sub.add_argument("--data", default=None, help="Folder with class subfolders (default: random inputs)")
+        sub.add_argument("--batch-size", type=int, default=32, help="Batch size for the throughput measurement")
+    autotune_parser.add_argument("--rounds", type=int, default=2, help="Measurements per candidate; the best one counts")
+    autotune_parser.add_argument("--objective", choices=OBJECTIVES, default='latency',
+                                 help="Single-image latency (interactive app) or batch throughput (ingestion)")
+    autotune_parser.add_argument("--output", default=RUNTIME_PROFILE_PATH, help="Where THYROID_RUNTIME_PROFILE=auto looks")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        print(f"{available_cores()} cores, native bfloat16: {'yes' if bf16_supported() else 'no'}")
+        for name in PROFILES:
+            print(f"{name:12} {profile_settings(name)}")
+        return
+    if args.command == "measure":
+        print(json.dumps(measure(args.model, args.data, args.batch_size)))
+        return
+    report = autotune(args.model, args.data, args.objective, args.batch_size, args.rounds)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    chosen = report['chosen']
+    print(f"Chose {chosen['profile']}/{chosen['precision']} for {args.objective}; "
+          f"set THYROID_RUNTIME_PROFILE=auto to use it ({args.output})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
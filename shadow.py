@@ -0,0 +1,173 @@
+"""Shadow (canary) evaluation of a candidate model next to the production model.
+
+The production model answers the request as usual. The same preprocessed tensor
+is then handed to a bounded background queue, where a worker thread runs the
+candidate model on shared batches and logs disagreements and confidence deltas
+to a local SQLite store. Users never see the candidate output.
+"""
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+from metrics import increment
+
+# --------------------------
+# Configuration (environment overrides)
+# --------------------------
+SHADOW_MODEL_PATH = os.environ.get('SHADOW_MODEL_PATH', '')
+SHADOW_LOG_PATH = os.environ.get('SHADOW_LOG_PATH', 'shadow_log.db')
+SHADOW_QUEUE_SIZE = int(os.environ.get('SHADOW_QUEUE_SIZE', '64'))
+SHADOW_BATCH_SIZE = int(os.environ.get('SHADOW_BATCH_SIZE', '16'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shadow_predictions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    tag TEXT,
+    production_class INTEGER NOT NULL,
+    candidate_class INTEGER NOT NULL,
+    disagree INTEGER NOT NULL,
+    production_confidence REAL NOT NULL,
+    candidate_confidence REAL NOT NULL,
+    confidence_delta REAL NOT NULL,
+    production_probs TEXT NOT NULL,
+    candidate_probs TEXT NOT NULL,
+    batch_size INTEGER NOT NULL,
+    candidate_latency_ms REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_shadow_created_at ON shadow_predictions (created_at);
+CREATE INDEX IF NOT EXISTS idx_shadow_disagree ON shadow_predictions (disagree);
+"""
+
+
+class ShadowEvaluator:
+    """Runs a candidate model off the request path on a bounded queue"""
+
+    def __init__(self, candidate_model, log_path=SHADOW_LOG_PATH,
+                 queue_size=SHADOW_QUEUE_SIZE, batch_size=SHADOW_BATCH_SIZE):
+        self.candidate_model = candidate_model
+        self.log_path = log_path
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.submitted = 0
+        self.dropped = 0
+        self._stop = object()
+        self._thread = threading.Thread(target=self._run, name="shadow-evaluator", daemon=True)
+        self._thread.start()
+
+    def submit(self, processed_image, production_predictions, tag=None):
+        """Queue one request for shadow inference; never blocks the caller"""
+        item = (np.asarray(processed_image), np.asarray(production_predictions), tag)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Shadow traffic is best-effort: drop rather than slow down users
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def close(self, timeout=5.0):
+        """Flush pending items and stop the worker thread"""
+        self.queue.put(self._stop)
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        """Block for one item, then drain whatever else is already queued"""
+        items = [self.queue.get()]
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        conn = sqlite3.connect(self.log_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        while True:
+            items = self._next_batch()
+            stopping = any(item is self._stop for item in items)
+            items = [item for item in items if item is not self._stop]
+            if items:
+                try:
+                    self._evaluate(conn, items)
+                except Exception as e:
+                    # A broken candidate must never take the app down, but its failures must be visible
+                    print(f"Shadow evaluation of {len(items)} requests failed: {e!r}", file=sys.stderr)
+                    increment('shadow_errors')
+            if stopping:
+                break
+        conn.close()
+
+    def _evaluate(self, conn, items):
+        # Stack the already-preprocessed tensors into one shared batch
+        batch = np.concatenate([image for image, _, _ in items], axis=0)
+        production = np.concatenate([preds.reshape(-1, preds.shape[-1]) for _, preds, _ in items], axis=0)
+
+        start = time.perf_counter()
+        candidate = self.candidate_model.predict(batch, verbose=0)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(batch)
+
+        production_class = np.argmax(production, axis=1)
+        candidate_class = np.argmax(candidate, axis=1)
+        production_conf = production.max(axis=1)
+        candidate_conf = candidate.max(axis=1)
+        # Delta on the production-predicted class, so drift in either direction is visible
+        rows = np.arange(len(batch))
+        delta = candidate[rows, production_class] - production[rows, production_class]
+
+        tags = []
+        for _, preds, tag in items:
+            tags.extend([tag] * preds.reshape(-1, preds.shape[-1]).shape[0])
+
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO shadow_predictions (created_at, tag, production_class, candidate_class, disagree, "
+            "production_confidence, candidate_confidence, confidence_delta, production_probs, candidate_probs, "
+            "batch_size, candidate_latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (now, tags[i], int(production_class[i]), int(candidate_class[i]),
+                 int(production_class[i] != candidate_class[i]),
+                 float(production_conf[i]), float(candidate_conf[i]), float(delta[i]),
+                 json.dumps(production[i].tolist()), json.dumps(candidate[i].tolist()),
+                 len(batch), latency_ms)
+                for i in range(len(batch))
+            ]
+        )
+        conn.commit()
+
+
+def summarize_shadow_log(log_path=SHADOW_LOG_PATH):
+    """Return disagreement rate and confidence-delta stats from the shadow store"""
+    conn = sqlite3.connect(log_path)
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*), AVG(disagree), AVG(confidence_delta), AVG(ABS(confidence_delta)), "
+            "AVG(candidate_latency_ms) FROM shadow_predictions"
+        ).fetchone()
+    finally:
+        conn.close()
+    return {
+        'count': row[0],
+        'disagreement_rate': row[1] or 0.0,
+        'mean_confidence_delta': row[2] or 0.0,
+        'mean_abs_confidence_delta': row[3] or 0.0,
+        'mean_candidate_latency_ms': row[4] or 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the shadow evaluation log")
+    parser.add_argument("--log", default=SHADOW_LOG_PATH, help="Path to the shadow SQLite store")
+    args = parser.parse_args()
+    print(json.dumps(summarize_shadow_log(args.log), indent=2))
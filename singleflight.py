@@ -0,0 +1,94 @@
+"""Single-flight coalescing of identical in-flight work.
+
+When a resident and an attending open the same study at the same moment, both
+Streamlit sessions would preprocess and predict the same bytes, and both may
+ask for the same report. ``SingleFlight`` lets the first caller for a key do
+the work while later callers for that key block on it and receive the same
+result (or the same exception). Keys are released as soon as the work
+finishes, so this only merges work that is running concurrently; finished
+results are served by the prediction store as before.
+
+Coalescing is per process: every Streamlit session of one server shares it,
+separate replicas do not.
+"""
+import threading
+
+from metrics import increment
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs work for a key at most once at a time; concurrent callers for the key share the result"""
+
+    def __init__(self, name='singleflight'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def do_many(self, keys, fn):
+        """{key: result} for every key: fn(claimed keys) -> {key: result} runs for keys nobody else is
+        computing, and keys already in flight are waited for.
+
+        Each caller computes its own claimed keys before waiting on anyone
+        else's, so two callers with overlapping key sets cannot deadlock.
+        """
+        claimed, waiting = [], []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call()
+                    claimed.append((key, call))
+                else:
+                    waiting.append((key, call))
+
+        results = {}
+        if claimed:
+            increment(f"{self.name}_executed", len(claimed))
+            try:
+                computed = fn([key for key, _ in claimed])
+                for key, call in claimed:
+                    call.result = results[key] = computed[key]
+            except BaseException as e:
+                for key, call in claimed:
+                    call.error = e
+                raise
+            finally:
+                with self._lock:
+                    for key, _ in claimed:
+                        del self._calls[key]
+                for _, call in claimed:
+                    call.done.set()
+
+        if waiting:
+            increment(f"{self.name}_shared", len(waiting))
+        for key, call in waiting:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            results[key] = call.result
+        return results
+
+    def do(self, key, fn):
+        """(result, shared): fn() runs once for concurrent callers with the same key; shared is True
+        for callers that received another caller's result"""
+        ran = []
+
+        def run(claimed):
+            ran.append(True)
+            return {key: fn()}
+
+        result = self.do_many([key], run)[key]
+        return result, not ran